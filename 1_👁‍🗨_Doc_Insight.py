@@ -1,24 +1,19 @@
-import ast
-import os
-import requests
 from functools import partial
 
-import numpy as np
-import pandas as pd
 import streamlit as st
 from annotated_text import annotated_text
-import streamlit_authenticator as stauth
-import openai
-from scipy.spatial.distance import cosine
-import tiktoken
 
 
 from utils.utils import auth
-from utils.utils import timed_alert
 from utils.html_codes import *
-from utils.api import send_question_to_api
 from utils.utils import set_state_if_absent
-from utils.ai import get_embedding, vector_similarity
+from utils.config import Answering, Retrieval, corpus_dir
+from utils.tracing import span, traced
+from utils.warmup import warm_up
+
+# numpy, pandas, openai and the retrieval modules are imported where they are used: the
+# login page does not need them, and the warm-up thread has them loaded by the first query
+warm_up()
 
 
 if 'sidebar_state' not in st.session_state:
@@ -34,24 +29,10 @@ st.set_page_config(page_title="Doc. Insight", page_icon="📎",
 
 st.markdown(HIDE_ST, unsafe_allow_html=True)
 
-COMPLETIONS_MODEL = "text-davinci-003"
-COMPLETIONS_API_PARAMS = {
-    "temperature": 0.0,
-    "max_tokens": 300,
-    "model": COMPLETIONS_MODEL,
-}
-
-MAX_SECTION_LEN = 500
-SEPARATOR = "\n* "
-ENCODING = "cl100k_base"  # encoding for text-embedding-ada-002
-
-# openai.api_key = os.getenv("OPENAI_API_KEY")
-openai.api_key_path = 'api.txt'
-# print(openai.api_key)
-header = """Answer the question as truthfully as possible using the provided context, \
-and include the parts of the context that are used to generate the answer after the answer starting with "\nRef:". \
-If the answer is not contained within the text below, say "I don't know."\n\nContext:\n"""
-
+COMPLETIONS_API_PARAMS = Answering.COMPLETIONS_API_PARAMS
+MAX_SECTION_LEN = Answering.MAX_SECTION_LEN
+CANDIDATE_POOL = Answering.CANDIDATE_POOL
+API_KEY_PATH = 'api.txt'
 
 
 def logout(authenticator):
@@ -62,82 +43,122 @@ def logout(authenticator):
     authenticator.logout('Logout', 'sidebar')
 
 
-@st.cache(suppress_st_warning=True, show_spinner=False)
-def str_vector_to_float(str_vector):
-    return np.array(ast.literal_eval(str_vector), dtype='float32')
-
-
-@st.cache(suppress_st_warning=True, show_spinner=False)
-def find_top_k_similar_vectors(df, input_vector, k):
-    # vectors = df['Embedding'].to_list()
-    df_ = df.copy(deep=True)
-    df_['Embedding'] = df_['Embedding'].apply(str_vector_to_float)
-    df_['Score'] = df_['Embedding'].apply(lambda x: np.dot(x, input_vector))
-    top_k_indexes = df_['Score'].nlargest(k).index
-    return df_.iloc[top_k_indexes]
-
-
 @st.cache(suppress_st_warning=True, show_spinner=False)
 def get_separator_len():
-    encoding = tiktoken.get_encoding(ENCODING)
-    separator_len = len(encoding.encode(SEPARATOR))
-    return separator_len
+    from utils.embedder import count_tokens
+    from utils.qa import SEPARATOR
 
+    return count_tokens(SEPARATOR)
 
-@st.cache(suppress_st_warning=True, show_spinner=False)
-def construct_prompt(question: str, df: pd.DataFrame) -> str:
+
+@traced()
+def get_related_contents(question, question_embedding, username, load_dataset):
     """
-    Fetch relevant
+    Asks the retrieval service, which keeps the corpus in memory, and searches in-process
+    when the service is not running or fails. Returns (scores, contents, prompt sections);
+    raises FileNotFoundError when the user has no documents.
     """
-
-    question_embedding = get_embedding(question)
-    found_contents = find_top_k_similar_vectors(df, question_embedding, 3)
-
-    scores, contents = found_contents['Score'], found_contents['Content']
-    most_relevant_document_sections = contents.to_list()
-    print('Scores:', scores)
-    # print('Contents:', most_relevant_document_sections)
-
-    chosen_sections = []
-    chosen_sections_len = 0
-    chosen_sections_indexes = []
-
-    for document_section in most_relevant_document_sections:
-        # # Add contexts until we run out of space.
-        # chosen_sections_len += document_section.tokens + get_separator_len()
-        # if chosen_sections_len > MAX_SECTION_LEN:
-        #     break
-
-        chosen_sections.append(SEPARATOR + document_section.replace("\n", " "))
-
-    # Useful diagnostic information
-    print(f"Selected {len(chosen_sections)} document sections:")
-    # print("\n".join(chosen_sections_indexes))
-
-    return (header + "".join(chosen_sections) + "\n\n Q: " + question + "\n A:",
-            scores, contents)
-
-
-@st.cache(suppress_st_warning=True, show_spinner=False)
+    import requests
+
+    from utils import api
+    from utils.access import access_mask
+    from utils.qa import find_related_contents
+
+    # Keyword search only, when there is no question embedding
+    mode = Retrieval.MODE if question_embedding is not None else 'lexical'
+    try:
+        found = api.get_related_contents(username, question, question_embedding,
+                                         CANDIDATE_POOL, MAX_SECTION_LEN, get_separator_len(), mode,
+                                         Retrieval.MMR_LAMBDA, Retrieval.MMR_K)
+        return found['scores'], found['contents'], found['texts']
+    except FileNotFoundError:
+        # No documents stored; searching in-process would not find any either
+        raise
+    except requests.RequestException as e:
+        print('Retrieval service failed, searching in-process:', e)
+
+    with st.spinner('Preparing Dataset...'):
+        dataset = load_dataset()
+    # Only the chunks the user may read, when the corpus is shared
+    allowed = access_mask(dataset[1], username)
+    # Add contexts until we run out of space.
+    found = find_related_contents(dataset, question, question_embedding, CANDIDATE_POOL, MAX_SECTION_LEN,
+                                  get_separator_len(), mode, Retrieval.RRF_K, Retrieval.MMR_LAMBDA,
+                                  Retrieval.MMR_K, allowed)
+    return found['Score'].astype(float).to_list(), found['Content'].to_list(), found['Text'].to_list()
+
+
+@traced()
 def answer_query_with_context(
         query: str,
-        df: pd.DataFrame,
-        show_prompt: bool = False
+        load_dataset,
+        corpus: tuple,
+        show_prompt: bool = False,
+        on_text=None
 ) -> str:
+    """
+    `corpus` is (username, store version); answers are cached per corpus version on disk,
+    so the dataset is only loaded and the completion only requested on a cache miss.
+    With `on_text`, the completion is streamed and `on_text(text so far)` is called on
+    every new token.
+    """
+    import openai
+
+    from utils.ai import try_get_embedding
+    from utils.cache import get_answer_cache
+    from utils.qa import complete, construct_prompt, stream_completion
+    from utils.semantic_cache import get_semantic_cache
+
+    # openai.api_key = os.getenv("OPENAI_API_KEY")
+    openai.api_key_path = API_KEY_PATH
+    answer_cache = get_answer_cache()
+    with span('answer_cache'):
+        cached = answer_cache.get(*corpus, query, COMPLETIONS_API_PARAMS)
+    if cached is not None:
+        return cached['answer'], cached['scores'], cached['contents']
+
+    # None in lexical mode or when the embedding API is slow or down
+    question_embedding = None
+    if Retrieval.MODE != 'lexical':
+        question_embedding = try_get_embedding(query, timeout=Retrieval.QUERY_EMBEDDING_TIMEOUT)
+
+    # Differently phrased versions of an earlier question
+    semantic_cache = get_semantic_cache()
+    if question_embedding is not None:
+        similar = semantic_cache.get(corpus, question_embedding)
+        if similar is not None:
+            cached, similarity = similar
+            return cached['answer'], cached['scores'], cached['contents']
 
     with st.spinner('Finding related docs...'):
-        prompt, scores, contents = construct_prompt(query, df)
+        scores, contents, sections = get_related_contents(query, question_embedding, corpus[0], load_dataset)
+    print('Scores:', scores)
+    # Useful diagnostic information
+    print(f"Selected {len(sections)} document sections:")
+    prompt = construct_prompt(query, sections)
 
     if show_prompt:
         print(prompt)
 
-    with st.spinner('Generating answer...'):
-        response = openai.Completion.create(
-                prompt=prompt,
-                **COMPLETIONS_API_PARAMS
-        )
-
-    return response["choices"][0]["text"].strip(" \n"), scores, contents
+    if on_text is None:
+        with st.spinner('Generating answer...'):
+            answer = complete(prompt, COMPLETIONS_API_PARAMS)
+    else:
+        # Stays empty when the stream ends without any text
+        answer = ''
+        with span('completion'):
+            for answer in stream_completion(prompt, COMPLETIONS_API_PARAMS):
+                on_text(answer)
+
+    answer = answer.strip(" \n")
+    cached = {'answer': answer, 'scores': scores, 'contents': contents}
+    # A keyword search answer given because the embedding timed out would otherwise be
+    # served for the question until the corpus changes
+    if question_embedding is not None or Retrieval.MODE == 'lexical':
+        answer_cache.put(*corpus, query, COMPLETIONS_API_PARAMS, cached)
+    if question_embedding is not None:
+        semantic_cache.put(corpus, question_embedding, cached)
+    return answer, scores, contents
 
 
 # @st.cache(suppress_st_warning=True)
@@ -153,10 +174,13 @@ def answer_query_with_context(
 #     return full_ans
 
 
-@st.cache(suppress_st_warning=True)
-def get_doc_dataset(dataset_path):
-    df = pd.read_csv(dataset_path)
-    return df
+@traced()
+def get_doc_dataset(usr_dir):
+    from utils.corpus import get_corpus_manager
+
+    # Shared by all sessions of this process, reloaded when the store version changes
+    version, dataset = get_corpus_manager().get(usr_dir)
+    return dataset
 
 
 def main():
@@ -177,31 +201,51 @@ def main():
         print('Q:', question_text)
         # if clicked or question_text:
         if clicked and question_text:
-            with st.spinner('Preparing Dataset...'):
-                dataset_path = os.path.join(os.getcwd(), 'users', st.session_state["username"], 'processed_docs.csv')
-                df = get_doc_dataset(dataset_path)
+            from utils.qa import split_answer
+            from utils.store import store_version
 
-            full_ans, scores, contents = answer_query_with_context(question_text, df)
-            ans_part = full_ans.split('Ref:')[0]
+            usr_dir = corpus_dir(st.session_state["username"])
+            version = store_version(usr_dir)
             st.markdown('**Answer:**')
-            # st.write(ans_part)
-            annotated_text((ans_part, 'ANS', "#28404A"))
-            st.markdown('---')
-            if "I don't know" not in ans_part:
-                ref_part = full_ans.split('Ref:')[1].strip()
-                st.markdown('**Reference:**')
-                st.markdown(f"- _{ref_part}_")
-                # for c in contents:
-                #     dd = c.find(ref_part)
-                #     print(c)
-                #     if dd != -1:
-                #         p = c[dd:dd+len(ref_part)]
-                #         annotated_text(c[:dd], (ref_part, "REF"), c[dd+len(ref_part)+1:])
-                #         break
-                with st.expander('Related Contents', expanded=False):
-                    for idx, (score, doc) in enumerate(zip(scores, contents)):
-                        part = {idx+1: {'Score': round(score, 4), 'Content': doc}}
-                        st.write(part)
+            answer_box = st.empty()
+            reference_box = st.empty()
+
+            def show_answer(text, final=False):
+                ans_part, ref_part = split_answer(text, final)
+                with answer_box.container():
+                    # st.write(ans_part)
+                    annotated_text((ans_part, 'ANS', "#28404A"))
+                    st.markdown('---')
+                if ref_part and "I don't know" not in ans_part:
+                    with reference_box.container():
+                        st.markdown('**Reference:**')
+                        st.markdown(f"- _{ref_part}_")
+                else:
+                    reference_box.empty()
+                return ans_part, ref_part
+
+            try:
+                full_ans, scores, contents = answer_query_with_context(
+                        question_text,
+                        partial(get_doc_dataset, usr_dir),
+                        (st.session_state["username"], version),
+                        on_text=show_answer if Answering.STREAM_ANSWERS else None)
+            except FileNotFoundError:
+                answer_box.warning('No documents to search yet, upload some in the Document Store first.')
+            else:
+                ans_part, ref_part = show_answer(full_ans, final=True)
+                if ref_part is not None and "I don't know" not in ans_part:
+                    # for c in contents:
+                    #     dd = c.find(ref_part)
+                    #     print(c)
+                    #     if dd != -1:
+                    #         p = c[dd:dd+len(ref_part)]
+                    #         annotated_text(c[:dd], (ref_part, "REF"), c[dd+len(ref_part)+1:])
+                    #         break
+                    with st.expander('Related Contents', expanded=False):
+                        for idx, (score, doc) in enumerate(zip(scores, contents)):
+                            part = {idx+1: {'Score': round(score, 4), 'Content': doc}}
+                            st.write(part)
 
 
         st.session_state.sidebar_state = 'auto'
@@ -1,83 +1,29 @@
-import json
 import os
-import glob
 import time
-import shutil
 from random import randint
-import requests
 
-import pandas as pd
 import streamlit as st
 from streamlit_custom_notification_box import custom_notification_box
 
 from utils.utils import timed_alert
 from utils.html_codes import *
-from utils.config import Paths, Urls
+from utils.access import user_groups
+from utils.config import Paths, Jobs, Crawl, Sharing
+from utils.crawler import normalize_url
 from utils.utils import set_state_if_absent
-from utils.ai import get_embedding
+from utils.ingest import submit_uploaded_docs, submit_crawl
+from utils.pipeline import ALLOWED_SUFFIXES
+from utils.jobs import get_job_queue, QUEUED, RUNNING, DONE, FAILED, CRAWL
+from utils.warmup import warm_up
+
+# The haystack PreProcessor is set up in the background, and inherited by the processes splitting files
+warm_up()
 
 
 st.set_page_config(page_title="Doc. Insight", page_icon="📎", layout="wide",
                    menu_items={'About': "### Doc. Insight app!"})
 
 
-def process_docs():
-    with st.spinner('Preparing Processor...'):
-        from haystack.utils import convert_files_to_docs, clean_wiki_text
-        from haystack.nodes import PreProcessor
-
-    with st.spinner('Creating Passages...'):
-        all_docs = convert_files_to_docs(dir_path=Paths.TMP_DIR,
-                                         clean_func=clean_wiki_text,
-                                         split_paragraphs=True)
-        for doc_txt in all_docs:
-            doc_filename = f"{os.path.basename(doc_txt.meta['name']).split('.')[0]}.txt"
-            with open(os.path.join(Paths.TXT_DIR, doc_filename), 'w', encoding="utf-8") as f:
-                f.write(doc_txt.content)
-
-    with st.spinner('Processing Docs...'):
-        # %% Preprocess
-        preprocessor = PreProcessor(
-                clean_empty_lines=True,
-                clean_whitespace=True,
-                clean_header_footer=False,
-                split_by="word",
-                split_length=200,
-                split_overlap=20,
-                split_respect_sentence_boundary=True,
-        )
-        chunks = preprocessor.process(all_docs)
-        print(f"n_docs_input: {len(all_docs)}\nn_docs_output: {len(chunks)}")
-
-    with st.spinner('Saving Docs...'):
-        chunk_paths = []
-        for chunk in chunks:
-            chunk_filename = f"{chunk.meta['name']}_{chunk.meta['_split_id']}.txt"
-            chunk_path = os.path.join(Paths.CHK_DIR, chunk_filename)
-            chunk_paths.append(chunk_path)
-            with open(chunk_path, 'w', encoding="utf-8") as f:
-                f.write(chunk.content)
-
-    return len(all_docs), len(chunks), chunk_paths
-
-
-def chunks_to_df(chunk_paths):
-    data = []
-    for chunk_path in chunk_paths:
-        # print('---reading', chunk_path)
-        with open(chunk_path, 'r', encoding="utf8", errors="ignore") as f:
-            content = f.read()
-            # print('---content:', content)
-            data.append([chunk_path, content])
-        df = pd.DataFrame(data, columns=['Filename', 'Content'])
-    return pd.DataFrame(data, columns=['Filename', 'Content'])
-
-
-def apply_get_embedding(df):
-    df['Embedding'] = df['Content'].apply(get_embedding)
-    return df
-
-
 def file_exists(file_name):
     existing_files = os.listdir(Paths.DOC_DIR)
     temp_files = os.listdir(Paths.TMP_DIR)
@@ -98,10 +44,22 @@ if 'uploader_key' not in st.session_state:
     st.session_state.uploader_key = str(randint(1000, 100000000))
 
 
-def upload_doc():
+def share_group():
+    """
+    The group new documents are shared with, chosen in the sidebar when the corpus is
+    shared and the user is in a group; '' keeps them private.
+    """
+    groups = user_groups(st.session_state['username']) if Sharing.ENABLED else []
+    if not groups:
+        return ''
+    choice = st.sidebar.selectbox('👥 Share new documents with', ['Only me', *groups], key='share_group')
+    return '' if choice == 'Only me' else choice
+
+
+def upload_doc(group=''):
     uploaded_any = False
     uploaded_files = st.sidebar.file_uploader("📤 Upload a document file",
-                                              type=['txt', 'doc', 'docx', 'pdf'],
+                                              type=[suffix.lstrip('.') for suffix in ALLOWED_SUFFIXES],
                                               accept_multiple_files=True,
                                               key=st.session_state.uploader_key)
 
@@ -112,15 +70,12 @@ def upload_doc():
             }"""
         st.sidebar.markdown(f'<style>{css}</style>', unsafe_allow_html=True)
 
-        with progress_container:
-            placeholder = st.empty()
-            placeholder.write(' 🚧 >>> Processing documents ...')
-            process_progress = st.progress(0)
-        for i, file in enumerate(uploaded_files):
+        saved_paths = []
+        for file in uploaded_files:
             # file_details = {"FileName":file.name, "FileType":file.type}
 
             if not file_exists(file.name):
-                save_path = save_uploaded_file(file)
+                saved_paths.append(save_uploaded_file(file))
                 uploaded_any = True
             elif not uploaded_any:
                 with progress_container:
@@ -128,74 +83,87 @@ def upload_doc():
                                 type_='error')
                 return
 
-            process_progress.progress((i + 1) * 100 // len(uploaded_files))
-
-        num_docs, num_chunks, chunk_paths = process_docs()
-        chunks_df = chunks_to_df(chunk_paths)
-        chunks_df.to_csv(os.path.join(os.getcwd(), 'users', st.session_state["username"], 'docs.csv'))
-        with st.spinner('Calculating Embeddings...'):
-            full_df = apply_get_embedding(chunks_df)
-            full_df.to_csv(os.path.join(os.getcwd(), 'users', st.session_state["username"], 'processed_docs.csv'))
-
-        placeholder.empty()
-        process_progress.empty()
-        with progress_container:
-            if num_docs > 0:
-                message = (f"Processed {num_docs} document(s)"
-                           f"and created {num_chunks} passages")
-
-                custom_notification_box(icon='add_task',
-                                        textDisplay=message,
-                                        externalLink='', url='#',
-                                        styles=NOTIF_STYLE, key="qwerty")
-                time.sleep(2)
+        # Passages and embeddings are created by the job workers; show_jobs follows their progress
+        submit_uploaded_docs(saved_paths, group)
 
         uploaded_files = None
         if 'uploader_key' in st.session_state.keys():
             st.session_state.pop('uploader_key')
-        # with progress_container:
-        #     timed_alert('Document processing finished')
-
-        for f in os.listdir(Paths.TMP_DIR):
-            shutil.move(os.path.join(Paths.TMP_DIR, f), os.path.join(Paths.DOC_DIR, f))
 
     return uploaded_any
 
 
-def upload_link():
-    url = st.sidebar.text_input("Enter a url to crawl", value="")
-    if url is not None or url != '':
-        st.sidebar.markdown(f"{url}")
-        # st.sidebar.button('Crawl', on_click=partial(send_link_to_api, None))
-
-    # from selenium import webdriver
-    # options = webdriver.ChromeOptions()
-    # or from selenium.webdriver.chrome.options import Options
-    # options.binary_location = '/home/appuser/.wdm/drivers/chromedriver/linux64/109.0.5414/chromedriver'
-    if url != '':
-        with st.spinner('Please wait...'):
-            from haystack.nodes import Crawler
-        with progress_container:
-            placeholder = st.empty()
-            placeholder.write(' 🚧 >>> Processing URL ...')
-
-        with st.spinner('Please wait ...'):
-            # webdriver_options=["--disable-gpu", "--no-sandbox", "--single-process"])
-            crawler = Crawler(output_dir=Paths.URL_DIR, crawler_depth=1)
-            sub_urls = crawler._extract_sublinks_from_url(base_url=url)
-            with st.sidebar.expander(f"Found {len(sub_urls)} sub-urls", expanded=False):
-                for _url in sub_urls:
-                    st.markdown(_url)
-            if len(sub_urls) > 0:
-                clicked = st.sidebar.button('📚 Get Content')
-                if clicked:
-                    crawler.crawl(output_dir=Paths.URL_DIR, urls=url, crawler_depth=1)
-            # crawler._extract_sublinks_from_url -> already_found_links: Optional[List] = None
-            # st.sidebar.write(f"Found {len(sub_urls)} sub-urls")
-            # for u in sub_urls:
-            #     st.sidebar.markdown(f"{u}")
-
-            placeholder.empty()
+def describe_job(job):
+    if job['kind'] == CRAWL:
+        return f"Crawl of {job['params']['url']}"
+    return f"{job['n_files']} document(s)"
+
+
+def show_jobs():
+    """
+    Shows the progress of the user's ingestion jobs and a notification for every job that
+    finished since the page was opened. Returns True while a job is queued or running.
+    """
+    jobs = get_job_queue().jobs(st.session_state['username'])
+    finished = [job for job in jobs if job['status'] in (DONE, FAILED)]
+    set_state_if_absent('notified_jobs', {job['id'] for job in finished})
+
+    active = False
+    with progress_container:
+        for job in reversed(jobs):
+            if job['status'] == QUEUED:
+                active = True
+                st.write(f" ⏳ >>> {describe_job(job)} waiting to be processed ...")
+            elif job['status'] == RUNNING and job['kind'] == CRAWL:
+                active = True
+                st.write(f" 🚧 >>> Crawling {job['params']['url']}: "
+                         f"{job['n_done']} of {job['n_files']} page(s) found so far done ...")
+                st.progress(job['n_done'] * 100 // max(job['params']['max_pages'], 1))
+            elif job['status'] == RUNNING:
+                active = True
+                st.write(f" 🚧 >>> Creating passages and embeddings: "
+                         f"{job['n_done']} of {job['n_files']} document(s) done ...")
+                st.progress(job['n_done'] * 100 // max(job['n_files'], 1))
+
+        for job in finished:
+            if job['id'] in st.session_state.notified_jobs:
+                continue
+            st.session_state.notified_jobs.add(job['id'])
+            if job['status'] == FAILED:
+                timed_alert(f"Processing {describe_job(job)} failed: {job['error']}", type_='error')
+                continue
+            for file in get_job_queue().files(job['id']):
+                if file['status'] == FAILED:
+                    timed_alert(f"Could not process \"{os.path.basename(file['path'])}\": {file['error']}",
+                                type_='error')
+            n_docs = job['n_done'] - job['n_failed']
+            if n_docs > 0:
+                message = (f"Processed {n_docs} document(s) "
+                           f"and created {job['n_chunks']} passages")
+
+                custom_notification_box(icon='add_task',
+                                        textDisplay=message,
+                                        externalLink='', url='#',
+                                        styles=NOTIF_STYLE, key=f"job_{job['id']}")
+    return active
+
+
+def upload_link(group=''):
+    with st.sidebar.form('crawl_form', clear_on_submit=True):
+        url = st.text_input("Enter a url to crawl", value="")
+        max_depth = st.number_input('Link depth', min_value=0, max_value=3, value=Crawl.MAX_DEPTH)
+        max_pages = st.number_input('Max pages', min_value=1, max_value=500, value=Crawl.MAX_PAGES)
+        clicked = st.form_submit_button('📚 Get Content')
+
+    if clicked and url:
+        if normalize_url(url) is None:
+            with progress_container:
+                timed_alert(f'Not a web address:\n "{url}"', type_='error')
+            return False
+        # Pages are fetched, split and embedded by the job workers; show_jobs follows their progress
+        submit_crawl(url, int(max_depth), int(max_pages), group)
+        return True
+    return False
 
 
 if st.session_state['authentication_status']:
@@ -234,16 +202,27 @@ if st.session_state['authentication_status']:
                             key=f'd_pdf_{i}'
                     )
 
-    uploaded = upload_doc()
+    # Resumes jobs left over from a previous run of the app
+    get_job_queue().start_workers(Jobs.WORKERS)
+    processing = show_jobs()
+
+    group = share_group()
+    uploaded = upload_doc(group)
     if uploaded:
         st.experimental_rerun()
 
     st.sidebar.markdown("---")
 
-    upload_link()
+    crawling = upload_link(group)
+    if crawling:
+        st.experimental_rerun()
 
     st.sidebar.markdown("---")
 
+    if processing:
+        time.sleep(Jobs.POLL_SECONDS)
+        st.experimental_rerun()
+
 else:
     st.markdown('Please <a href="/" target="_self">login</a> to access this page',
                 unsafe_allow_html=True)
\ No newline at end of file
@@ -1,10 +1,22 @@
 import os
 import shutil
+from functools import partial
 
+import pandas as pd
+import requests
 import streamlit as st
 
-from utils.config import Paths, Urls
+from utils import api
+from utils.config import Paths
 from utils.utils import timed_alert
+from utils.cache import get_answer_cache, get_embedding_cache
+from utils.corpus import get_corpus_manager
+from utils.semantic_cache import get_semantic_cache
+from utils.ingest import clear_documents, list_documents, remove_document, replace_document
+from utils.tracing import get_tracer
+from utils.warmup import warm_up
+
+warm_up()
 
 
 st.set_page_config(page_title="Doc. Insight", page_icon="📎", layout="wide",
@@ -26,6 +38,15 @@ def clear_docs():
                 shutil.rmtree(Paths.CHK_DIR)
             if os.path.exists(Paths.URL_DIR):
                 shutil.rmtree(Paths.URL_DIR)
+            # The service also drops the corpus it keeps in memory
+            try:
+                api.clear(st.session_state["username"])
+            except requests.ConnectionError:
+                clear_documents()
+                get_answer_cache().invalidate(st.session_state["username"])
+            # So does the in-process fallback of the Doc Insight page
+            get_corpus_manager().drop(Paths.CORPUS_DIR)
+            get_semantic_cache().invalidate(st.session_state["username"])
 
             if not os.path.exists(Paths.TMP_DIR):
                 os.makedirs(Paths.TMP_DIR)
@@ -41,6 +62,79 @@ def clear_docs():
     timed_alert('✅ Cleared all documents', type_='success')
 
 
+def remove_doc(document):
+    with doc_container:
+        try:
+            with st.spinner(f'Removing "{document}"...'):
+                remove_document(document)
+        except PermissionError as e:
+            timed_alert(str(e), type_='error')
+            return
+        timed_alert(f'✅ Removed "{document}"', type_='success')
+
+
+def replace_doc(document, uploader_key):
+    uploaded_file = st.session_state[uploader_key]
+    if uploaded_file is None:
+        return
+    with doc_container:
+        try:
+            with st.spinner(f'Re-indexing "{document}"...'):
+                num_chunks = replace_document(document, uploaded_file)
+        except PermissionError as e:
+            timed_alert(str(e), type_='error')
+            return
+        timed_alert(f'✅ Replaced "{document}" with {num_chunks} passages', type_='success')
+
+
+def metrics_table(snapshot):
+    table = pd.DataFrame.from_dict(snapshot, orient='index',
+                                   columns=['count', 'errors', 'mean_ms', 'p50_ms', 'p95_ms', 'p99_ms'])
+    return table.rename_axis('stage').round(2)
+
+
+def show_metrics():
+    with st.expander('⏱️ Latency per stage', expanded=False):
+        tracer = get_tracer()
+        if not tracer.enabled:
+            st.write('Tracing is disabled (utils.config.Tracing.ENABLED)')
+            return
+        st.markdown('**This app server**')
+        st.dataframe(metrics_table(tracer.snapshot()), use_container_width=True)
+        st.download_button('⬇️ Prometheus metrics', data=tracer.prometheus(),
+                           file_name='metrics.txt', mime='text/plain')
+        try:
+            service_snapshot = api.get_metrics()
+        except requests.RequestException:
+            return
+        st.markdown('**Retrieval service**')
+        st.dataframe(metrics_table(service_snapshot), use_container_width=True)
+
+
+def show_cache_stats():
+    with st.expander('🗄️ Caches', expanded=False):
+        st.markdown('**This app server**')
+        caches = {'answers': get_answer_cache().stats(), 'similar questions': get_semantic_cache().stats(),
+                  'embeddings': get_embedding_cache().stats()}
+        table = pd.DataFrame.from_dict(caches, orient='index').rename_axis('cache')
+        st.dataframe(table.round(3), use_container_width=True)
+        # Corpora searched in this process while the retrieval service was down
+        st.markdown('**Loaded corpora**')
+        st.dataframe(pd.DataFrame([get_corpus_manager().stats()], index=['this process']), use_container_width=True)
+
+
+def show_documents(documents):
+    for document, n_chunks in sorted(documents.items()):
+        with st.expander(f"{document}  ({n_chunks} passages)", expanded=False):
+            uploader_key = f'replace_{document}'
+            st.file_uploader('🔄 Replace with a new version',
+                             type=[os.path.splitext(document)[1].lstrip('.') or 'txt'],
+                             key=uploader_key,
+                             on_change=partial(replace_doc, document, uploader_key))
+            st.button('🗑️ Remove document', key=f'remove_{document}',
+                      on_click=partial(remove_doc, document))
+
+
 if 'authentication_status' not in st.session_state:
     st.session_state['authentication_status'] = False
 
@@ -48,14 +142,26 @@ if st.session_state['authentication_status']:
     st.markdown('## Manage your documents')
     st.markdown("---")
 
+    documents = list_documents()
+
     c1, c2, c3 = st.columns([1, 1, 7])
     with c1:
         st.markdown('Documents: <span style="color:Teal">' +
-                    f'{len(os.listdir(Paths.DOC_DIR))}</span>', unsafe_allow_html=True)
+                    f'{len(documents)}</span>', unsafe_allow_html=True)
 
     with c2:
         st.markdown('Passages: <span style="color:Teal">' +
-                    f'{len(os.listdir(Paths.CHK_DIR))}</span>', unsafe_allow_html=True)
+                    f'{sum(documents.values())}</span>', unsafe_allow_html=True)
+
+    doc_container = st.container()
+    with doc_container:
+        show_documents(documents)
+
+    st.markdown("---")
+    show_metrics()
+    show_cache_stats()
+
+    st.markdown("---")
     btn_container = st.empty()
     with btn_container:
         btn_clear = st.button('❌ Clear Document Store', on_click=clear_docs)
@@ -2,4 +2,5 @@
 # source /home/saeed/anaconda3/etc/profile.d/conda.sh
 # conda activate deploy
 # streamlit run "1_👁‍🗨_Doc_Insight.py" --server.address 0.0.0.0 --server.port 8080
+python -m utils.service --port 8088 &
 streamlit run "1_👁‍🗨_Doc_Insight.py" --server.port 8501 --server.enableXsrfProtection false
\ No newline at end of file
@@ -0,0 +1,57 @@
+import pandas as pd
+import pytest
+
+from utils.access import access_mask, can_modify, can_read, private_documents, shared_document
+from utils.config import Sharing
+
+CHUNKS = [('alice', '', 'notes.txt'),
+          ('alice', 'team', 'plan.txt'),
+          ('bob', '', 'notes.txt'),
+          ('bob', 'team', 'budget.txt'),
+          ('carol', 'board', 'minutes.txt')]
+
+
+@pytest.fixture
+def sharing(monkeypatch):
+    monkeypatch.setattr(Sharing, 'ENABLED', True)
+    monkeypatch.setattr(Sharing, 'GROUPS', {'team': ['alice', 'bob'], 'board': ['carol']})
+
+
+@pytest.fixture
+def meta():
+    return pd.DataFrame({'Owner': [owner for owner, _, _ in CHUNKS],
+                         'Group': [group for _, group, _ in CHUNKS],
+                         'Document': [shared_document(name, owner, group) for owner, group, name in CHUNKS]},
+                        dtype='category')
+
+
+def test_users_read_their_own_and_their_groups_chunks(sharing, meta):
+    assert access_mask(meta, 'alice').tolist() == [True, True, False, True, False]
+    assert access_mask(meta, 'carol').tolist() == [False, False, False, False, True]
+    # Nobody uploaded anything or is in a group
+    assert not access_mask(meta, 'dave').any()
+
+
+def test_documents_restrict_the_readable_chunks(sharing, meta):
+    mask = access_mask(meta, 'bob', documents=['@team/plan.txt', '@board/minutes.txt'])
+    assert mask.tolist() == [False, True, False, False, False]
+
+
+def test_nothing_is_filtered_without_sharing(meta):
+    assert access_mask(meta, 'dave') is None
+    assert access_mask(meta, 'dave', documents=['bob/notes.txt']).tolist() == [False, False, True, False, False]
+
+
+def test_document_names(sharing):
+    assert can_read('@team/plan.txt', 'bob') and not can_read('@team/plan.txt', 'carol')
+    assert can_read('bob/notes.txt', 'bob') and not can_read('bob/notes.txt', 'alice')
+    assert private_documents(['bob/notes.txt', '@team/budget.txt', 'alice/notes.txt'], 'bob') == ['bob/notes.txt']
+
+
+def test_only_the_uploader_changes_a_document():
+    assert can_modify('bob/notes.txt', 'bob', ['bob'])
+    assert not can_modify('bob/notes.txt', 'alice', ['bob'])
+    assert can_modify('@team/budget.txt', 'bob', ['bob'])
+    # Alice reads the document of her group, but bob uploaded it
+    assert not can_modify('@team/budget.txt', 'alice', ['bob'])
+    assert not can_modify('@team/budget.txt', 'alice', [])
@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+import pytest
+
+from utils.blobs import BlobReader, ChunkTexts, write_blob
+
+TEXTS = ['apples grow in the orchard', '', 'Preis: 10 € pro Kiste', 'rivers flow to the sea']
+
+
+@pytest.mark.parametrize('codec', ['zlib', 'none', 'zstd'])
+def test_blob_round_trip(tmp_path, codec):
+    if codec == 'zstd':
+        pytest.importorskip('zstandard')
+    path = str(tmp_path / 'texts.blob')
+    assert write_blob(path, iter(TEXTS), codec) == os.path.getsize(path)
+    reader = BlobReader(path, codec)
+    assert len(reader) == len(TEXTS)
+    assert [reader[row] for row in (3, 0, 2, 1)] == [TEXTS[3], TEXTS[0], TEXTS[2], TEXTS[1]]
+
+
+def test_empty_blob(tmp_path):
+    path = str(tmp_path / 'texts.blob')
+    write_blob(path, [])
+    assert len(BlobReader(path)) == 0
+
+
+def test_unknown_codec(tmp_path):
+    with pytest.raises(ValueError):
+        write_blob(str(tmp_path / 'texts.blob'), TEXTS, 'lz4')
+
+
+@pytest.fixture
+def texts(tmp_path):
+    # A segment written before texts were kept in blobs, then two blob segments
+    paths = [str(tmp_path / 'a.blob'), str(tmp_path / 'b.blob')]
+    write_blob(paths[0], TEXTS[1:3])
+    write_blob(paths[1], TEXTS[3:])
+    return ChunkTexts([TEXTS[:1], BlobReader(paths[0]), BlobReader(paths[1])])
+
+
+def test_chunk_texts_read_across_parts(texts):
+    assert len(texts) == len(TEXTS)
+    assert [texts[row] for row in range(len(TEXTS))] == TEXTS
+    assert texts[-1] == TEXTS[-1] and texts[np.int64(2)] == TEXTS[2]
+    assert texts[1:] == TEXTS[1:] and texts[::-2] == TEXTS[::-2]
+    assert texts[np.array([3, 0, 2])] == [TEXTS[3], TEXTS[0], TEXTS[2]]
+    assert list(texts) == TEXTS
+
+
+def test_chunk_texts_out_of_range(texts):
+    with pytest.raises(IndexError):
+        texts[len(TEXTS)]
+    with pytest.raises(IndexError):
+        texts[[0, len(TEXTS)]]
+
+
+def test_chunk_texts_count_bytes_of_texts_in_memory():
+    # Two bytes per character in memory, while a character is one item of the string
+    assert ChunkTexts([['€' * 1000]]).nbytes >= 2000
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+
+from utils.corpus import CorpusManager, clear_corpus
+from utils.store import SegmentStore
+
+
+def _append(user_dir, filename, n_chunks=3, dim=8, seed=0):
+    chunks = pd.DataFrame({'Filename': [f'{filename}_{i}.txt' for i in range(n_chunks)],
+                           'Content': [f'{filename} passage number {i}' for i in range(n_chunks)]})
+    vectors = np.random.default_rng(seed).standard_normal((n_chunks, dim)).astype('float32')
+    SegmentStore(user_dir).append(chunks, vectors / np.linalg.norm(vectors, axis=1, keepdims=True))
+
+
+def test_versions_continue_after_clear(tmp_path):
+    user_dir = str(tmp_path)
+    corpora = CorpusManager()
+    _append(user_dir, 'a')
+    version_a, dataset = corpora.get(user_dir)
+    assert set(dataset[1]['Document']) == {'a'}
+
+    clear_corpus(user_dir)
+    _append(user_dir, 'b', seed=1)
+    version_b, dataset = corpora.get(user_dir)
+    assert version_b > version_a
+    assert set(dataset[1]['Document']) == {'b'}
+
+
+def test_clear_keeps_version_of_empty_store(tmp_path):
+    user_dir = str(tmp_path)
+    _append(user_dir, 'a')
+    version = SegmentStore(user_dir).version
+    clear_corpus(user_dir)
+    clear_corpus(user_dir)
+    assert SegmentStore(user_dir).version == version
+    assert not SegmentStore(user_dir).exists()
@@ -0,0 +1,112 @@
+import functools
+import threading
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from utils.crawler import Crawler, normalize_url, page_filename, parse_html, save_page
+
+SITE = {
+    'index.html': '<html><head><title>Home</title></head><body><nav><a href="b.html">B</a></nav>'
+                  '<p>Welcome to the home page.</p><a href="a.html">A</a> <a href="a.html#top">A again</a>'
+                  '<a href="copy.html">Copy</a> <a href="notes.txt">Notes</a> <a href="logo.png">Logo</a>'
+                  '<a href="http://elsewhere.invalid/">Elsewhere</a> <a href="mailto:someone@example.com">Mail</a>'
+                  '</body></html>',
+    'a.html': '<html><body><p>Apples grow on trees.</p><a href="deep.html">Deeper</a>'
+              '<a href="index.html">Home</a></body></html>',
+    'b.html': '<html><body><p>Bananas are yellow.</p></body></html>',
+    # Same text as a.html under another URL
+    'copy.html': '<html><body><p>Apples  grow on trees.</p>\n<a href="deep.html">Deeper</a> Home</body></html>',
+    'deep.html': '<html><body><p>Deep down the site.</p></body></html>',
+    'notes.txt': 'Plain text notes.',
+    'logo.png': '\x89PNG',
+}
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def site(tmp_path_factory):
+    root = tmp_path_factory.mktemp('site')
+    for name, content in SITE.items():
+        (root / name).write_text(content, encoding='utf-8')
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(QuietHandler, directory=str(root)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_address[1]}/'
+    server.shutdown()
+    server.server_close()
+
+
+def crawled(site, **params):
+    crawler = Crawler(timeout=5, **params)
+    pages = {page.url[len(site):]: page for page in crawler.crawl(site + 'index.html')}
+    return pages, crawler.stats
+
+
+def test_depth_zero_fetches_start_url_only(site):
+    pages, stats = crawled(site, max_depth=0)
+    assert list(pages) == ['index.html']
+    assert pages['index.html'].title == 'Home'
+    # The links in <nav> are followed, but their text is left out
+    assert pages['index.html'].text == 'Welcome to the home page.\n\nA A again Copy Notes Logo Elsewhere Mail'
+    assert stats['fetched'] == 1
+
+
+def test_follows_links_up_to_max_depth(site):
+    pages, stats = crawled(site, max_depth=1)
+    # logo.png is not text and other hosts are not followed
+    assert set(pages) - {'a.html', 'copy.html'} == {'index.html', 'b.html', 'notes.txt'}
+    assert pages['b.html'].depth == 1 and pages['notes.txt'].text == 'Plain text notes.'
+    assert stats['skipped'] == 1
+
+    pages, _ = crawled(site, max_depth=2)
+    assert pages['deep.html'].depth == 2
+
+
+def test_duplicate_texts_are_skipped(site):
+    pages, stats = crawled(site, max_depth=1)
+    # copy.html has the text of a.html; whichever arrives second is dropped
+    assert len({'a.html', 'copy.html'} & set(pages)) == 1
+    assert stats['duplicates'] == 1
+
+
+def test_urls_are_visited_once(site):
+    _, stats = crawled(site, max_depth=3)
+    # index, a, b, copy, notes, logo and deep, although a.html links back home and a.html#top is a.html
+    assert stats['fetched'] + stats['skipped'] == 7
+
+
+def test_max_pages(site):
+    pages, stats = crawled(site, max_depth=2, max_pages=2)
+    assert len(pages) == 2 and stats['pages'] == 2
+    assert 'index.html' in pages
+
+
+def test_closing_the_generator_stops_the_crawl(site):
+    crawler = Crawler(max_depth=2, concurrency=1, timeout=5)
+    pages = crawler.crawl(site + 'index.html')
+    assert next(pages).url.endswith('index.html')
+    pages.close()
+    assert crawler.stats['pages'] < 5
+
+
+def test_parse_html_and_urls():
+    title, text, links = parse_html('<title> A  page </title><base href="/docs/"><script>var x;</script>'
+                                    '<h1>Head</h1>text <a href="b.html">link</a><footer>skip</footer>',
+                                    'http://Example.com/start.html')
+    assert (title, text) == ('A page', 'Head\n\ntext link')
+    assert links == ['http://Example.com/docs/b.html']
+    assert normalize_url('HTTP://Example.COM#intro') == 'http://example.com/'
+    assert normalize_url('ftp://example.com/file') is None
+
+
+def test_save_page(tmp_path, site):
+    pages, _ = crawled(site, max_depth=0)
+    path = save_page(pages['index.html'], str(tmp_path))
+    assert path.endswith(page_filename(site + 'index.html'))
+    with open(path, encoding='utf-8') as f:
+        assert f.read().startswith(f'Home\n\n{site}index.html\n\nWelcome')
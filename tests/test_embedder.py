@@ -0,0 +1,136 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pytest
+from tenacity import wait_none
+
+from utils import embedder
+from utils.cache import EmbeddingCache
+from utils.embedder import BatchEmbedder, RateLimiter, make_batches
+
+
+def fake_embedding(text):
+    return [float(len(text)), float(sum(map(ord, text)) % 97), 1.0]
+
+
+class FakeOpenAI(ThreadingHTTPServer):
+    """
+    Serves POST /v1/embeddings like the OpenAI API; the first `failures` requests get a 500.
+    """
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), FakeOpenAIHandler)
+        self.batches = []
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    @property
+    def api_base(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/v1'
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.server.lock:
+            failing = self.server.failures > 0
+            self.server.failures -= failing
+            if not failing:
+                self.server.batches.append(request['input'])
+        if failing:
+            self._reply(500, {'error': {'message': 'The server had an error', 'type': 'server_error'}})
+            return
+        # Out of order, as the API does not promise any
+        data = [{'object': 'embedding', 'index': i, 'embedding': fake_embedding(text)}
+                for i, text in reversed(list(enumerate(request['input'])))]
+        self._reply(200, {'object': 'list', 'data': data, 'model': request['model']})
+
+
+@pytest.fixture
+def api():
+    server = FakeOpenAI()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def fast(monkeypatch):
+    # One token per word, without loading the tokenizer, and retries without waiting
+    monkeypatch.setattr(embedder, 'count_tokens', lambda text: len(text.split()))
+    monkeypatch.setattr(BatchEmbedder._request.retry, 'wait', wait_none())
+
+
+def make(api, **params):
+    return BatchEmbedder(api_base=api.api_base, api_key='test', **params)
+
+
+TEXTS = [f'passage {i} ' + 'word ' * (i % 7) for i in range(40)]
+
+
+def test_make_batches():
+    assert make_batches([3, 3, 3, 10, 1], max_tokens=6, max_size=10) == [(0, 2), (2, 3), (3, 4), (4, 5)]
+    assert make_batches([1] * 5, max_tokens=100, max_size=2) == [(0, 2), (2, 4), (4, 5)]
+    assert make_batches([]) == []
+
+
+def test_embeds_in_order_with_bounded_batches(api):
+    progress = []
+    vectors = make(api, max_batch_tokens=20, max_batch_size=5, max_workers=4).embed(
+        TEXTS, progress=lambda done, total: progress.append((done, total)))
+
+    assert vectors.dtype == np.float32
+    assert vectors.tolist() == [fake_embedding(text) for text in TEXTS]
+    assert sorted(text for batch in api.batches for text in batch) == sorted(TEXTS)
+    assert all(len(batch) <= 5 for batch in api.batches)
+    assert all(sum(len(text.split()) for text in batch) <= 20 or len(batch) == 1 for batch in api.batches)
+    assert progress[-1] == (len(TEXTS), len(TEXTS))
+    assert [done for done, _ in progress] == sorted(done for done, _ in progress)
+
+
+def test_failed_requests_are_retried(api):
+    api.failures = 3
+    vectors = make(api, max_batch_size=10, max_workers=2).embed(TEXTS)
+    assert vectors.tolist() == [fake_embedding(text) for text in TEXTS]
+    assert len(api.batches) == 4
+    assert api.failures == 0
+
+
+def test_cached_texts_are_not_sent(api, tmp_path):
+    cache = EmbeddingCache(str(tmp_path / 'embeddings.sqlite'))
+    make(api, cache=cache).embed(TEXTS[:10])
+    api.batches.clear()
+
+    vectors = make(api, cache=cache).embed(TEXTS[:20])
+    assert vectors.tolist() == [fake_embedding(text) for text in TEXTS[:20]]
+    assert sorted(text for batch in api.batches for text in batch) == sorted(TEXTS[10:20])
+
+
+def test_rate_limiter_waits_for_the_window():
+    limiter = RateLimiter(requests_per_minute=2, tokens_per_minute=100, window=0.2)
+    start = time.monotonic()
+    limiter.acquire(10)
+    limiter.acquire(10)
+    assert time.monotonic() - start < 0.1
+    limiter.acquire(10)
+    assert time.monotonic() - start >= 0.2
+
+    start = time.monotonic()
+    limiter.acquire(95)
+    assert time.monotonic() - start >= 0.2
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from utils.index import index_nbytes, load_index, update_index
+from utils.store import SegmentStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    n_rows = 2000
+    # Not unit length, like vectors of other embedding models
+    vectors = 3 * np.random.default_rng(0).standard_normal((n_rows, 32)).astype('float32')
+    chunks = pd.DataFrame({'Filename': [f'doc{i // 10}_{i}.txt' for i in range(n_rows)],
+                           'Content': [f'passage {i}' for i in range(n_rows)]})
+    store = SegmentStore(str(tmp_path))
+    store.append(chunks, vectors)
+    return store
+
+
+@pytest.mark.parametrize('kind', ['fp16', 'int8', 'pq'])
+def test_compressed_index_keeps_vectors_memory_mapped(store, kind):
+    vectors, _, live, _ = store.load()
+    update_index(store.user_dir, vectors, store.generation, kind)
+    vectors, _, live, _ = store.load()
+    index = load_index(store.user_dir, vectors, None, store.generation, live)
+
+    assert isinstance(index.vectors, np.memmap)
+    assert index_nbytes(index) == index.codes_nbytes <= vectors.nbytes / 2
+    _, rows = index.search(vectors[:5], 1)
+    assert rows[:, 0].tolist() == list(range(5))
+
+
+def test_exact_index_counts_its_vectors(store):
+    vectors, _, live, _ = store.load()
+    update_index(store.user_dir, vectors, store.generation, 'exact')
+    index = load_index(store.user_dir, vectors, None, store.generation, live)
+    assert index_nbytes(index) >= vectors.nbytes
+
+
+def test_hnsw_recall_and_concurrent_searches():
+    from concurrent.futures import ThreadPoolExecutor
+
+    from utils.ai import normalize_rows
+    from utils.index import HNSWIndex, recall_at_k
+
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((16, 32))
+    data = normalize_rows((centers[rng.integers(0, 16, 1500)] + 0.7 * rng.standard_normal((1500, 32)))
+                          .astype('float32'))
+    queries = data[rng.choice(1500, 40)] + 0.1 * rng.standard_normal((40, 32)).astype('float32')
+    index = HNSWIndex(data, m=8, ef_construction=64)
+    assert recall_at_k(index, queries, 10) >= 0.95
+
+    # Searches of different threads keep their own visit marks
+    expected = index.search(queries, 10)[1]
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        found = list(executor.map(lambda query: index.search(query, 10)[1][0], queries))
+    assert np.array_equal(np.array(found), expected)
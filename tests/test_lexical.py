@@ -0,0 +1,63 @@
+import numpy as np
+
+from utils.lexical import BM25Index, reciprocal_rank_fusion, tokenize
+
+TEXTS = ['apples grow in the orchard',
+         'the orchard is behind the farm, the farm is old',
+         'error AB-1234 means the disk is full',
+         'rivers flow to the sea']
+
+
+def test_tokenize_keeps_identifiers_whole_and_split():
+    assert tokenize('Error AB-1234 in v2.1') == ['error', 'ab-1234', 'ab', '1234', 'in', 'v2.1', 'v2', '1']
+
+
+def test_scores_match_okapi_bm25():
+    index = BM25Index(TEXTS)
+    lengths = np.array([len(tokenize(text)) for text in TEXTS])
+    # "orchard" is in 2 of the 4 passages, once each
+    idf = np.log(1 + (4 - 2 + 0.5) / (2 + 0.5))
+    norms = 1.2 * (1 - 0.75 + 0.75 * lengths / lengths.mean())
+    expected = [idf * 2.2 / (1 + norms[0]), idf * 2.2 / (1 + norms[1]), 0, 0]
+    np.testing.assert_allclose(index.scores('Orchard?'), expected, rtol=1e-5)
+
+
+def test_search_ranks_rarer_and_more_frequent_terms_higher():
+    index = BM25Index(TEXTS)
+    scores, rows = index.search('farm orchard', k=3)
+    # Only passages sharing a term are returned; -1 pads the rest
+    assert rows[0].tolist() == [1, 0, -1]
+    assert scores[0][0] > scores[0][1] > 0
+
+
+def test_search_finds_identifiers_by_their_parts():
+    index = BM25Index(TEXTS)
+    assert index.search(['ab-1234', '1234'], k=1)[1].tolist() == [[2], [2]]
+
+
+def test_search_skips_rows_not_allowed_or_deleted():
+    index = BM25Index(TEXTS)
+    allowed = np.array([True, False, True, True])
+    assert index.search('orchard', k=2, allowed=allowed)[1][0].tolist() == [0, -1]
+    index.set_live(np.array([False, True, True, True]))
+    assert index.search('orchard', k=2)[1][0].tolist() == [1, -1]
+
+
+def test_added_passages_score_as_if_indexed_at_once(tmp_path):
+    index = BM25Index(TEXTS[:2])
+    index.save(str(tmp_path))
+    index = BM25Index.load(str(tmp_path), {'k1': 1.2, 'b': 0.75, 'terms': index.terms})
+    index.add(TEXTS[2:])
+    np.testing.assert_allclose(index.scores('the farm disk sea'), BM25Index(TEXTS).scores('the farm disk sea'))
+
+
+def test_reciprocal_rank_fusion():
+    scores, rows = reciprocal_rank_fusion([np.array([3, 1, -1]), np.array([1, 7, 3])], k=60)
+    # Row 1 is second and first, row 3 first and third, row 7 second only
+    assert rows.tolist() == [1, 3, 7]
+    np.testing.assert_allclose(scores, [1 / 62 + 1 / 61, 1 / 61 + 1 / 63, 1 / 62], rtol=1e-6)
+
+
+def test_reciprocal_rank_fusion_of_padding_only():
+    scores, rows = reciprocal_rank_fusion([np.array([-1, -1]), np.array([-1])])
+    assert scores.size == rows.size == 0
@@ -0,0 +1,32 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+
+from utils.qa import mmr_order, mmr_rerank
+
+# Rows 0 and 1 are the same passage, row 2 is about something else
+VECTORS = np.array([[1.0, 0.0], [1.0, 0.0], [0.6, 0.8]], dtype='float32')
+SIMILARITY = VECTORS @ VECTORS.T
+
+
+def test_lambda_one_keeps_the_ranking():
+    assert mmr_order(np.array([0.2, 1.0, 0.5]), SIMILARITY, 3, 1.0) == [1, 2, 0]
+
+
+def test_duplicates_go_behind_different_passages():
+    assert mmr_order(np.array([1.0, 0.95, 0.8]), SIMILARITY, 3, 0.5) == [0, 2, 1]
+
+
+def test_at_most_k_and_at_most_all():
+    assert mmr_order(np.array([1.0, 0.95, 0.8]), SIMILARITY, 2, 0.5) == [0, 2]
+    assert len(mmr_order(np.array([1.0, 0.95, 0.8]), SIMILARITY, 10, 0.5)) == 3
+
+
+def test_rerank_candidates_by_their_vectors():
+    # Unnormalized, as compressed indexes keep them
+    dataset = (SimpleNamespace(vectors=VECTORS * 3),)
+    candidates = pd.DataFrame({'Score': [12.0, 11.5, 10.0]}, index=[0, 1, 2])
+    # Scores scale to relevances 1, 0.75 and 0
+    assert mmr_rerank(dataset, candidates, 2, 0.3).index.to_list() == [0, 2]
+    assert mmr_rerank(dataset, candidates, 3, 1.0).index.to_list() == [0, 1, 2]
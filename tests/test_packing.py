@@ -0,0 +1,61 @@
+import pandas as pd
+import pytest
+
+from utils import qa
+from utils.qa import pack_context
+from utils.store import UNKNOWN_TOKENS
+
+OVERLAP = 'the river bends south past the old mill'
+
+
+@pytest.fixture(autouse=True)
+def count_words(monkeypatch):
+    # One token per word, without loading tiktoken
+    monkeypatch.setattr(qa, 'count_tokens', lambda text: len(text.split()))
+
+
+def candidates(*passages):
+    """
+    Candidates best first from (document, content) pairs, with one token per word.
+    """
+    return pd.DataFrame({'Document': [document for document, _ in passages],
+                         'Content': [content for _, content in passages],
+                         'Tokens': [len(content.split()) for _, content in passages]})
+
+
+def test_near_duplicates_are_skipped():
+    text = 'apples grow in the orchard on the hill behind the farm house'
+    found, texts = pack_context(candidates(('a.txt', text), ('b.txt', text + ' today'),
+                                           ('c.txt', 'rivers flow to the sea')), 100)
+    assert found['Document'].to_list() == ['a.txt', 'c.txt']
+    assert texts == [text, 'rivers flow to the sea']
+
+
+def test_overlap_with_a_neighbouring_passage_is_trimmed():
+    first = 'water collects in the valley and ' + OVERLAP
+    second = OVERLAP + ' and reaches the lake by evening'
+    found, texts = pack_context(candidates(('a.txt', first), ('a.txt', second)), 100)
+    assert texts == [first, 'and reaches the lake by evening']
+
+
+def test_overlap_is_kept_across_documents():
+    first = 'water collects in the valley and ' + OVERLAP
+    second = OVERLAP + ' and reaches the lake by evening'
+    _, texts = pack_context(candidates(('a.txt', first), ('b.txt', second)), 100)
+    assert texts == [first, second]
+
+
+def test_passages_that_do_not_fit_are_skipped():
+    found, texts = pack_context(candidates(('a.txt', 'one two three four'),
+                                           ('b.txt', 'five six seven eight nine ten'),
+                                           ('c.txt', 'eleven twelve')), 8, separator_len=1)
+    # 4 + 1 tokens are used, the 6 + 1 of b.txt do not fit, the 2 + 1 of c.txt do
+    assert found['Document'].to_list() == ['a.txt', 'c.txt']
+    assert texts == ['one two three four', 'eleven twelve']
+
+
+def test_unknown_token_counts_are_counted():
+    passages = candidates(('a.txt', 'one two three four five'), ('b.txt', 'six'))
+    passages['Tokens'] = UNKNOWN_TOKENS
+    found, _ = pack_context(passages, 5)
+    assert found['Document'].to_list() == ['a.txt']
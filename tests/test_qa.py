@@ -0,0 +1,102 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from tenacity import wait_none
+
+from utils.qa import complete, split_answer, stream_completion
+
+COMPLETION = ['The', ' sky', ' is', ' blue', '.', '\nRe', 'f:', ' the', ' sky', ' section']
+PARAMS = {'model': 'text-davinci-003', 'temperature': 0.0, 'max_tokens': 50}
+
+
+class FakeCompletions(BaseHTTPRequestHandler):
+    """
+    POST /v1/completions of the OpenAI API, streamed as server-sent events when asked to.
+    Streaming requests fail while the server's `streaming_fails` is set, and the next
+    `blocking_failures` blocking requests fail.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.requests.append(request)
+        if request.get('stream'):
+            failing = self.server.streaming_fails
+        else:
+            failing = self.server.blocking_failures > 0
+            self.server.blocking_failures -= failing
+        if failing:
+            data = json.dumps({'error': {'message': 'Overloaded', 'type': 'server_error'}}).encode()
+            self.send_response(500)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        elif request.get('stream'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.end_headers()
+            for token in COMPLETION:
+                event = {'object': 'text_completion', 'choices': [{'index': 0, 'text': token}]}
+                self.wfile.write(f'data: {json.dumps(event)}\n\n'.encode())
+                self.wfile.flush()
+            self.wfile.write(b'data: [DONE]\n\n')
+        else:
+            data = json.dumps({'object': 'text_completion',
+                               'choices': [{'index': 0, 'text': ''.join(COMPLETION)}]}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+
+@pytest.fixture
+def api():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeCompletions)
+    server.requests = []
+    server.streaming_fails = False
+    server.blocking_failures = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def api_params(server):
+    return {'api_base': f'http://127.0.0.1:{server.server_address[1]}/v1', 'api_key': 'test'}
+
+
+def test_stream_completion_yields_growing_text(api):
+    texts = list(stream_completion('Q: colour of the sky?', PARAMS, **api_params(api)))
+    assert texts == [''.join(COMPLETION[:n]) for n in range(1, len(COMPLETION) + 1)]
+    assert [request.get('stream') for request in api.requests] == [True]
+
+
+def test_stream_completion_falls_back_to_a_blocking_request(api):
+    api.streaming_fails = True
+    texts = list(stream_completion('Q: colour of the sky?', PARAMS, **api_params(api)))
+    assert texts == [''.join(COMPLETION)]
+    assert [bool(request.get('stream')) for request in api.requests] == [True, False]
+
+
+def test_stream_completion_fallback_is_retried(api, monkeypatch):
+    monkeypatch.setattr(complete.retry, 'wait', wait_none())
+    api.streaming_fails = True
+    api.blocking_failures = 2
+    texts = list(stream_completion('Q: colour of the sky?', PARAMS, **api_params(api)))
+    assert texts == [''.join(COMPLETION)]
+    assert [bool(request.get('stream')) for request in api.requests] == [True, False, False, False]
+
+
+def test_split_answer_while_streaming():
+    # A partial marker is held back until it is known not to be one
+    assert split_answer('The sky is blue.\nRe', final=False) == ('The sky is blue.', None)
+    assert split_answer('The sky is blue.\nRe', final=True) == ('The sky is blue.\nRe', None)
+    assert split_answer(''.join(COMPLETION)) == ('The sky is blue.', 'the sky section')
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from utils import service
+from utils.cache import AnswerCache
+from utils.service import SECRET_HEADER, is_loopback, make_app
+
+CHUNKS = [{'Filename': 'apples_0.txt', 'Content': 'apples grow on trees in the orchard', 'Tokens': 7},
+          {'Filename': 'apples_1.txt', 'Content': 'the orchard is harvested in autumn', 'Tokens': 6},
+          {'Filename': 'rivers_0.txt', 'Content': 'rivers flow down to the sea', 'Tokens': 6}]
+EMBEDDINGS = [[1.0, 0.0, 0.0], [0.8, 0.6, 0.0], [0.0, 0.0, 1.0]]
+
+
+@pytest.fixture(autouse=True)
+def workdir(tmp_path, monkeypatch):
+    # User directories are resolved against the working directory
+    monkeypatch.chdir(tmp_path)
+    answer_cache = AnswerCache(str(tmp_path / 'answers.sqlite'))
+    monkeypatch.setattr(service, 'get_answer_cache', lambda: answer_cache)
+
+
+def run(test, secret=None):
+    async def main():
+        async with TestClient(TestServer(make_app(workers=2, secret=secret))) as client:
+            await test(client)
+
+    asyncio.run(main())
+
+
+def search(question, **params):
+    return {'user': 'alice', 'question': question, 'mode': 'lexical', 'mmr_lambda': None} | params
+
+
+def test_send_search_and_clear():
+    async def test(client):
+        response = await client.post('/doc/send_chunks', json={'user': 'alice', 'chunks': CHUNKS,
+                                                                'embeddings': EMBEDDINGS})
+        assert response.status == 200
+        assert (await response.json())['n_chunks'] == 3
+
+        response = await client.post('/doc/get_related_contents', json=search('where do rivers flow'))
+        assert response.status == 200
+        found = await response.json()
+        assert found['documents'][0] == 'rivers'
+        assert found['contents'][0] == CHUNKS[2]['Content']
+
+        response = await client.post('/doc/get_related_contents',
+                                     json=search('orchard', mode='vector', embedding=[1.0, 0.0, 0.0], pool=1))
+        assert (await response.json())['contents'] == [CHUNKS[0]['Content']]
+        response = await client.post('/doc/get_related_contents',
+                                     json=search('orchard', mode='vector', embedding=[1.0, 0.0]))
+        assert response.status == 400
+
+        response = await client.post('/doc/clear', json={'user': 'alice'})
+        assert response.status == 200
+        response = await client.post('/doc/get_related_contents', json=search('orchard'))
+        assert response.status == 404
+
+    run(test)
+
+
+@pytest.mark.parametrize('params', [{'pool': -5}, {'pool': 0}, {'pool': 2.5}, {'pool': '10'}, {'pool': True},
+                                    {'mmr_k': -1}, {'max_tokens': -1}, {'separator_len': None},
+                                    {'mode': 'fuzzy'}, {'mmr_lambda': 2}, {'documents': 'apples'},
+                                    {'question': ''}, {'user': '../bob'}, {'embedding': 'apples'},
+                                    {'embedding': []}, {'embedding': [[1.0, 0.0, 0.0]]}, {'embedding': [1.0, None]}])
+def test_invalid_parameters(params):
+    async def test(client):
+        response = await client.post('/doc/get_related_contents', json=search('orchard') | params)
+        assert response.status == 400
+
+    run(test)
+
+
+def test_secret_is_required_when_set():
+    async def test(client):
+        response = await client.get('/metrics')
+        assert response.status == 401
+        response = await client.get('/metrics', headers={SECRET_HEADER: 'wrong'})
+        assert response.status == 401
+        response = await client.get('/metrics', headers={SECRET_HEADER: 's3cret'}, params={'format': 'json'})
+        assert response.status == 200
+
+    run(test, secret='s3cret')
+
+
+def test_is_loopback():
+    assert is_loopback('127.0.0.1') and is_loopback('localhost') and is_loopback('::1')
+    assert not is_loopback('0.0.0.0') and not is_loopback('10.0.0.5') and not is_loopback('example.com')
@@ -0,0 +1,91 @@
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from utils.store import SegmentStore
+
+
+def _chunks(document, n_chunks=2):
+    return pd.DataFrame({'Filename': [f'{document}_{i}.txt' for i in range(n_chunks)],
+                         'Content': [f'{document} passage {i}' for i in range(n_chunks)]})
+
+
+def _append_documents(user_dir, prefix, n_documents):
+    store = SegmentStore(user_dir)
+    for i in range(n_documents):
+        store.append(_chunks(f'{prefix}{i}'), np.ones((2, 4), dtype='float32'))
+
+
+def test_appends_from_several_processes(tmp_path):
+    user_dir = str(tmp_path)
+    processes = [multiprocessing.Process(target=_append_documents, args=(user_dir, prefix, 15))
+                 for prefix in ('a', 'b', 'c')]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+
+    store = SegmentStore(user_dir)
+    assert len(store.documents()) == 45
+    vectors, meta, live, texts = store.load()
+    assert len(vectors) == len(meta) == len(texts) == 90
+    assert meta['chunk_id'].is_unique
+
+
+def test_compaction_keeps_concurrent_appends(tmp_path):
+    user_dir = str(tmp_path)
+    _append_documents(user_dir, 'a', 10)
+    store = SegmentStore(user_dir)
+    store.delete_documents(['a0'])
+    writer = multiprocessing.Process(target=_append_documents, args=(user_dir, 'b', 10))
+    writer.start()
+    store.compact()
+    writer.join()
+    assert writer.exitcode == 0
+
+    _, meta, live, texts = store.load()
+    assert set(meta['Document'][live]) == {f'a{i}' for i in range(1, 10)} | {f'b{i}' for i in range(10)}
+    assert texts[int(np.flatnonzero(live)[-1])].startswith('b9')
+
+
+def test_clear_after_migrate(tmp_path):
+    from utils.corpus import clear_corpus
+    from utils.store import LEGACY_FILE, open_store
+
+    legacy = pd.DataFrame({'Filename': ['a_0.txt', 'a_1.txt', 'b_0.txt'], 'Content': ['one', 'two', 'three'],
+                           'Embedding': ['[1.0, 0.0]', '[0.0, 1.0]', '[0.6, 0.8]']})
+    legacy.to_csv(tmp_path / LEGACY_FILE, index=False)
+    assert open_store(str(tmp_path)).documents() == {'a': 2, 'b': 1}
+    assert not (tmp_path / LEGACY_FILE).exists()
+    assert (tmp_path / (LEGACY_FILE + '.migrated')).exists()
+
+    clear_corpus(str(tmp_path))
+    store = open_store(str(tmp_path))
+    assert not store.exists() and store.documents() == {}
+
+
+def test_load_while_compacting(tmp_path):
+    import threading
+
+    user_dir = str(tmp_path)
+    _append_documents(user_dir, 'a', 4)
+    store = SegmentStore(user_dir)
+    stop = threading.Event()
+
+    def compact_repeatedly():
+        for i in range(40):
+            store.append(_chunks(f'b{i}'), np.ones((2, 4), dtype='float32'))
+            store.compact()
+        stop.set()
+
+    compactor = threading.Thread(target=compact_repeatedly)
+    compactor.start()
+    loads = 0
+    while not stop.is_set():
+        vectors, meta, live, texts = SegmentStore(user_dir).load()
+        assert len(vectors) == len(meta) == len(texts)
+        loads += 1
+    compactor.join()
+    assert loads > 0
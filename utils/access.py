@@ -0,0 +1,90 @@
+"""
+Access control over a corpus shared by all users (see config.Sharing).
+
+Every chunk of the shared corpus records its Owner, the user who uploaded it, and its
+Group, the group it was shared with ('' for a private document). A user reads their own
+chunks and those of their groups. Documents are named "<owner>/<file>" or "@<group>/<file>",
+so equally named files of different users or groups do not replace each other.
+
+Queries are restricted to the readable chunks by a boolean row mask handed to the vector
+and BM25 searches, so the top k are only ever chosen among them. The mask is computed from
+the integer codes of the categorical Owner and Group columns, not by comparing strings.
+"""
+import numpy as np
+
+from utils.config import Sharing
+
+GROUP_PREFIX = '@'
+
+
+def user_groups(username):
+    return sorted(group for group, members in Sharing.GROUPS.items() if username in members)
+
+
+def shared_document(document, owner, group=''):
+    """
+    The name of a document in the shared corpus.
+    """
+    return f'{GROUP_PREFIX}{group}/{document}' if group else f'{owner}/{document}'
+
+
+def split_document(document):
+    """
+    (scope, file name) of a shared document name; the scope is '' for a per-user corpus.
+    """
+    scope, sep, name = document.partition('/')
+    return (scope, name) if sep else ('', document)
+
+
+def can_read(document, username, groups=None):
+    """
+    Whether a document of the shared corpus is readable by a user, from its name alone.
+    """
+    groups = user_groups(username) if groups is None else groups
+    scope, _ = split_document(document)
+    return scope == username or (scope.startswith(GROUP_PREFIX) and scope[len(GROUP_PREFIX):] in groups)
+
+
+def can_modify(document, username, owners):
+    """
+    Whether a user may remove or replace a document of the shared corpus: only the user
+    who uploaded it may, also when it is shared with a group. `owners` are the Owner
+    values of the document's chunks.
+    """
+    scope, _ = split_document(document)
+    return scope == username or (scope.startswith(GROUP_PREFIX) and set(owners) == {username})
+
+
+def private_documents(documents, username):
+    """
+    The documents of the shared corpus that only `username` can read.
+    """
+    return [document for document in documents if split_document(document)[0] == username]
+
+
+def _codes(column, values):
+    """
+    Integer codes of `values` in a categorical column; values not in it are left out.
+    """
+    codes = column.cat.categories.get_indexer(list(values))
+    return codes[codes >= 0]
+
+
+def access_mask(meta, username, groups=None, documents=None):
+    """
+    Boolean mask of the rows of the corpus metadata readable by `username`, optionally
+    restricted to `documents`. Returns None when nothing is filtered out, so the searches
+    skip the mask.
+    """
+    if not Sharing.ENABLED and documents is None:
+        return None
+    mask = np.ones(len(meta), dtype=bool)
+    if Sharing.ENABLED:
+        groups = user_groups(username) if groups is None else groups
+        mask = np.isin(meta['Owner'].cat.codes.to_numpy(), _codes(meta['Owner'], [username]))
+        group_codes = _codes(meta['Group'], [group for group in groups if group])
+        if group_codes.size:
+            mask |= np.isin(meta['Group'].cat.codes.to_numpy(), group_codes)
+    if documents is not None:
+        mask &= meta['Document'].isin(list(documents)).to_numpy()
+    return mask
@@ -1,15 +1,55 @@
 import numpy as np
-import openai
 from numpy import ndarray
 from tenacity import retry, wait_random_exponential, stop_after_attempt
-from scipy.spatial.distance import cosine
 
+from utils.cache import embedding_key, get_embedding_cache
+from utils.tracing import span, traced
 
+
+@traced('get_embedding')
 @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
 def get_embedding(text: str, model="text-embedding-ada-002") -> list[float]:
+    # openai and scipy are imported on first use, they add most of a second to every cold start
+    import openai
+
     return openai.Embedding.create(input=[text], model=model)["data"][0]["embedding"]
 
 
+def get_embedding_cached(text: str, model="text-embedding-ada-002") -> ndarray:
+    """
+    Same as get_embedding, but served from the shared embedding cache when the text was seen before.
+    """
+    cache = get_embedding_cache()
+    key = embedding_key(text, model)
+    vector = cache.get(key)
+    if vector is None:
+        vector = np.array(get_embedding(text, model), dtype='float32')
+        cache.put(key, vector)
+    return vector
+
+
+def try_get_embedding(text: str, model="text-embedding-ada-002", timeout: float = 10):
+    """
+    Same as get_embedding_cached, but makes a single request of at most `timeout` seconds
+    and returns None when the API is slow or down, so callers can fall back to keyword search.
+    """
+    import openai
+
+    cache = get_embedding_cache()
+    key = embedding_key(text, model)
+    vector = cache.get(key)
+    if vector is None:
+        try:
+            with span('get_embedding'):
+                response = openai.Embedding.create(input=[text], model=model, request_timeout=timeout)
+        except openai.error.OpenAIError as e:
+            print('Question embedding failed, falling back to keyword search:', e)
+            return None
+        vector = np.array(response["data"][0]["embedding"], dtype='float32')
+        cache.put(key, vector)
+    return vector
+
+
 def vector_similarity(x: list[float], y: list[float]) -> ndarray:
     """
     Returns the similarity between two vectors.
@@ -20,9 +60,90 @@ def vector_similarity(x: list[float], y: list[float]) -> ndarray:
 
 
 def vector_similarity_2(x: list[float], y: list[float]) -> float:
+    from scipy.spatial.distance import cosine
+
     return 1 - cosine(x, y)
 
 
+def normalize_rows(matrix: ndarray) -> ndarray:
+    """
+    Returns the rows scaled to unit length, so that dot products are cosine similarities.
+
+    Matrices whose rows are already unit length (e.g. OpenAI embeddings) are returned as is,
+    which keeps memory-mapped matrices zero-copy and memory-mapped.
+    """
+    matrix = np.asanyarray(matrix, dtype='float32')
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    if np.allclose(norms, 1.0, atol=1e-3):
+        return matrix
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def top_k_from_scores(scores: ndarray, k: int) -> tuple[ndarray, ndarray]:
+    """
+    Returns the k best (scores, indexes) of every row of a score matrix, best first.
+    """
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        empty = np.empty((scores.shape[0], 0))
+        return empty.astype(scores.dtype), empty.astype('int64')
+    if k < scores.shape[1]:
+        indexes = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    else:
+        indexes = np.broadcast_to(np.arange(k), (scores.shape[0], k))
+    top_scores = np.take_along_axis(scores, indexes, axis=1)
+    order = np.argsort(-top_scores, axis=1, kind='stable')
+    return np.take_along_axis(top_scores, order, axis=1), np.take_along_axis(indexes, order, axis=1)
+
+
+class Retriever:
+    """
+    Exact top-k retrieval over a corpus held as one normalized float32 matrix.
+
+    Queries are scored with a single matrix product per block of queries, and the
+    best k are selected with argpartition instead of a full sort.
+    """
+
+    # Upper bound on the number of scores materialised at once
+    MAX_BLOCK_SCORES = 1 << 24
+
+    def __init__(self, vectors: ndarray):
+        self.vectors = normalize_rows(vectors)
+        self.dead = None
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def set_live(self, live):
+        """
+        Excludes the rows where the boolean mask `live` is False (e.g. deleted passages) from results.
+        Excluded rows never make it into the top k; if fewer than k rows are live the rest score -inf.
+        """
+        self.dead = None if live is None or live.all() else np.flatnonzero(~live)
+
+    def search(self, queries, k: int = 3, allowed: ndarray = None) -> tuple[ndarray, ndarray]:
+        """
+        Returns (scores, indexes) arrays of shape (n_queries, k) for one query or a batch of them.
+        With the boolean mask `allowed`, only the rows where it is True are searched.
+        """
+        queries = normalize_rows(np.atleast_2d(np.asarray(queries, dtype='float32')))
+        block = max(1, self.MAX_BLOCK_SCORES // max(1, len(self)))
+        all_scores, all_indexes = [], []
+        for start in range(0, queries.shape[0], block):
+            scores = queries[start:start + block] @ self.vectors.T
+            if self.dead is not None:
+                scores[:, self.dead] = -np.inf
+            if allowed is not None:
+                scores[:, ~allowed] = -np.inf
+            top_scores, top_indexes = top_k_from_scores(scores, k)
+            all_scores.append(top_scores)
+            all_indexes.append(top_indexes)
+        if not all_scores:
+            return top_k_from_scores(np.empty((0, len(self)), dtype='float32'), k)
+        return np.vstack(all_scores), np.vstack(all_indexes)
+
+
 if __name__ == '__main__':
     import ast
     import time
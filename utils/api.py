@@ -1,5 +1,64 @@
-import streamlit as st
+from utils.config import Retrieval, Urls, Service
 
 
-def send_question_to_api():
-    print(st.session_state.question)
+def _headers():
+    # The secret header name is defined in utils/service.py, which is not imported by the pages
+    return {'X-Service-Secret': Service.SECRET} if Service.SECRET else {}
+
+
+def _post(url, payload):
+    import requests
+
+    response = requests.post(url, json=payload, headers=_headers(), timeout=Service.TIMEOUT)
+    if response.status_code == 404:
+        raise FileNotFoundError(response.text)
+    response.raise_for_status()
+    return response.json()
+
+
+def send_chunks(user, chunks, embeddings=None, group=''):
+    """
+    Adds chunks (dicts with Filename and Content, optionally Document and Tokens) to the
+    user's store; the service embeds them unless `embeddings` are given. In a shared
+    corpus, the chunks are shared with `group`.
+    """
+    payload = {'user': user, 'chunks': chunks}
+    if embeddings is not None:
+        payload['embeddings'] = [list(map(float, vector)) for vector in embeddings]
+    if group:
+        payload['group'] = group
+    return _post(Urls.CHK_URL, payload)
+
+
+def clear(user):
+    return _post(Urls.CLR_URL, {'user': user})
+
+
+def get_metrics():
+    """
+    Span histograms of the service (see Tracer.snapshot).
+    """
+    import requests
+
+    response = requests.get(Urls.MET_URL, params={'format': 'json'}, headers=_headers(), timeout=Service.TIMEOUT)
+    response.raise_for_status()
+    return response.json()
+
+
+def get_related_contents(user, question, embedding=None, pool=50, max_tokens=1000, separator_len=0,
+                         mode=None, mmr_lambda=Retrieval.MMR_LAMBDA, mmr_k=Retrieval.MMR_K, documents=None):
+    """
+    Returns {version, scores, contents, texts, documents} of the passages packed into the
+    prompt context for `question`, searching only `documents` if given. An `mmr_lambda`
+    of None turns the diversity reranking off. Raises FileNotFoundError when the user has
+    no documents and requests.ConnectionError when the service is down.
+    """
+    payload = {'user': user, 'question': question, 'pool': pool, 'max_tokens': max_tokens,
+               'separator_len': separator_len, 'mmr_lambda': mmr_lambda, 'mmr_k': mmr_k}
+    if embedding is not None:
+        payload['embedding'] = [float(x) for x in embedding]
+    if mode is not None:
+        payload['mode'] = mode
+    if documents is not None:
+        payload['documents'] = list(documents)
+    return _post(Urls.RTD_URL, payload)
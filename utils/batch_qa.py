@@ -0,0 +1,154 @@
+"""
+Headless batch question answering over a user's corpus, for offline evaluation runs.
+
+    python -m utils.batch_qa --user alice questions.txt --out answers.jsonl [--workers 8]
+
+Questions are read one per line from a text file, or from a JSONL file of objects with a
+"question" and an optional "id". They are answered the way the query page answers them,
+with the same retrieval settings and prompt, but in bulk:
+
+- all questions are embedded with the BatchEmbedder (batched, concurrent requests),
+- the vector index is searched for all of them at once (one matrix product),
+- completions run concurrently in a bounded thread pool.
+
+The answer and semantic caches are bypassed, so every run asks the model. Every answer
+is written as one JSON line, in the order of the questions, with its reference, the
+passages it was given and the latency of every stage in ms. Embedding and retrieval are
+done for a whole batch; their latency is the batch's duration divided by its size.
+"""
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.access import access_mask
+from utils.config import Answering, Retrieval, corpus_dir
+from utils.corpus import load_corpus
+from utils.embedder import count_tokens, make_embedder
+from utils.qa import SEPARATOR, complete, construct_prompt, find_related_contents_batch, split_answer
+
+
+def read_questions(path):
+    """
+    Returns [(id, question)] from a text file (one question per line) or a .jsonl file.
+    """
+    questions = []
+    with open(path, encoding='utf-8') as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            if path.endswith('.jsonl'):
+                record = json.loads(line)
+                questions.append((record.get('id', line_no), record['question']))
+            else:
+                questions.append((line_no, line))
+    return questions
+
+
+def _refs(found):
+    return [{'document': document, 'score': float(score), 'content': content}
+            for document, score, content in zip(found['Document'], found['Score'], found['Content'])]
+
+
+def answer_questions(dataset, questions, embedder=None, workers=8, batch_size=64, mode=Retrieval.MODE,
+                     params=Answering.COMPLETIONS_API_PARAMS, pool=Answering.CANDIDATE_POOL,
+                     max_tokens=Answering.MAX_SECTION_LEN, mmr_lambda=Retrieval.MMR_LAMBDA,
+                     mmr_k=Retrieval.MMR_K, allowed=None, **api_params):
+    """
+    Yields one result dict per (id, question), in order, as soon as it and the ones before
+    it are answered. Questions are embedded and retrieved for `batch_size` at a time, while
+    the completions of earlier batches are still running on `workers` threads. `allowed`
+    restricts retrieval to some rows of the corpus (see access.access_mask).
+    """
+    separator_len = count_tokens(SEPARATOR)
+    if mode != 'lexical' and embedder is None:
+        embedder = make_embedder()
+
+    def answer(prompt, result):
+        start = time.perf_counter()
+        try:
+            result['answer'], result['reference'] = split_answer(complete(prompt, params, **api_params))
+        except Exception as e:
+            result['error'] = f'{type(e).__name__}: {e}'
+        result['latency_ms']['completion'] = 1000 * (time.perf_counter() - start)
+        result['latency_ms']['total'] = sum(result['latency_ms'].values())
+        return result
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = []
+        for batch_start in range(0, len(questions), batch_size):
+            batch = questions[batch_start:batch_start + batch_size]
+            texts = [question for _, question in batch]
+
+            start = time.perf_counter()
+            vectors = embedder.embed(texts) if mode != 'lexical' else None
+            t_embed = (time.perf_counter() - start) / len(batch)
+
+            start = time.perf_counter()
+            related = find_related_contents_batch(dataset, texts, vectors, pool, max_tokens, separator_len,
+                                                  mode, Retrieval.RRF_K, mmr_lambda, mmr_k, allowed)
+            t_retrieve = (time.perf_counter() - start) / len(batch)
+
+            for (question_id, question), found in zip(batch, related):
+                start = time.perf_counter()
+                prompt = construct_prompt(question, found['Text'].to_list())
+                result = {'id': question_id, 'question': question, 'answer': None, 'reference': None,
+                          'refs': _refs(found), 'mode': mode,
+                          'latency_ms': {'embed': 1000 * t_embed, 'retrieve': 1000 * t_retrieve,
+                                         'prompt': 1000 * (time.perf_counter() - start)}}
+                pending.append(executor.submit(answer, prompt, result))
+
+            # Hand back what is done, so results stream out while later batches are prepared
+            while pending and pending[0].done():
+                yield pending.pop(0).result()
+        for future in pending:
+            yield future.result()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    import openai
+
+    from utils.benchmark import percentiles
+
+    parser = argparse.ArgumentParser(description="Answer a file of questions over a user's documents")
+    parser.add_argument('questions', help='Text file with one question per line, or JSONL with "question" fields')
+    parser.add_argument('--user', required=True)
+    parser.add_argument('--out', default='answers.jsonl')
+    parser.add_argument('--workers', type=int, default=8, help='Completions requested at once')
+    parser.add_argument('--batch-size', type=int, default=64, help='Questions embedded and retrieved at once')
+    parser.add_argument('--mode', default=Retrieval.MODE, choices=('hybrid', 'vector', 'lexical'))
+    parser.add_argument('--mmr-lambda', type=float, default=Retrieval.MMR_LAMBDA,
+                        help='Relevance weight of the diversity reranking; 1 ranks by relevance only')
+    parser.add_argument('--no-mmr', action='store_true', help='Pack the context without diversity reranking')
+    parser.add_argument('--api-key-path', default='api.txt')
+    args = parser.parse_args()
+
+    if os.path.exists(args.api_key_path):
+        openai.api_key_path = args.api_key_path
+    questions = read_questions(args.questions)
+    if not questions:
+        parser.error(f'No questions in {args.questions}')
+    start = time.perf_counter()
+    dataset = load_corpus(corpus_dir(args.user), Retrieval.INDEX_PARAMS)
+    print(f'Loaded the corpus of {args.user} in {time.perf_counter() - start:.2f}s')
+
+    start = time.perf_counter()
+    n_errors, completion_seconds = 0, []
+    with open(args.out, 'w', encoding='utf-8') as f:
+        for i, result in enumerate(answer_questions(dataset, questions, workers=args.workers,
+                                                    batch_size=args.batch_size, mode=args.mode,
+                                                    mmr_lambda=None if args.no_mmr else args.mmr_lambda,
+                                                    allowed=access_mask(dataset[1], args.user))):
+            f.write(json.dumps(result) + '\n')
+            f.flush()
+            n_errors += 'error' in result
+            completion_seconds.append(result['latency_ms']['completion'] / 1000)
+            print(f'\r{i + 1}/{len(questions)} answered', end='', flush=True)
+    seconds = time.perf_counter() - start
+    print(f'\nAnswered {len(questions)} questions in {seconds:.1f}s ({len(questions) / seconds:.2f}/s), '
+          f'{n_errors} failed; completion p50/p95 '
+          f"{percentiles(completion_seconds)['p50_ms']:.0f}/{percentiles(completion_seconds)['p95_ms']:.0f} ms. "
+          f'Wrote {args.out}')
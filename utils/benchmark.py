@@ -0,0 +1,212 @@
+"""
+Retrieval and ingestion benchmark on synthetic corpora.
+
+    python -m utils.benchmark --sizes 1000 10000 100000 --out bench.json
+
+For every corpus size, chunks are ingested into a fresh store with a fake embedder, the
+corpus is loaded as the app loads it, and single and batched queries are timed. Results
+are written as JSON, so runs on different versions can be compared.
+
+Every size runs in a process of its own, so the peak resident memory reported for it is
+not carried over from a smaller size run before. A million chunks are left out of the
+default sizes: at 1536 dimensions their vectors alone take 6 GB and building their index
+takes long. Ask for them with `--sizes 1000000` on a machine that has the memory.
+"""
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+from utils.ai import normalize_rows
+from utils.corpus import corpus_nbytes, load_corpus, sync_corpus
+from utils.qa import find_top_k_candidates
+from utils.store import SegmentStore
+
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+
+N_CLUSTERS = 64
+VOCABULARY_SIZE = 5000
+WORDS_PER_CHUNK = 60
+
+
+class FakeEmbedder:
+    """
+    Stands in for BatchEmbedder: returns clustered random unit vectors without any request.
+    """
+
+    def __init__(self, dim=1536, seed=0):
+        self.dim = dim
+        self.rng = np.random.default_rng(seed)
+        self.centers = self.rng.standard_normal((N_CLUSTERS, dim)).astype('float32')
+
+    def embed(self, texts, progress=None):
+        n = len(texts)
+        vectors = self.centers[self.rng.integers(0, N_CLUSTERS, n)]
+        vectors = vectors + 0.5 * self.rng.standard_normal((n, self.dim), dtype='float32')
+        return normalize_rows(vectors)
+
+
+def synthetic_chunks(n, start, rng, docs_every=20):
+    words = np.array([f'w{i}' for i in range(VOCABULARY_SIZE)])
+    # Zipf-like term frequencies, as in natural text
+    weights = 1.0 / np.arange(1, VOCABULARY_SIZE + 1)
+    weights /= weights.sum()
+    contents = [' '.join(rng.choice(words, WORDS_PER_CHUNK, p=weights)) for _ in range(n)]
+    ids = np.arange(start, start + n)
+    return pd.DataFrame({'Document': [f'doc_{i // docs_every}.txt' for i in ids],
+                         'Filename': [f'doc_{i // docs_every}.txt_{i % docs_every}.txt' for i in ids],
+                         'Content': contents,
+                         'Tokens': WORDS_PER_CHUNK})
+
+
+def percentiles(seconds):
+    ms = np.asarray(seconds) * 1000
+    return {'p50_ms': float(np.percentile(ms, 50)), 'p95_ms': float(np.percentile(ms, 95)),
+            'p99_ms': float(np.percentile(ms, 99)), 'mean_ms': float(ms.mean())}
+
+
+def max_rss_bytes():
+    """
+    Peak resident memory of this process so far, None where it is not available.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss if platform.system() == 'Darwin' else rss * 1024
+
+
+def bench_size(work_dir, size, dim, kind, params, n_queries, batch_size, k, batch_chunks, seed):
+    rng = np.random.default_rng(seed)
+    embedder = FakeEmbedder(dim, seed)
+    user_dir = os.path.join(work_dir, f'user_{size}_{kind}')
+    store = SegmentStore(user_dir)
+
+    # Ingest: chunks -> embeddings -> store segments, then the indexes
+    t_embed = t_store = 0.0
+    for start in range(0, size, batch_chunks):
+        chunks = synthetic_chunks(min(batch_chunks, size - start), start, rng)
+        t_start = time.perf_counter()
+        vectors = embedder.embed(chunks['Content'].to_list())
+        t_embed += time.perf_counter() - t_start
+        t_start = time.perf_counter()
+        store.append(chunks, vectors)
+        t_store += time.perf_counter() - t_start
+    t_start = time.perf_counter()
+    if store.needs_compaction():
+        store.compact()
+    t_compact = time.perf_counter() - t_start
+    t_start = time.perf_counter()
+    sync_corpus(store, kind, params)
+    t_index = time.perf_counter() - t_start
+    t_ingest = t_embed + t_store + t_compact + t_index
+
+    # Load as the corpus manager does on a cold start
+    t_start = time.perf_counter()
+    dataset = load_corpus(user_dir, params)
+    t_load = time.perf_counter() - t_start
+    index, meta, lexical, texts = dataset
+
+    # Sorted, so the rows are read from the memory-mapped vectors in order
+    query_rows = np.sort(rng.choice(size, n_queries))
+    queries = normalize_rows(np.asarray(index.vectors[query_rows])
+                             + 0.1 * rng.standard_normal((n_queries, dim), dtype='float32'))
+    questions = [' '.join(texts[row].split()[:8]) for row in query_rows]
+
+    latencies = {}
+    for mode in ('vector', 'lexical', 'hybrid'):
+        seconds = []
+        for question, query in zip(questions, queries):
+            t_start = time.perf_counter()
+            find_top_k_candidates(dataset, question, query, k, mode)
+            seconds.append(time.perf_counter() - t_start)
+        latencies[mode] = percentiles(seconds)
+
+    t_start = time.perf_counter()
+    for start in range(0, n_queries, batch_size):
+        index.search(queries[start:start + batch_size], k)
+    t_batch = time.perf_counter() - t_start
+
+    return {
+        'size': size,
+        'kind': type(index).kind,
+        'ingest': {'seconds': t_ingest, 'chunks_per_sec': size / t_ingest,
+                   'embed_seconds': t_embed, 'store_seconds': t_store,
+                   'compact_seconds': t_compact, 'index_seconds': t_index},
+        'load_seconds': t_load,
+        'query_latency': latencies,
+        'batch_queries_per_sec': n_queries / t_batch,
+        'memory': {'corpus_bytes': corpus_nbytes(dataset), 'max_rss_bytes': max_rss_bytes()},
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from utils.config import Retrieval
+
+    parser = argparse.ArgumentParser(description='Benchmark ingestion and retrieval on synthetic corpora')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--kind', default=Retrieval.INDEX_KIND)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--k', type=int, default=20)
+    parser.add_argument('--batch-chunks', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='bench.json')
+    parser.add_argument('--work-dir', help='Keep the synthetic stores here instead of a temporary directory')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='docinsight_bench_')
+    report = {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': {'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'settings': {key: value for key, value in vars(args).items() if key not in ('out', 'work_dir')},
+        'results': [],
+    }
+    try:
+        for size in args.sizes:
+            with ProcessPoolExecutor(max_workers=1) as executor:
+                result = executor.submit(bench_size, work_dir, size, args.dim, args.kind, Retrieval.INDEX_PARAMS,
+                                         args.queries, args.batch_size, args.k, args.batch_chunks,
+                                         args.seed).result()
+            report['results'].append(result)
+            print(f"{size:>8} chunks ({result['kind']}): ingest {result['ingest']['chunks_per_sec']:.0f} chunks/s, "
+                  f"load {result['load_seconds']:.2f}s, "
+                  f"p50/p99 {result['query_latency']['vector']['p50_ms']:.2f}/"
+                  f"{result['query_latency']['vector']['p99_ms']:.2f} ms vector, "
+                  f"{result['query_latency']['hybrid']['p50_ms']:.2f}/"
+                  f"{result['query_latency']['hybrid']['p99_ms']:.2f} ms hybrid, "
+                  f"{result['batch_queries_per_sec']:.0f} queries/s batched, "
+                  f"{result['memory']['corpus_bytes'] / 2 ** 20:.1f} MB")
+            with open(args.out, 'w') as f:
+                json.dump(report, f, indent=2)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    print(f'Wrote {args.out}')
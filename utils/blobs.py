@@ -0,0 +1,145 @@
+"""
+Compressed chunk texts of the store segments, read on demand.
+
+The texts of a segment are written once, back to back, to a blob file; each one is
+compressed on its own, so any chunk can be read without the others. An offsets array
+(n + 1 int64 values, saved next to it) locates chunk i at blob[offsets[i]:offsets[i + 1]].
+Blobs are memory-mapped: loading a corpus reads no text, and a query only decompresses
+the chunks it returns. Only an index rebuild or a compaction reads them all.
+
+`codec` is 'zlib', 'zstd' (needs the zstandard package) or 'none'.
+"""
+import mmap
+import os
+import sys
+import zlib
+
+import numpy as np
+
+
+CODECS = ('zlib', 'zstd', 'none')
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+
+def _compress(codec):
+    if codec == 'zlib':
+        return lambda data: zlib.compress(data, ZLIB_LEVEL)
+    if codec == 'zstd':
+        import zstandard
+
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress
+    if codec == 'none':
+        return bytes
+    raise ValueError(f'Unknown text codec "{codec}", expected one of {CODECS}')
+
+
+def _decompress(codec):
+    if codec == 'zlib':
+        return zlib.decompress
+    if codec == 'zstd':
+        import zstandard
+
+        # Decompressors are not thread-safe, so every call gets its own
+        return lambda data: zstandard.ZstdDecompressor().decompress(data)
+    if codec == 'none':
+        return bytes
+    raise ValueError(f'Unknown text codec "{codec}", expected one of {CODECS}')
+
+
+def offsets_path(blob_path):
+    return os.path.splitext(blob_path)[0] + '.offsets.npy'
+
+
+def write_blob(path, texts, codec='zlib'):
+    """
+    Writes `texts` (any iterable of strings, consumed once) to a blob file and its offsets.
+    Returns the number of bytes written.
+    """
+    compress = _compress(codec)
+    offsets = [0]
+    with open(path + '.tmp', 'wb') as f:
+        for text in texts:
+            offsets.append(offsets[-1] + f.write(compress(text.encode('utf-8'))))
+    with open(offsets_path(path) + '.tmp', 'wb') as f:
+        np.save(f, np.asarray(offsets, dtype='int64'))
+    # The offsets go last: a blob is only readable once both files are in place
+    os.replace(path + '.tmp', path)
+    os.replace(offsets_path(path) + '.tmp', offsets_path(path))
+    return offsets[-1]
+
+
+class BlobReader:
+    """
+    Random access to the texts of one blob file.
+    """
+
+    def __init__(self, path, codec='zlib'):
+        self.path = path
+        self.codec = codec
+        self._decompress = _decompress(codec)
+        self.offsets = np.load(offsets_path(path))
+        with open(path, 'rb') as f:
+            # An empty file cannot be mapped
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.offsets[-1] else b''
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        start, end = self.offsets[row], self.offsets[row + 1]
+        return self._decompress(self._data[start:end]).decode('utf-8')
+
+    @property
+    def nbytes(self):
+        # The blob itself is paged in by the OS as chunks are read
+        return self.offsets.nbytes
+
+
+class ChunkTexts:
+    """
+    The texts of all rows of a store, in row order, over the texts of its segments: blob
+    readers, or plain lists for segments written before texts were kept in blobs.
+
+    texts[row] is one text; texts[rows] (a slice or an array of rows) a list of them.
+    """
+
+    def __init__(self, parts):
+        self.parts = list(parts)
+        self.starts = np.cumsum([0] + [len(part) for part in self.parts])
+
+    def __len__(self):
+        return int(self.starts[-1])
+
+    def _text(self, row):
+        if row < 0:
+            row += len(self)
+        if not 0 <= row < len(self):
+            raise IndexError(f'Row {row} out of range for {len(self)} texts')
+        part = int(np.searchsorted(self.starts, row, side='right')) - 1
+        return self.parts[part][row - int(self.starts[part])]
+
+    def __getitem__(self, rows):
+        if isinstance(rows, slice):
+            return [self._text(row) for row in range(*rows.indices(len(self)))]
+        if np.ndim(rows) == 0:
+            return self._text(int(rows))
+        rows = np.asarray(rows, dtype='int64').ravel()
+        if rows.size and (rows.min() < 0 or rows.max() >= len(self)):
+            raise IndexError(f'Rows out of range for {len(self)} texts')
+        parts = np.searchsorted(self.starts, rows, side='right') - 1
+        offsets = rows - self.starts[parts]
+        return [self.parts[part][offset] for part, offset in zip(parts.tolist(), offsets.tolist())]
+
+    def __iter__(self):
+        for part in self.parts:
+            for row in range(len(part)):
+                yield part[row]
+
+    @property
+    def nbytes(self):
+        """
+        Bytes held in memory: texts of older segments and the blob offsets.
+        """
+        return sum(part.nbytes if isinstance(part, BlobReader) else sum(sys.getsizeof(text) for text in part)
+                   for part in self.parts)
@@ -0,0 +1,193 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+
+CACHE_DIR = os.path.join(os.getcwd(), 'cache')
+
+
+def normalize_text(text: str) -> str:
+    return ' '.join(text.split())
+
+
+def embedding_key(text: str, model: str) -> str:
+    return hashlib.sha256(f'{model}\0{normalize_text(text)}'.encode('utf-8')).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent content-addressed embedding cache shared by all users.
+
+    Entries are keyed by hash(model, normalized text) and evicted least-recently-used
+    once the cache holds more than `max_entries` embeddings.
+    """
+
+    def __init__(self, path=os.path.join(CACHE_DIR, 'embeddings.sqlite'), max_entries=200000):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS embeddings '
+                           '(key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)')
+        self._conn.commit()
+
+    def get_many(self, keys):
+        """
+        Returns {key: vector} for the keys that are cached.
+        """
+        found = {}
+        unique_keys = list(dict.fromkeys(keys))
+        with self._lock:
+            # Stay below SQLite's limit on bound parameters
+            for start in range(0, len(unique_keys), 500):
+                chunk = unique_keys[start:start + 500]
+                marks = ','.join('?' * len(chunk))
+                rows = self._conn.execute(f'SELECT key, vector FROM embeddings WHERE key IN ({marks})', chunk)
+                found.update((key, np.frombuffer(vector, dtype='float32')) for key, vector in rows)
+                if found:
+                    self._conn.execute(f'UPDATE embeddings SET last_used = ? WHERE key IN ({marks})',
+                                       [time.time(), *chunk])
+            self._conn.commit()
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+        return found
+
+    def put_many(self, items):
+        now = time.time()
+        rows = [(key, np.asarray(vector, dtype='float32').tobytes(), now) for key, vector in items]
+        with self._lock:
+            self._conn.executemany('INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)', rows)
+            (n_entries,) = self._conn.execute('SELECT COUNT(*) FROM embeddings').fetchone()
+            if n_entries > self.max_entries:
+                self._conn.execute('DELETE FROM embeddings WHERE key IN '
+                                   '(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)',
+                                   (n_entries - self.max_entries,))
+            self._conn.commit()
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def put(self, key, vector):
+        self.put_many([(key, vector)])
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0}
+
+
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+
+def get_embedding_cache():
+    """
+    Process-wide cache instance, created on first use.
+    """
+    global _embedding_cache
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            _embedding_cache = EmbeddingCache()
+    return _embedding_cache
+
+
+def normalize_question(question: str) -> str:
+    return normalize_text(question).lower().rstrip('?!. ')
+
+
+class AnswerCache:
+    """
+    Persistent cache of generated answers, shared by all server processes.
+
+    Entries are keyed by (user, corpus version, normalized question, model params), expire
+    after `ttl` seconds and are evicted least-recently-used above `max_entries`. Writing an
+    answer for a newer corpus version drops the user's answers for older versions, so a
+    changed document store never serves stale answers.
+    """
+
+    def __init__(self, path=os.path.join(CACHE_DIR, 'answers.sqlite'), ttl=7 * 24 * 3600,
+                 max_entries=10000):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS answers '
+                           '(key TEXT PRIMARY KEY, user TEXT NOT NULL, version TEXT NOT NULL, '
+                           'answer TEXT NOT NULL, expires REAL NOT NULL, last_used REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS answers_last_used ON answers (last_used)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS answers_user ON answers (user)')
+        self._conn.commit()
+
+    @staticmethod
+    def make_key(user, version, question, params):
+        raw = json.dumps([user, str(version), normalize_question(question), params], sort_keys=True)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, user, version, question, params):
+        """
+        Returns the cached answer (any JSON-serializable value) or None.
+        """
+        key = self.make_key(user, version, question, params)
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT answer FROM answers WHERE key = ? AND expires > ?',
+                                     (key, now)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute('UPDATE answers SET last_used = ? WHERE key = ?', (now, key))
+            self._conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def put(self, user, version, question, params, answer):
+        key = self.make_key(user, version, question, params)
+        now = time.time()
+        with self._lock:
+            self._conn.execute('DELETE FROM answers WHERE user = ? AND version != ?', (user, str(version)))
+            self._conn.execute('DELETE FROM answers WHERE expires <= ?', (now,))
+            self._conn.execute('INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, user, str(version), json.dumps(answer), now + self.ttl, now))
+            (n_entries,) = self._conn.execute('SELECT COUNT(*) FROM answers').fetchone()
+            if n_entries > self.max_entries:
+                self._conn.execute('DELETE FROM answers WHERE key IN '
+                                   '(SELECT key FROM answers ORDER BY last_used LIMIT ?)',
+                                   (n_entries - self.max_entries,))
+            self._conn.commit()
+
+    def invalidate(self, user):
+        with self._lock:
+            self._conn.execute('DELETE FROM answers WHERE user = ?', (user,))
+            self._conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0}
+
+
+_answer_cache = None
+_answer_cache_lock = threading.Lock()
+
+
+def get_answer_cache():
+    global _answer_cache
+    with _answer_cache_lock:
+        if _answer_cache is None:
+            _answer_cache = AnswerCache()
+    return _answer_cache
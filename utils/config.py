@@ -1,14 +1,139 @@
 import os
 
-import streamlit as st
 
+def user_dir(username):
+    return os.path.join(os.getcwd(), 'users', username)
+
+
+def corpus_dir(username):
+    """
+    Directory of the store and indexes searched for a user: the shared corpus when
+    Sharing.ENABLED, otherwise the user's own.
+    """
+    return Sharing.CORPUS_DIR if Sharing.ENABLED else user_dir(username)
+
+
+class UserPaths:
+    """
+    Directories of one user.
+    """
+
+    def __init__(self, username):
+        self.USR_DIR = user_dir(username)
+        self.CORPUS_DIR = corpus_dir(username)
+        self.TMP_DIR = os.path.join(self.USR_DIR, 'temp')
+        self.DOC_DIR = os.path.join(self.USR_DIR, 'docs')
+        self.TXT_DIR = os.path.join(self.USR_DIR, 'txts')
+        self.CHK_DIR = os.path.join(self.USR_DIR, 'chks')
+        self.URL_DIR = os.path.join(self.USR_DIR, 'urls')
+
+
+class _SessionPaths(type):
+    """
+    Resolves the paths from the logged-in user on every access, so the same process can
+    serve several users and the module can be imported outside of a Streamlit session.
+    """
+
+    def __getattr__(cls, name):
+        import streamlit as st
+
+        return getattr(UserPaths(st.session_state["username"]), name)
+
+
+class Paths(metaclass=_SessionPaths):
+    pass
+
+
+class Retrieval:
+    # 'auto' scans exhaustively for small corpora and switches to IVF for large ones,
+    # otherwise one of 'exact', 'ivf' or 'hnsw', or a compressed scan: 'fp16', 'int8' or 'pq'
+    INDEX_KIND = 'auto'
+    # Per-backend knobs: more probes / a wider beam give better recall and slower queries;
+    # compressed scans rescore their best `rescore` candidates at full precision
+    INDEX_PARAMS = {
+        'ivf': {'n_lists': None, 'n_probe': 8},
+        'hnsw': {'m': 16, 'ef_construction': 100, 'ef_search': 64},
+        'fp16': {'rescore': 100},
+        'int8': {'rescore': 100},
+        'pq': {'n_subvectors': 96, 'rescore': 200},
+    }
+    # 'hybrid' fuses vector and BM25 keyword rankings, 'vector' or 'lexical' use one of them;
+    # lexical retrieval needs no embedding request and is also used when that fails
+    MODE = 'hybrid'
+    # Reciprocal rank fusion constant: larger values flatten the weight of the top ranks
+    RRF_K = 60
+    # The candidate pool is reranked by maximal marginal relevance to its MMR_K most diverse
+    # passages before the context is packed. MMR_LAMBDA weighs relevance against redundancy
+    # with the passages already chosen: 1 ranks by relevance alone, None skips the reranking
+    MMR_LAMBDA = 0.7
+    MMR_K = 10
+    # Seconds to wait for the question embedding before answering from BM25 alone
+    QUERY_EMBEDDING_TIMEOUT = 10
+    # Loaded corpora (vectors, index and metadata) kept in memory per process; least
+    # recently used users are evicted above this
+    CORPUS_MEMORY_BYTES = 2 * 1024 ** 3
+
+
+class Answering:
+    COMPLETIONS_API_PARAMS = {
+        "temperature": 0.0,
+        "max_tokens": 300,
+        "model": "text-davinci-003",
+    }
+    # Token budget of the context, filled from the best CANDIDATE_POOL passages
+    # (after the diversity reranking, see Retrieval.MMR_LAMBDA)
+    MAX_SECTION_LEN = 1000
+    CANDIDATE_POOL = 50
+    # Questions at least this similar to an answered one reuse its answer (see utils/semantic_cache.py)
+    SEMANTIC_CACHE_THRESHOLD = 0.95
+    # Render the answer token by token instead of waiting for the whole completion
+    STREAM_ANSWERS = True
+
+
+class Ingestion:
+    # Concurrent embedding requests and the account's rate limits for the embedding model
+    EMBED_WORKERS = 4
+    REQUESTS_PER_MINUTE = 3000
+    TOKENS_PER_MINUTE = 1000000
+    # Processes converting and splitting files, and chunks embedded per store segment
+    SPLIT_WORKERS = os.cpu_count()
+    BATCH_CHUNKS = 1000
+
+
+class Crawl:
+    # Link hops followed from the start URL, and pages ingested per crawl (see utils/crawler.py)
+    MAX_DEPTH = 1
+    MAX_PAGES = 50
+    # Requests in flight, and seconds and bytes allowed per page
+    CONCURRENCY = 8
+    TIMEOUT = 15
+    MAX_PAGE_BYTES = 5 * 2 ** 20
+    # Only follow links to the host of the start URL
+    SAME_HOST = True
+
+
+class Jobs:
+    # Ingestion job queue (see utils/jobs.py), shared by the app and the service processes
+    DB_PATH = os.path.join(os.getcwd(), 'users', 'jobs.sqlite')
+    # Jobs processed at once per process; jobs of one user always run one after the other
+    WORKERS = 2
+    SPLIT_WORKERS = max(1, (os.cpu_count() or 1) // WORKERS)
+    # A running job whose worker has not reported for this long is taken over by another worker
+    STALE_SECONDS = 60
+    # Seconds between checks of the queue by idle workers and of job progress by the page
+    POLL_SECONDS = 2
+
+
+class Sharing:
+    # One corpus for all users instead of a store per user (see utils/access.py): documents
+    # shared with a group are stored and embedded once, and every query only searches the
+    # chunks its user uploaded or that were shared with one of the user's groups. All users
+    # then write to one store, so run the job workers of a deployment in a single process
+    ENABLED = False
+    CORPUS_DIR = os.path.join(os.getcwd(), 'users', '_shared')
+    # Group name -> usernames of its members
+    GROUPS = {}
 
-class Paths:
-    TMP_DIR = os.path.join(os.getcwd(), 'users', st.session_state["username"], 'temp')
-    DOC_DIR = os.path.join(os.getcwd(), 'users', st.session_state["username"], 'docs')
-    TXT_DIR = os.path.join(os.getcwd(), 'users', st.session_state["username"], 'txts')
-    CHK_DIR = os.path.join(os.getcwd(), 'users', st.session_state["username"], 'chks')
-    URL_DIR = os.path.join(os.getcwd(), 'users', st.session_state["username"], 'urls')
 
 class Urls:
     # CHK_URL = 'http://54.242.28.52/doc/send_chunks'
@@ -17,4 +142,31 @@ class Urls:
 
     CHK_URL = 'http://localhost:8088/doc/send_chunks'
     CLR_URL = 'http://localhost:8088/doc/clear'
-    RTD_URL = 'http://localhost:8088/doc/get_related_contents'
\ No newline at end of file
+    RTD_URL = 'http://localhost:8088/doc/get_related_contents'
+    MET_URL = 'http://localhost:8088/metrics'
+
+class Service:
+    # Address the retrieval service listens on (see utils/service.py); only this machine by default
+    HOST = '127.0.0.1'
+    # Shared secret the pages send in the X-Service-Secret header. The service refuses every
+    # request without it, and refuses to listen on anything but a loopback address unless set
+    SECRET = None
+    PORT = 8088
+    # Threads running searches and index loads; queries of different users run in parallel
+    WORKERS = 8
+    # Seconds a page waits for a response from the service
+    TIMEOUT = 30
+
+
+class Startup:
+    # Load the slow modules, the tokenizer and haystack's PreProcessor in a background thread
+    # when a process starts (see utils/warmup.py), instead of on the first query or upload
+    WARM_UP = True
+    WARM_PREPROCESSOR = True
+
+
+class Tracing:
+    # Per-stage latency histograms (Management page, GET /metrics of the service)
+    ENABLED = True
+    # Also append every span to this JSONL file, e.g. 'logs/spans.jsonl'
+    LOG_PATH = None
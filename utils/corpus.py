@@ -0,0 +1,152 @@
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from functools import partial
+
+from utils.config import Retrieval
+from utils.index import INDEX_DIRNAME, index_nbytes, load_index, update_index
+from utils.lexical import load_lexical, update_lexical
+from utils.store import SegmentStore, file_lock, open_store, store_version
+from utils.tracing import span, traced
+
+# Lock file of the index updates of a store, next to its index so clearing the index keeps it
+INDEX_LOCK_FILE = 'index.lock'
+
+
+@traced()
+def load_corpus(user_dir, params=None):
+    """
+    Returns (vector index, meta, lexical index, texts) over the live chunks of a user's
+    store. The chunk texts stay in the store's blobs until read (see utils/blobs.py).
+    """
+    store = open_store(user_dir)
+    vectors, meta, live, texts = store.load()
+    return (load_index(user_dir, vectors, params, store.generation, live), meta,
+            load_lexical(user_dir, texts, store.generation, live), texts)
+
+
+def sync_corpus(store, kind='auto', params=None):
+    """
+    Updates the vector and lexical indexes of a SegmentStore after it was written to.
+    Updates of one store run one at a time, also across processes, as jobs of several users
+    write to a shared corpus.
+    """
+    with file_lock(os.path.join(store.user_dir, INDEX_LOCK_FILE)):
+        vectors, _, _, texts = store.load()
+        with span('ingest.vector_index'):
+            update_index(store.user_dir, vectors, store.generation, kind, params)
+        with span('ingest.lexical_index'):
+            update_lexical(store.user_dir, texts, store.generation)
+
+
+def refresh_corpus(store, kind='auto', params=None):
+    """
+    sync_corpus, then compacts the store in the background if it has too many segments,
+    syncing the indexes again once the rows were renumbered.
+    """
+    sync_corpus(store, kind, params)
+    if store.needs_compaction():
+        store.compact_in_background(on_done=partial(sync_corpus, store, kind, params))
+
+
+def clear_corpus(user_dir):
+    """
+    Deletes the store and the index of a user.
+    """
+    SegmentStore(user_dir).clear()
+    with file_lock(os.path.join(user_dir, INDEX_LOCK_FILE)):
+        if os.path.exists(os.path.join(user_dir, INDEX_DIRNAME)):
+            shutil.rmtree(os.path.join(user_dir, INDEX_DIRNAME))
+
+
+def corpus_nbytes(dataset):
+    index, meta, lexical, texts = dataset
+    return index_nbytes(index) + int(meta.memory_usage(deep=True).sum()) + index_nbytes(lexical) + texts.nbytes
+
+
+class CorpusManager:
+    """
+    Keeps the loaded corpora of many users in memory within `max_bytes`.
+
+    A corpus is loaded on first use and reloaded when its store version on disk changes.
+    When the loaded corpora together exceed `max_bytes`, the least recently used ones are
+    evicted; the corpus just requested is always kept, even if it alone is larger. Safe to
+    use from several threads; a corpus is loaded only once even when many queries for it
+    arrive at the same time.
+    """
+
+    def __init__(self, params=None, max_bytes=None):
+        self.params = params
+        self.max_bytes = max_bytes
+        self.loads = 0
+        self.hits = 0
+        self.evictions = 0
+        # user_dir -> (version, dataset, size in bytes), least recently used first
+        self._corpora = OrderedDict()
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _user_lock(self, user_dir):
+        with self._lock:
+            return self._locks.setdefault(user_dir, threading.Lock())
+
+    def get(self, user_dir):
+        """
+        Returns (version, (index, meta, lexical, texts)) of the current version of a user's corpus.
+        """
+        with self._user_lock(user_dir):
+            version = store_version(user_dir)
+            with self._lock:
+                current = self._corpora.get(user_dir)
+                if current is not None and current[0] == version:
+                    self._corpora.move_to_end(user_dir)
+                    self.hits += 1
+                    return current[0], current[1]
+
+            dataset = load_corpus(user_dir, self.params)
+            size = corpus_nbytes(dataset)
+            with self._lock:
+                self._corpora[user_dir] = (version, dataset, size)
+                self._corpora.move_to_end(user_dir)
+                self.loads += 1
+                self._evict(keep=user_dir)
+            return version, dataset
+
+    def _evict(self, keep):
+        while self.max_bytes is not None and self.nbytes > self.max_bytes and len(self._corpora) > 1:
+            user_dir = next(iter(self._corpora))
+            if user_dir == keep:
+                self._corpora.move_to_end(user_dir)
+                continue
+            del self._corpora[user_dir]
+            self.evictions += 1
+
+    @property
+    def nbytes(self):
+        return sum(size for _, _, size in self._corpora.values())
+
+    def drop(self, user_dir):
+        with self._user_lock(user_dir):
+            with self._lock:
+                self._corpora.pop(user_dir, None)
+
+    def stats(self):
+        with self._lock:
+            return {'corpora': len(self._corpora), 'bytes': self.nbytes, 'max_bytes': self.max_bytes,
+                    'loads': self.loads, 'hits': self.hits, 'evictions': self.evictions}
+
+
+_corpus_manager = None
+_corpus_manager_lock = threading.Lock()
+
+
+def get_corpus_manager(params=Retrieval.INDEX_PARAMS, max_bytes=Retrieval.CORPUS_MEMORY_BYTES):
+    """
+    Process-wide manager; the arguments only apply when it is first created.
+    """
+    global _corpus_manager
+    with _corpus_manager_lock:
+        if _corpus_manager is None:
+            _corpus_manager = CorpusManager(params, max_bytes)
+    return _corpus_manager
@@ -0,0 +1,307 @@
+"""
+Concurrent, bounded web crawler feeding crawled pages into the ingestion pipeline.
+
+    crawler = Crawler(max_depth=1, max_pages=50)
+    for page in crawler.crawl('https://example.com/docs/'):
+        path = save_page(page, url_dir)      # a .txt file for pipeline.ingest_files
+
+Pages are fetched breadth-first by `concurrency` coroutines sharing one HTTP session, and
+yielded as soon as their text is extracted, while the crawl goes on in the background.
+URLs are visited once, and pages whose text was already seen under another URL are
+skipped. Only HTML and plain text pages are kept; links are followed up to `max_depth`
+hops from the start URLs, on the same host unless `same_host` is off.
+"""
+import asyncio
+import hashlib
+import os
+import queue
+import re
+import threading
+import time
+from collections import namedtuple
+from html.parser import HTMLParser
+from urllib.parse import urldefrag, urljoin, urlsplit, urlunsplit
+
+from utils.tracing import record
+
+
+Page = namedtuple('Page', ['url', 'depth', 'title', 'text'])
+
+# Their content is not text of the page
+SKIPPED_TAGS = {'script', 'style', 'noscript', 'template', 'svg', 'head', 'iframe'}
+# Navigation and other boilerplate: links are followed, the text is dropped
+BOILERPLATE_TAGS = {'nav', 'footer', 'aside'}
+# Tags starting a new paragraph, so passages are split where the page has breaks
+BLOCK_TAGS = {'p', 'div', 'section', 'article', 'main', 'header', 'li', 'ul', 'ol', 'dl', 'dt', 'dd',
+              'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'br', 'hr', 'tr', 'table', 'pre', 'blockquote',
+              'figure', 'figcaption', 'form'}
+TEXT_TYPES = ('text/html', 'application/xhtml+xml', 'text/plain')
+FILENAME_PATTERN = re.compile(r'[^\w-]+')
+
+
+class _PageParser(HTMLParser):
+    """
+    Collects the paragraphs of visible text, the title and the links of an HTML page.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = ''
+        self.links = []
+        self.base = None
+        self.paragraphs = []
+        self._words = []
+        self._skipped = 0
+        self._boilerplate = 0
+        self._in_title = False
+
+    def _break(self):
+        if self._words:
+            self.paragraphs.append(' '.join(self._words))
+            self._words = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            href = dict(attrs).get('href')
+            if href:
+                self.links.append(href)
+        elif tag == 'base' and self.base is None:
+            self.base = dict(attrs).get('href')
+        elif tag == 'title':
+            self._in_title = True
+        if tag in SKIPPED_TAGS:
+            self._skipped += 1
+        elif tag in BOILERPLATE_TAGS:
+            self._boilerplate += 1
+        if tag in BLOCK_TAGS:
+            self._break()
+
+    def handle_endtag(self, tag):
+        if tag == 'title':
+            self._in_title = False
+        if tag in SKIPPED_TAGS:
+            self._skipped = max(0, self._skipped - 1)
+        elif tag in BOILERPLATE_TAGS:
+            self._boilerplate = max(0, self._boilerplate - 1)
+        if tag in BLOCK_TAGS:
+            self._break()
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title += data
+        elif not self._skipped and not self._boilerplate:
+            self._words.extend(data.split())
+
+    def close(self):
+        super().close()
+        self._break()
+
+
+def parse_html(html, url):
+    """
+    Returns (title, text with paragraphs separated by blank lines, absolute links) of a page.
+    """
+    parser = _PageParser()
+    parser.feed(html)
+    parser.close()
+    base = urljoin(url, parser.base) if parser.base else url
+    links = [urljoin(base, link.strip()) for link in parser.links]
+    return ' '.join(parser.title.split()), '\n\n'.join(parser.paragraphs), links
+
+
+def normalize_url(url):
+    """
+    The URL without its fragment and with lowercase scheme and host, or None when it is not http(s).
+    """
+    url = urldefrag(url)[0]
+    parts = urlsplit(url)
+    if parts.scheme.lower() not in ('http', 'https') or not parts.netloc:
+        return None
+    return urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path or '/', parts.query, ''))
+
+
+def content_hash(text):
+    return hashlib.sha256(' '.join(text.split()).encode('utf-8')).hexdigest()
+
+
+class Crawler:
+    """
+    Breadth-first crawl with at most `concurrency` requests in flight.
+
+    `max_depth` is the number of link hops followed from the start URLs (0 fetches the start
+    URLs only) and `max_pages` bounds the pages yielded. Responses larger than `max_bytes`
+    or of other content types are skipped. After a crawl, `stats` counts the fetched,
+    yielded, duplicate, skipped and failed pages.
+    """
+
+    def __init__(self, max_depth=1, max_pages=50, concurrency=8, timeout=15, same_host=True,
+                 max_bytes=5 * 2 ** 20, user_agent='DocInsight-crawler/1.0'):
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.same_host = same_host
+        self.max_bytes = max_bytes
+        self.user_agent = user_agent
+        self.stats = {}
+
+    def crawl(self, urls):
+        """
+        Yields a Page for every new page, while the crawl runs on in a background thread.
+        Closing the generator early stops the crawl.
+        """
+        urls = [urls] if isinstance(urls, str) else list(urls)
+        pages = queue.Queue(maxsize=2 * self.concurrency)
+        stop = threading.Event()
+        done = object()
+
+        def run():
+            try:
+                asyncio.run(self._crawl(urls, pages, stop))
+            except BaseException as e:
+                pages.put(e)
+            finally:
+                pages.put(done)
+
+        thread = threading.Thread(target=run, daemon=True, name='crawler')
+        thread.start()
+        try:
+            while True:
+                page = pages.get()
+                if page is done:
+                    break
+                if isinstance(page, BaseException):
+                    raise page
+                yield page
+        finally:
+            stop.set()
+            # Unblock the crawl if it waits for room in the queue
+            while thread.is_alive():
+                try:
+                    pages.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    async def _crawl(self, urls, pages, stop):
+        import aiohttp
+
+        self.stats = {'fetched': 0, 'pages': 0, 'duplicates': 0, 'skipped': 0, 'errors': 0}
+        frontier = asyncio.Queue()
+        seen_urls, seen_hashes = set(), set()
+        hosts = set()
+        for url in urls:
+            url = normalize_url(url)
+            if url is not None and url not in seen_urls:
+                seen_urls.add(url)
+                hosts.add(urlsplit(url).netloc)
+                frontier.put_nowait((url, 0))
+
+        def finished():
+            return stop.is_set() or self.stats['pages'] >= self.max_pages
+
+        async def emit(page):
+            # The consumer may be busy splitting and embedding; wait without blocking the loop
+            while not stop.is_set():
+                try:
+                    pages.put_nowait(page)
+                    return
+                except queue.Full:
+                    await asyncio.sleep(0.05)
+
+        async def visit(session, url, depth):
+            if finished():
+                return
+            page, links = await self._fetch(session, url, depth)
+            if page is not None and not finished():
+                digest = content_hash(page.text)
+                if digest in seen_hashes:
+                    self.stats['duplicates'] += 1
+                else:
+                    seen_hashes.add(digest)
+                    self.stats['pages'] += 1
+                    await emit(page)
+            if depth < self.max_depth and not finished():
+                for link in links:
+                    link = normalize_url(link)
+                    if (link is not None and link not in seen_urls
+                            and (not self.same_host or urlsplit(link).netloc in hosts)):
+                        seen_urls.add(link)
+                        frontier.put_nowait((link, depth + 1))
+
+        async def worker(session):
+            while True:
+                url, depth = await frontier.get()
+                try:
+                    await visit(session, url, depth)
+                except Exception as e:
+                    # A page that cannot be handled must not stop the worker, or the crawl would never finish
+                    print(f'Crawling {url} failed: {e!r}')
+                    self.stats['errors'] += 1
+                finally:
+                    frontier.task_done()
+
+        timeout = aiohttp.ClientTimeout(total=self.timeout)
+        headers = {'User-Agent': self.user_agent}
+        async with aiohttp.ClientSession(timeout=timeout, headers=headers) as session:
+            workers = [asyncio.create_task(worker(session)) for _ in range(self.concurrency)]
+            await frontier.join()
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _fetch(self, session, url, depth):
+        """
+        Returns (Page or None, links found on it).
+        """
+        import aiohttp
+
+        start = time.perf_counter()
+        try:
+            async with session.get(url) as response:
+                content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+                if (response.status != 200 or content_type not in TEXT_TYPES
+                        or (response.content_length or 0) > self.max_bytes):
+                    self.stats['skipped'] += 1
+                    return None, []
+                body = await response.content.read(self.max_bytes + 1)
+                if len(body) > self.max_bytes:
+                    self.stats['skipped'] += 1
+                    return None, []
+                text = body.decode(response.charset or 'utf-8', errors='replace')
+                final_url = str(response.url)
+        except (aiohttp.ClientError, asyncio.TimeoutError, LookupError) as e:
+            print(f'Crawling {url} failed: {e!r}')
+            self.stats['errors'] += 1
+            return None, []
+        finally:
+            record('crawl.fetch', time.perf_counter() - start)
+        self.stats['fetched'] += 1
+
+        if content_type == 'text/plain':
+            title, links = '', []
+        else:
+            title, text, links = parse_html(text, final_url)
+        if not text.strip():
+            self.stats['skipped'] += 1
+            return None, links
+        return Page(final_url, depth, title, text), links
+
+
+def page_filename(url):
+    """
+    A file name for the text of a page: readable from its host and path, unique by a hash
+    of the URL, and without dots, since the pipeline names text copies after the first one.
+    """
+    parts = urlsplit(url)
+    readable = FILENAME_PATTERN.sub('_', f'{parts.netloc}{parts.path}').strip('_')[:80]
+    return f'{readable}_{hashlib.sha1(url.encode("utf-8")).hexdigest()[:8]}.txt'
+
+
+def save_page(page, dir_path):
+    """
+    Writes the title, URL and text of a page to a text file in `dir_path`; returns its path.
+    """
+    path = os.path.join(dir_path, page_filename(page.url))
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n\n'.join(part for part in (page.title, page.url, page.text) if part))
+    return path
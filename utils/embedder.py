@@ -0,0 +1,174 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+from tenacity import retry, wait_random_exponential, stop_after_attempt
+
+from utils.cache import embedding_key, get_embedding_cache
+from utils.config import Ingestion
+from utils.tracing import span, traced
+
+
+EMBEDDING_MODEL = "text-embedding-ada-002"
+ENCODING = "cl100k_base"  # encoding for text-embedding-ada-002
+
+# Upper bounds for a single embedding request
+MAX_BATCH_TOKENS = 8000
+MAX_BATCH_SIZE = 256
+
+_encoding = None
+
+
+def count_tokens(text: str) -> int:
+    global _encoding
+    if _encoding is None:
+        # Loading the encoding takes a while; utils.warmup does it in the background
+        import tiktoken
+
+        _encoding = tiktoken.get_encoding(ENCODING)
+    return len(_encoding.encode(text))
+
+
+def make_batches(token_counts, max_tokens=MAX_BATCH_TOKENS, max_size=MAX_BATCH_SIZE):
+    """
+    Greedily packs consecutive texts into batches of at most `max_tokens` tokens and
+    `max_size` texts. Returns (start, end) row ranges; a text larger than the budget gets
+    a batch of its own.
+    """
+    batches = []
+    start, batch_tokens = 0, 0
+    for i, n_tokens in enumerate(token_counts):
+        if i > start and (batch_tokens + n_tokens > max_tokens or i - start >= max_size):
+            batches.append((start, i))
+            start, batch_tokens = i, 0
+        batch_tokens += n_tokens
+    if start < len(token_counts):
+        batches.append((start, len(token_counts)))
+    return batches
+
+
+class RateLimiter:
+    """
+    Sliding one-minute window over requests and tokens, shared by all worker threads.
+    """
+
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None, window=60.0):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.window = window
+        self._sent = deque()
+        self._sent_tokens = 0
+        self._lock = threading.Lock()
+
+    def _wait_time(self, n_tokens, now):
+        while self._sent and now - self._sent[0][0] >= self.window:
+            self._sent_tokens -= self._sent.popleft()[1]
+        if not self._sent:
+            return 0.0
+        if self.requests_per_minute and len(self._sent) >= self.requests_per_minute:
+            return self._sent[0][0] + self.window - now
+        if self.tokens_per_minute and self._sent_tokens + n_tokens > self.tokens_per_minute:
+            return self._sent[0][0] + self.window - now
+        return 0.0
+
+    def acquire(self, n_tokens=0):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self._wait_time(n_tokens, now)
+                if wait <= 0:
+                    self._sent.append((now, n_tokens))
+                    self._sent_tokens += n_tokens
+                    return
+            time.sleep(wait)
+
+
+class BatchEmbedder:
+    """
+    Embeds many texts with token-budgeted batches sent concurrently by a bounded thread pool.
+
+    Texts found in `cache` (an EmbeddingCache) are not sent at all, and new embeddings are
+    added to it. `api_base` / `api_key` point the requests at another endpoint, e.g. a local
+    fake server.
+    """
+
+    def __init__(self, model=EMBEDDING_MODEL, max_batch_tokens=MAX_BATCH_TOKENS,
+                 max_batch_size=MAX_BATCH_SIZE, max_workers=4,
+                 requests_per_minute=None, tokens_per_minute=None,
+                 cache=None, api_base=None, api_key=None):
+        self.model = model
+        self.cache = cache
+        self.max_batch_tokens = max_batch_tokens
+        self.max_batch_size = max_batch_size
+        self.max_workers = max_workers
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.api_params = {k: v for k, v in (('api_base', api_base), ('api_key', api_key)) if v}
+
+    @traced('embedding_request')
+    @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
+    def _request(self, texts):
+        import openai
+
+        response = openai.Embedding.create(input=texts, model=self.model, **self.api_params)
+        data = sorted(response["data"], key=lambda d: d["index"])
+        return [d["embedding"] for d in data]
+
+    def _embed_batch(self, texts, n_tokens):
+        with span('embedding_rate_limit_wait'):
+            self.rate_limiter.acquire(n_tokens)
+        return self._request(texts)
+
+    def embed(self, texts, progress=None):
+        """
+        Returns a float32 matrix with one embedding per text, in the order of `texts`.
+
+        `progress(done, total)` is called from the calling thread after every finished
+        batch, so it can safely update Streamlit elements.
+        """
+        texts = list(texts)
+        results = [None] * len(texts)
+        keys, missing = [], list(range(len(texts)))
+        if self.cache is not None:
+            keys = [embedding_key(t, self.model) for t in texts]
+            cached = self.cache.get_many(keys)
+            missing = [i for i, key in enumerate(keys) if key not in cached]
+            for i, key in enumerate(keys):
+                results[i] = cached.get(key)
+
+        missing_texts = [texts[i] for i in missing]
+        token_counts = [count_tokens(t) for t in missing_texts]
+        batches = make_batches(token_counts, self.max_batch_tokens, self.max_batch_size)
+        done = len(texts) - len(missing)
+        if progress is not None and done:
+            progress(done, len(texts))
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            futures = {executor.submit(self._embed_batch, missing_texts[start:end],
+                                       sum(token_counts[start:end])): (start, end)
+                       for start, end in batches}
+            for future in as_completed(futures):
+                start, end = futures[future]
+                embeddings = future.result()
+                for i, embedding in zip(missing[start:end], embeddings):
+                    results[i] = embedding
+                if self.cache is not None:
+                    self.cache.put_many((keys[i], e) for i, e in zip(missing[start:end], embeddings))
+                done += end - start
+                if progress is not None:
+                    progress(done, len(texts))
+
+        if not results:
+            return np.empty((0, 0), dtype='float32')
+        return np.array(results, dtype='float32')
+
+
+def make_embedder():
+    """
+    BatchEmbedder with the configured concurrency and rate limits, sharing the embedding cache.
+    """
+    return BatchEmbedder(max_workers=Ingestion.EMBED_WORKERS,
+                         requests_per_minute=Ingestion.REQUESTS_PER_MINUTE,
+                         tokens_per_minute=Ingestion.TOKENS_PER_MINUTE,
+                         cache=get_embedding_cache())
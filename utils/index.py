@@ -0,0 +1,593 @@
+import json
+import os
+import threading
+
+import numpy as np
+from numpy import ndarray
+
+from utils.ai import Retriever, normalize_rows, top_k_from_scores
+from utils.quantize import QUANTIZED_TYPES
+
+
+INDEX_DIRNAME = 'index'
+INDEX_META_FILE = 'index.json'
+
+# Below this many passages a brute-force scan is as fast as any index
+AUTO_EXACT_LIMIT = 20000
+# A search restricted to fewer than this share of the passages scans them exhaustively;
+# the cluster and graph searches would find too few of them among their candidates
+FILTER_SCAN_SHARE = 0.1
+# Visit marks of the HNSW searches start over when the stamp reaches this
+MAX_STAMP = np.iinfo('uint32').max
+
+
+def _save_array(index_dir, name, array):
+    # Replace instead of overwriting, the old file may still be memory-mapped
+    path = os.path.join(index_dir, f'{name}.npy')
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, np.ascontiguousarray(array))
+    os.replace(path + '.tmp', path)
+
+
+def _load_array(index_dir, name):
+    return np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode='r')
+
+
+def _scan_rows(vectors, queries, rows, k):
+    """
+    Exact search of normalized queries among the given rows only.
+    """
+    scores = queries @ np.asarray(vectors[rows]).T
+    top_scores, top = top_k_from_scores(scores, k)
+    all_scores = np.full((queries.shape[0], k), -np.inf, dtype='float32')
+    all_indexes = np.full((queries.shape[0], k), -1, dtype='int64')
+    all_scores[:, :top.shape[1]] = top_scores
+    all_indexes[:, :top.shape[1]] = rows[top]
+    return all_scores, all_indexes
+
+
+def _allowed_share(index, allowed):
+    """
+    (allowed rows that are live, their share of the index) for a search restricted to `allowed`.
+    """
+    if index.live is not None:
+        allowed = allowed & index.live
+    return allowed, allowed.sum() / max(1, len(index))
+
+
+class ExactIndex(Retriever):
+    """
+    Brute-force index, always exact. Nothing is persisted besides its metadata.
+    """
+    kind = 'exact'
+
+    def __init__(self, vectors: ndarray, **params):
+        super().__init__(vectors)
+        self.params = {}
+
+    def add(self, vectors):
+        self.vectors = normalize_rows(vectors)
+
+    def save_arrays(self, index_dir):
+        pass
+
+    @classmethod
+    def load_arrays(cls, index_dir, vectors, params):
+        return cls(vectors)
+
+
+class IVFIndex:
+    """
+    Inverted-file index: passages are clustered with spherical k-means and a query only
+    scans the `n_probe` clusters whose centroids are closest to it.
+
+    More lists make every probe cheaper, more probes raise recall at the cost of latency.
+    """
+    kind = 'ivf'
+
+    def __init__(self, vectors: ndarray, n_lists: int = None, n_probe: int = 8,
+                 n_iter: int = 10, seed: int = 0, train: bool = True):
+        self.vectors = normalize_rows(vectors)
+        n = self.vectors.shape[0]
+        self.n_lists = max(1, min(n, n_lists or int(np.sqrt(n))))
+        self.n_probe = n_probe
+        self.params = {'n_lists': self.n_lists, 'n_probe': n_probe}
+        self.live = None
+        if train:
+            self.centroids = self._train(n_iter, seed)
+            self.assignments = self._assign(self.vectors)
+            self._build_lists()
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def set_live(self, live):
+        self.live = None if live is None or live.all() else live
+
+    def _assign(self, vectors, block=4096):
+        assignments = np.empty(vectors.shape[0], dtype='int64')
+        for start in range(0, vectors.shape[0], block):
+            scores = np.asarray(vectors[start:start + block]) @ self.centroids.T
+            assignments[start:start + block] = scores.argmax(axis=1)
+        return assignments
+
+    def _train(self, n_iter, seed):
+        rng = np.random.default_rng(seed)
+        n = self.vectors.shape[0]
+        sample_size = min(n, 256 * self.n_lists)
+        sample = np.asarray(self.vectors[np.sort(rng.choice(n, sample_size, replace=False))])
+        self.centroids = sample[rng.choice(sample_size, self.n_lists, replace=False)].copy()
+        for _ in range(n_iter):
+            assignments = self._assign(sample)
+            sums = np.zeros_like(self.centroids)
+            np.add.at(sums, assignments, sample)
+            counts = np.bincount(assignments, minlength=self.n_lists)
+            empty = counts == 0
+            if empty.any():
+                sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+            self.centroids = normalize_rows(sums)
+        return self.centroids
+
+    def _build_lists(self):
+        self.order = np.argsort(self.assignments, kind='stable')
+        self.offsets = np.zeros(self.n_lists + 1, dtype='int64')
+        np.cumsum(np.bincount(self.assignments, minlength=self.n_lists), out=self.offsets[1:])
+
+    def add(self, vectors):
+        """
+        Adds the rows of `vectors` past the indexed ones to their nearest existing clusters.
+        """
+        n_old = len(self)
+        self.vectors = normalize_rows(vectors)
+        self.assignments = np.concatenate([self.assignments, self._assign(self.vectors[n_old:])])
+        self._build_lists()
+
+    def search(self, queries, k: int = 3, allowed: ndarray = None) -> tuple[ndarray, ndarray]:
+        queries = normalize_rows(np.atleast_2d(np.asarray(queries, dtype='float32')))
+        n_probe = min(self.n_probe, self.n_lists)
+        if allowed is not None:
+            allowed, share = _allowed_share(self, allowed)
+            if share < FILTER_SCAN_SHARE:
+                return _scan_rows(self.vectors, queries, np.flatnonzero(allowed), k)
+            # Probe more lists, so as many allowed candidates are scanned as without a filter
+            n_probe = min(int(np.ceil(n_probe / share)), self.n_lists)
+        _, probes = top_k_from_scores(queries @ self.centroids.T, n_probe)
+
+        all_scores = np.full((queries.shape[0], k), -np.inf, dtype='float32')
+        all_indexes = np.full((queries.shape[0], k), -1, dtype='int64')
+        for qi, (query, lists) in enumerate(zip(queries, probes)):
+            candidates = np.concatenate([self.order[self.offsets[l]:self.offsets[l + 1]] for l in lists])
+            if allowed is not None:
+                candidates = candidates[allowed[candidates]]
+            elif self.live is not None:
+                candidates = candidates[self.live[candidates]]
+            if candidates.size == 0:
+                continue
+            candidates.sort()
+            scores = np.asarray(self.vectors[candidates]) @ query
+            top_scores, top = top_k_from_scores(scores[None, :], k)
+            all_scores[qi, :top.shape[1]] = top_scores[0]
+            all_indexes[qi, :top.shape[1]] = candidates[top[0]]
+        return all_scores, all_indexes
+
+    def save_arrays(self, index_dir):
+        _save_array(index_dir, 'centroids', self.centroids)
+        _save_array(index_dir, 'assignments', self.assignments)
+
+    @classmethod
+    def load_arrays(cls, index_dir, vectors, params):
+        index = cls(vectors, train=False, **params)
+        index.centroids = np.asarray(_load_array(index_dir, 'centroids'))
+        index.assignments = np.asarray(_load_array(index_dir, 'assignments'))
+        index._build_lists()
+        return index
+
+
+class HNSWIndex:
+    """
+    Hierarchical navigable small-world graph.
+
+    `m` bounds the links per node (twice that on the bottom layer), `ef_construction` is
+    the beam width while building and `ef_search` the beam width per query; raising either
+    beam trades latency for recall.
+    """
+    kind = 'hnsw'
+    # Beam nodes expanded together per search step: fewer, larger numpy operations
+    EXPAND = 32
+
+    def __init__(self, vectors: ndarray, m: int = 16, ef_construction: int = 100,
+                 ef_search: int = 64, seed: int = 0, build: bool = True):
+        self.vectors = normalize_rows(vectors)
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.params = {'m': m, 'ef_construction': ef_construction, 'ef_search': ef_search}
+        self.seed = seed
+        self.live = None
+        self.entry_point = -1
+        # Visit marks of the searches of each thread, see _visit_marks
+        self._visits = threading.local()
+        # links[0] is an (n, 2m) matrix; upper layers map node -> row of a (n_layer, m) matrix
+        self.links = []
+        self.layer_rows = []
+        if build:
+            self.levels = np.empty(0, dtype='int64')
+            self.links = [np.empty((0, 2 * m), dtype='int32')]
+            self.layer_rows = [None]
+            self._insert_new()
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    def set_live(self, live):
+        # Deleted nodes stay in the graph for navigation and are only dropped from results
+        self.live = None if live is None or live.all() else live
+
+    def _rows(self, nodes, layer):
+        """
+        Rows of the links matrix of a layer holding the links of `nodes`.
+        """
+        if layer == 0:
+            return nodes
+        return [self.layer_rows[layer][node] for node in nodes]
+
+    def _neighbours(self, node, layer):
+        row = self.links[layer][self._rows([node], layer)[0]]
+        return row[row >= 0]
+
+    def _visit_marks(self):
+        """
+        Returns (marks, stamp): node i was visited by the current search if marks[i] == stamp.
+        The marks are allocated once per thread and size instead of once per search.
+        """
+        visits = self._visits
+        if getattr(visits, 'marks', None) is None or len(visits.marks) < len(self) or visits.stamp == MAX_STAMP:
+            visits.marks = np.zeros(len(self), dtype='uint32')
+            visits.stamp = 0
+        visits.stamp += 1
+        return visits.marks, visits.stamp
+
+    def _search_layer(self, query, entry_points, ef, layer):
+        """
+        Beam search of one layer; returns up to `ef` (score, node) pairs, best first.
+
+        The beam is kept sorted. Each step expands its best `EXPAND` nodes not expanded
+        yet at once, scoring all their new neighbours with one matrix product, until every
+        node of the beam was expanded.
+        """
+        marks, stamp = self._visit_marks()
+        nodes = np.unique(np.asarray(entry_points, dtype='int64'))
+        marks[nodes] = stamp
+        scores = np.asarray(self.vectors[nodes]) @ query
+        order = np.argsort(-scores)[:ef]
+        nodes, scores = nodes[order], scores[order]
+        expanded = np.zeros(len(nodes), dtype=bool)
+        links = self.links[layer]
+        while True:
+            pending = np.flatnonzero(~expanded)[:self.EXPAND]
+            if not pending.size:
+                break
+            expanded[pending] = True
+            neighbours = links[self._rows(nodes[pending], layer)].ravel()
+            neighbours = neighbours[neighbours >= 0]
+            neighbours = neighbours[marks[neighbours] != stamp]
+            if not neighbours.size:
+                continue
+            # Nodes linked from several of the expanded ones are scored once
+            neighbours.sort()
+            neighbours = neighbours[np.concatenate(([True], neighbours[1:] != neighbours[:-1]))]
+            marks[neighbours] = stamp
+            neighbour_scores = np.asarray(self.vectors[neighbours]) @ query
+            if len(nodes) >= ef:
+                # Only neighbours closer than the worst of the beam can enter it
+                closer = neighbour_scores > scores[-1]
+                neighbours, neighbour_scores = neighbours[closer], neighbour_scores[closer]
+                if not neighbours.size:
+                    continue
+            order = np.argsort(-np.concatenate([scores, neighbour_scores]), kind='stable')[:ef]
+            nodes = np.concatenate([nodes, neighbours])[order]
+            scores = np.concatenate([scores, neighbour_scores])[order]
+            expanded = np.concatenate([expanded, np.zeros(len(neighbours), dtype=bool)])[order]
+        return list(zip(scores.tolist(), nodes.tolist()))
+
+    def _set_links(self, node, layer, neighbours):
+        width = self.links[layer].shape[1]
+        row = np.full(width, -1, dtype='int32')
+        row[:len(neighbours)] = neighbours[:width]
+        self.links[layer][self._rows([node], layer)[0]] = row
+
+    def _select(self, base, candidates, width):
+        """
+        Neighbour selection heuristic: a candidate is kept only if it is closer to `base`
+        than to every neighbour kept so far, which keeps links spread across clusters.
+        Remaining slots are filled with the closest pruned candidates.
+        """
+        candidates = np.asarray(candidates)
+        if len(candidates) <= width:
+            return list(candidates)
+        vectors = np.asarray(self.vectors[candidates])
+        to_base = vectors @ np.asarray(self.vectors[base])
+        order = np.argsort(-to_base)
+        gram = vectors @ vectors.T
+        # Highest similarity of every candidate to the kept ones
+        covered = np.full(len(candidates), -np.inf, dtype=gram.dtype)
+        kept, pruned = [], []
+        for i in order.tolist():
+            if len(kept) >= width:
+                break
+            if covered[i] < to_base[i]:
+                kept.append(i)
+                np.maximum(covered, gram[i], out=covered)
+            else:
+                pruned.append(i)
+        kept += pruned[:width - len(kept)]
+        return list(candidates[kept])
+
+    def _connect(self, node, layer, found):
+        width = self.links[layer].shape[1]
+        neighbours = np.asarray(self._select(node, [n for _, n in found], width), dtype='int64')
+        self._set_links(node, layer, neighbours)
+        # The links of all new neighbours are updated at once
+        rows = np.asarray(self._rows(neighbours.tolist(), layer), dtype='int64')
+        links = self.links[layer][rows]
+        counts = (links >= 0).sum(axis=1)
+        open_slots = counts < width
+        self.links[layer][rows[open_slots], counts[open_slots]] = node
+        full = ~open_slots
+        if not full.any():
+            return
+        # Cheap form of the heuristic for full lists: the new node replaces the farthest
+        # link unless an existing link already covers it
+        links, rows = links[full], rows[full]
+        node_vector = np.asarray(self.vectors[node])
+        neighbour_vectors = np.asarray(self.vectors[neighbours[full]])
+        linked = np.asarray(self.vectors[links.ravel()]).reshape(links.shape[0], width, -1)
+        to_neighbour = np.einsum('nwd,nd->nw', linked, neighbour_vectors)
+        replace = (linked @ node_vector).max(axis=1) < neighbour_vectors @ node_vector
+        if replace.any():
+            farthest = to_neighbour[replace].argmin(axis=1)
+            self.links[layer][rows[replace], farthest] = node
+
+    def add(self, vectors):
+        """
+        Inserts the rows of `vectors` past the indexed ones into the graph.
+        """
+        self.vectors = normalize_rows(vectors)
+        self._insert_new()
+
+    def _insert_new(self):
+        start, n = len(self.levels), len(self)
+        if start == n:
+            return
+        rng = np.random.default_rng(self.seed + start)
+        new_levels = np.floor(-np.log(rng.random(n - start) + 1e-12) / np.log(self.m)).astype('int64')
+        self.levels = np.concatenate([self.levels, new_levels])
+
+        self.links[0] = np.vstack([self.links[0], np.full((n - start, 2 * self.m), -1, dtype='int32')])
+        for layer in range(1, int(self.levels.max()) + 1):
+            if layer == len(self.links):
+                self.links.append(np.empty((0, self.m), dtype='int32'))
+                self.layer_rows.append({})
+            new_nodes = start + np.flatnonzero(new_levels >= layer)
+            rows = self.layer_rows[layer]
+            for node in new_nodes:
+                rows[int(node)] = len(rows)
+            self.links[layer] = np.vstack([self.links[layer],
+                                           np.full((len(new_nodes), self.m), -1, dtype='int32')])
+
+        entry_level = int(self.levels[self.entry_point]) if self.entry_point >= 0 else -1
+        for node in range(start, n):
+            level = int(self.levels[node])
+            query = np.asarray(self.vectors[node])
+            if self.entry_point < 0:
+                self.entry_point, entry_level = node, level
+                continue
+            entry_points = [self.entry_point]
+            for layer in range(entry_level, level, -1):
+                entry_points = [self._search_layer(query, entry_points, 1, layer)[0][1]]
+            for layer in range(min(entry_level, level), -1, -1):
+                found = self._search_layer(query, entry_points, self.ef_construction, layer)
+                self._connect(node, layer, found)
+                entry_points = [n for _, n in found]
+            if level > entry_level:
+                self.entry_point, entry_level = node, level
+
+    def search(self, queries, k: int = 3, allowed: ndarray = None) -> tuple[ndarray, ndarray]:
+        queries = normalize_rows(np.atleast_2d(np.asarray(queries, dtype='float32')))
+        all_scores = np.full((queries.shape[0], k), -np.inf, dtype='float32')
+        all_indexes = np.full((queries.shape[0], k), -1, dtype='int64')
+        if self.entry_point < 0:
+            return all_scores, all_indexes
+        ef = max(self.ef_search, k)
+        keep = self.live
+        if allowed is not None:
+            keep, share = _allowed_share(self, allowed)
+            if share < FILTER_SCAN_SHARE:
+                return _scan_rows(self.vectors, queries, np.flatnonzero(keep), k)
+            # Every node is a stepping stone, but only allowed ones are results: widen the beam
+            ef = int(np.ceil(ef / share))
+        for qi, query in enumerate(queries):
+            entry_points = [self.entry_point]
+            for layer in range(len(self.links) - 1, 0, -1):
+                entry_points = [self._search_layer(query, entry_points, 1, layer)[0][1]]
+            found = self._search_layer(query, entry_points, ef, 0)
+            if keep is not None:
+                found = [(score, node) for score, node in found if keep[node]]
+            found = found[:k]
+            all_scores[qi, :len(found)] = [s for s, _ in found]
+            all_indexes[qi, :len(found)] = [n for _, n in found]
+        return all_scores, all_indexes
+
+    def save_arrays(self, index_dir):
+        _save_array(index_dir, 'levels', self.levels)
+        _save_array(index_dir, 'entry_point', np.array([self.entry_point]))
+        for layer, links in enumerate(self.links):
+            _save_array(index_dir, f'links_{layer}', links)
+
+    @classmethod
+    def load_arrays(cls, index_dir, vectors, params):
+        index = cls(vectors, build=False, **params)
+        index.levels = np.asarray(_load_array(index_dir, 'levels'))
+        index.entry_point = int(_load_array(index_dir, 'entry_point')[0])
+        top_level = int(index.levels.max()) if len(index.levels) else 0
+        index.links = [np.array(_load_array(index_dir, 'links_0'))]
+        index.layer_rows = [None]
+        for layer in range(1, top_level + 1):
+            nodes = np.flatnonzero(index.levels >= layer)
+            index.links.append(np.array(_load_array(index_dir, f'links_{layer}')))
+            index.layer_rows.append({int(node): row for row, node in enumerate(nodes)})
+        return index
+
+
+INDEX_TYPES = {cls.kind: cls for cls in (ExactIndex, IVFIndex, HNSWIndex)}
+# Compressed scans with full-precision rescoring (fp16, int8, pq)
+INDEX_TYPES.update(QUANTIZED_TYPES)
+
+
+def resolve_kind(kind, n_vectors):
+    if kind == 'auto':
+        return 'exact' if n_vectors <= AUTO_EXACT_LIMIT else 'ivf'
+    if kind not in INDEX_TYPES:
+        raise ValueError(f'Unknown index kind "{kind}", expected one of {list(INDEX_TYPES)} or "auto"')
+    return kind
+
+
+def build_index(vectors, kind='auto', params=None):
+    """
+    `params` maps an index kind to the keyword arguments of its backend, so one settings
+    dict can cover every kind that "auto" may pick.
+    """
+    kind = resolve_kind(kind, vectors.shape[0])
+    return INDEX_TYPES[kind](vectors, **(params or {}).get(kind, {}))
+
+
+def save_index(index, user_dir, generation=0):
+    """
+    `generation` is the store generation the row numbers of the index refer to.
+    """
+    index_dir = os.path.join(user_dir, INDEX_DIRNAME)
+    os.makedirs(index_dir, exist_ok=True)
+    index.save_arrays(index_dir)
+    meta = {'kind': index.kind, 'params': index.params, 'size': len(index), 'generation': generation}
+    with open(os.path.join(index_dir, INDEX_META_FILE) + '.tmp', 'w') as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(index_dir, INDEX_META_FILE) + '.tmp', os.path.join(index_dir, INDEX_META_FILE))
+
+
+def _read_index_meta(user_dir):
+    meta_path = os.path.join(user_dir, INDEX_DIRNAME, INDEX_META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return meta if meta['kind'] in INDEX_TYPES else None
+
+
+def load_index(user_dir, vectors, params=None, generation=0, live=None):
+    """
+    Load the persisted index of a user, falling back to an exact scan when there is none
+    or it was built for another version of the corpus.
+
+    Entries of `params` (same layout as for `build_index`) override the persisted
+    query-time knobs such as `n_probe` or `ef_search`. Rows where `live` is False are
+    never returned.
+    """
+    meta = _read_index_meta(user_dir)
+    if meta is None or meta['size'] != vectors.shape[0] or meta.get('generation', 0) != generation:
+        if meta is not None:
+            # Queries scan every row until sync_corpus has brought the index up to date
+            print(f"Index of {user_dir} is out of date ({meta['size']} rows of generation "
+                  f"{meta.get('generation', 0)}, the store has {vectors.shape[0]} of generation {generation}), "
+                  f"falling back to an exact scan")
+        index = ExactIndex(vectors)
+    else:
+        overrides = (params or {}).get(meta['kind'], {})
+        params = {**meta['params'], **{k: v for k, v in overrides.items() if k in meta['params']}}
+        index = INDEX_TYPES[meta['kind']].load_arrays(os.path.join(user_dir, INDEX_DIRNAME), vectors, params)
+    index.set_live(live)
+    return index
+
+
+def update_index(user_dir, vectors, generation=0, kind='auto', params=None):
+    """
+    Brings the persisted index up to date after rows were appended to the store, only
+    inserting the new rows. The index is rebuilt from scratch when there is none yet, when
+    it belongs to an older generation (i.e. the store was compacted since) or when "auto"
+    now resolves to another kind.
+    """
+    meta = _read_index_meta(user_dir)
+    resolved = resolve_kind(kind, vectors.shape[0])
+    if meta is not None and meta['kind'] == resolved and meta.get('generation', 0) == generation \
+            and meta['size'] <= vectors.shape[0]:
+        index = INDEX_TYPES[resolved].load_arrays(os.path.join(user_dir, INDEX_DIRNAME),
+                                                  vectors[:meta['size']], meta['params'])
+        index.add(vectors)
+    else:
+        index = build_index(vectors, kind, params)
+    save_index(index, user_dir, generation)
+    return index
+
+
+def index_nbytes(index):
+    """
+    Bytes held by the arrays of an index, including its (possibly memory-mapped) vectors.
+    Memory-mapped vectors of an index that only reads a few rows of them per query
+    (`full_scan = False`) are not counted, since they stay out of memory: a compressed
+    index counts its codes, scales and codebooks only.
+    """
+    seen = set()
+    if not getattr(index, 'full_scan', True) and isinstance(index.vectors, np.memmap):
+        seen.add(id(index.vectors))
+
+    def walk(value):
+        if isinstance(value, np.ndarray):
+            if id(value) in seen:
+                return 0
+            seen.add(id(value))
+            return value.nbytes
+        if isinstance(value, dict):
+            return sum(walk(item) for item in value.values())
+        if isinstance(value, (list, tuple)):
+            return sum(walk(item) for item in value)
+        return 0
+
+    return walk(vars(index))
+
+
+def recall_at_k(index, queries, k=10):
+    """
+    Fraction of the exact top-k passages that the index also returns, averaged over queries.
+    """
+    _, exact = ExactIndex(index.vectors).search(queries, k)
+    _, approx = index.search(queries, k)
+    hits = [len(set(e) & set(a)) for e, a in zip(exact, approx)]
+    return float(np.sum(hits)) / exact.size
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description='Recall and latency of the index backends on random data')
+    parser.add_argument('--size', type=int, default=20000)
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    # Clustered data resembles real embeddings far better than uniform noise
+    centers = rng.standard_normal((64, args.dim))
+    data = centers[rng.integers(0, 64, args.size)] + 0.5 * rng.standard_normal((args.size, args.dim))
+    data = normalize_rows(data.astype('float32'))
+    queries = data[rng.choice(args.size, args.queries)] + 0.1 * rng.standard_normal((args.queries, args.dim))
+
+    for kind in INDEX_TYPES:
+        t_start = time.perf_counter()
+        index = build_index(data, kind)
+        t_build = time.perf_counter() - t_start
+        t_start = time.perf_counter()
+        index.search(queries, args.k)
+        t_query = (time.perf_counter() - t_start) / args.queries
+        print(f'{kind:>6}: build {t_build:.2f}s, {t_query * 1000:.2f} ms/query, '
+              f'recall@{args.k} {recall_at_k(index, queries, args.k):.3f}')
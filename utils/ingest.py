@@ -0,0 +1,139 @@
+import os
+
+import streamlit as st
+
+from utils.access import GROUP_PREFIX, can_modify, can_read, private_documents, split_document
+from utils.config import Paths, Retrieval, Ingestion, Jobs, Crawl, Sharing
+from utils.embedder import make_embedder
+from utils.store import open_store, document_name
+from utils.corpus import clear_corpus, refresh_corpus
+from utils.jobs import get_job_queue
+from utils.pipeline import ingest_files
+
+
+def refresh_index(store):
+    with st.spinner('Updating Index...'):
+        refresh_corpus(store, Retrieval.INDEX_KIND, Retrieval.INDEX_PARAMS)
+
+
+def ingest_docs(paths, progress=None, group=''):
+    """
+    Converts, splits, embeds and stores the given files, then updates the index.
+    In a shared corpus, the documents are shared with `group` ('' keeps them private).
+    """
+    store = open_store(Paths.CORPUS_DIR)
+    embedder = make_embedder()
+    with st.spinner('Processing Docs...'):
+        num_docs, num_chunks = ingest_files(paths, store, embedder,
+                                            batch_chunks=Ingestion.BATCH_CHUNKS,
+                                            max_workers=Ingestion.SPLIT_WORKERS,
+                                            txt_dir=Paths.TXT_DIR,
+                                            progress=progress,
+                                            owner=st.session_state["username"] if Sharing.ENABLED else None,
+                                            group=group)
+    print(f"n_docs_input: {num_docs}\nn_docs_output: {num_chunks}")
+    print('Embedding cache:', embedder.cache.stats())
+    refresh_index(store)
+    return num_docs, num_chunks
+
+
+def submit_uploaded_docs(paths, group=''):
+    """
+    Queues files saved in the temp dir for ingestion in the background; returns the job id.
+    The files are moved to the docs dir as they are processed.
+    """
+    queue = get_job_queue()
+    queue.start_workers(Jobs.WORKERS)
+    return queue.submit(st.session_state["username"], paths, params={'group': group} if group else None)
+
+
+def submit_crawl(url, max_depth=Crawl.MAX_DEPTH, max_pages=Crawl.MAX_PAGES, group=''):
+    """
+    Queues a crawl of the site at `url`; its pages are ingested like uploaded files.
+    """
+    queue = get_job_queue()
+    queue.start_workers(Jobs.WORKERS)
+    return queue.submit_crawl(st.session_state["username"], url, max_depth, max_pages, group)
+
+
+def list_documents():
+    """
+    Returns {document: number of passages} of the documents the user can read.
+    """
+    documents = open_store(Paths.CORPUS_DIR).documents()
+    if Sharing.ENABLED:
+        documents = {document: n_chunks for document, n_chunks in documents.items()
+                     if can_read(document, st.session_state["username"])}
+    return documents
+
+
+def clear_documents():
+    """
+    Deletes the user's store and index; in a shared corpus only the user's private
+    documents, as those shared with a group are still read by its other members.
+    """
+    if not Sharing.ENABLED:
+        clear_corpus(Paths.USR_DIR)
+        return
+    store = open_store(Paths.CORPUS_DIR)
+    store.delete_documents(private_documents(store.documents(), st.session_state["username"]))
+    refresh_index(store)
+
+
+def remove_document_files(document):
+    # Files are named after the document without the scope of a shared corpus
+    document = split_document(document)[1]
+    # Chunk files are only left over from uploads made before chunks were streamed to the store
+    for chunk_file in os.listdir(Paths.CHK_DIR):
+        if document_name(chunk_file) == document:
+            os.remove(os.path.join(Paths.CHK_DIR, chunk_file))
+    txt_path = os.path.join(Paths.TXT_DIR, f"{document.split('.')[0]}.txt")
+    if os.path.exists(txt_path):
+        os.remove(txt_path)
+
+
+def check_owner(store, document):
+    """
+    In a shared corpus, raises PermissionError unless the user uploaded the document:
+    members of a group read each other's documents but only change their own.
+    """
+    if not Sharing.ENABLED:
+        return
+    meta = store.load()[1]
+    owners = meta.loc[meta['Document'] == document, 'Owner'].unique()
+    if not can_modify(document, st.session_state["username"], owners):
+        raise PermissionError(f'Only the user who uploaded "{document}" can change it')
+
+
+def remove_document(document):
+    """
+    Drops the chunks and vectors of a single document from the store and the index,
+    along with its files.
+    """
+    store = open_store(Paths.CORPUS_DIR)
+    check_owner(store, document)
+    store.delete_documents([document])
+    remove_document_files(document)
+    doc_path = os.path.join(Paths.DOC_DIR, split_document(document)[1])
+    if os.path.exists(doc_path):
+        os.remove(doc_path)
+    refresh_index(store)
+
+
+def replace_document(document, uploaded_file, progress=None):
+    """
+    Re-indexes a document from a new version of its file. Only this document is
+    re-chunked and re-embedded; its previous chunks are replaced in the store.
+    """
+    check_owner(open_store(Paths.CORPUS_DIR), document)
+    # Keep the stored name and scope, so the new chunks take over the old document's entry
+    scope, filename = split_document(document)
+    tmp_path = os.path.join(Paths.TMP_DIR, filename)
+    with open(tmp_path, "wb") as f:
+        f.write(uploaded_file.getbuffer())
+    remove_document_files(document)
+
+    group = scope[len(GROUP_PREFIX):] if scope.startswith(GROUP_PREFIX) else ''
+    num_docs, num_chunks = ingest_docs([tmp_path], progress, group)
+    os.replace(tmp_path, os.path.join(Paths.DOC_DIR, filename))
+    return num_chunks
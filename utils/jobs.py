@@ -0,0 +1,366 @@
+"""
+Persistent queue of document ingestion jobs, processed by a pool of worker threads.
+
+    queue = get_job_queue()
+    queue.start_workers()
+    job_id = queue.submit(username, paths)   # files saved in the user's temp dir
+    job_id = queue.submit_crawl(username, 'https://example.com/docs/', max_depth=1, max_pages=50)
+    queue.job(job_id)                        # {'status': 'running', 'n_files': 12, 'n_done': 5, ...}
+
+Jobs and their files are kept in SQLite, so they outlive the process that submitted
+them. A file is checkpointed as soon as its chunks are in the store, and is then moved
+to the user's docs dir. A job interrupted by a crash or a restart is taken over by the
+next worker that finds it without a heartbeat, and continues with the files not done yet.
+Crawl jobs save every crawled page as a text file and add it to the job's files as the
+crawl goes on; an interrupted crawl starts over, skipping the pages already stored.
+
+Jobs of one user run one after the other, since they write to the same store; jobs of
+different users run in parallel, also across processes sharing the database. Workers can
+run in a process of their own:
+
+    python -m utils.jobs [--workers 2]
+"""
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from utils.config import Crawl, Jobs, Retrieval, Ingestion, Sharing, UserPaths
+from utils.corpus import refresh_corpus
+from utils.crawler import Crawler, page_filename, save_page
+from utils.embedder import make_embedder
+from utils.pipeline import ingest_files
+from utils.store import open_store
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Kinds of jobs: uploaded files, or the pages of a crawled site
+FILES = 'files'
+CRAWL = 'crawl'
+
+JOB_COLUMNS = ('id', 'user', 'kind', 'params', 'status', 'created', 'started', 'finished', 'heartbeat',
+               'n_files', 'n_done', 'n_failed', 'n_chunks', 'error')
+
+
+class JobQueue:
+    """
+    Ingestion jobs of all users, stored in SQLite and shared by every process using `path`.
+    """
+
+    def __init__(self, path=Jobs.DB_PATH, stale_seconds=Jobs.STALE_SECONDS, poll_seconds=Jobs.POLL_SECONDS):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.stale_seconds = stale_seconds
+        self.poll_seconds = poll_seconds
+        self._lock = threading.Lock()
+        # Transactions are explicit, so a job is claimed by one worker of one process only
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS jobs '
+                           '(id INTEGER PRIMARY KEY AUTOINCREMENT, user TEXT NOT NULL, status TEXT NOT NULL, '
+                           'created REAL NOT NULL, started REAL, finished REAL, heartbeat REAL, '
+                           'n_files INTEGER NOT NULL, n_done INTEGER NOT NULL DEFAULT 0, '
+                           'n_failed INTEGER NOT NULL DEFAULT 0, n_chunks INTEGER NOT NULL DEFAULT 0, '
+                           'error TEXT, kind TEXT NOT NULL DEFAULT \'files\', params TEXT)')
+        # Queues created before crawl jobs have no kind and params
+        columns = {row[1] for row in self._conn.execute('PRAGMA table_info(jobs)')}
+        if 'kind' not in columns:
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN kind TEXT NOT NULL DEFAULT 'files'")
+            self._conn.execute('ALTER TABLE jobs ADD COLUMN params TEXT')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS job_files '
+                           '(job_id INTEGER NOT NULL, path TEXT NOT NULL, status TEXT NOT NULL, '
+                           'n_chunks INTEGER NOT NULL DEFAULT 0, error TEXT, PRIMARY KEY (job_id, path))')
+        # Jobs this process is working on, kept alive by the heartbeat thread
+        self._running = set()
+        self._workers = []
+        self._wakeup = threading.Event()
+
+    def _transaction(self, statements):
+        """
+        Runs `statements(conn)` in one write transaction and returns its result.
+        """
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                result = statements(self._conn)
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+            return result
+
+    @staticmethod
+    def _as_job(row):
+        job = dict(zip(JOB_COLUMNS, row))
+        job['params'] = json.loads(job['params']) if job['params'] else {}
+        return job
+
+    def submit(self, user, paths, kind=FILES, params=None):
+        """
+        Queues the files at `paths` for ingestion into the store of `user`. Returns the job id.
+        With Sharing.ENABLED, a 'group' in `params` shares the documents with that group.
+        """
+        paths = list(dict.fromkeys(paths))
+
+        def insert(conn):
+            cursor = conn.execute('INSERT INTO jobs (user, kind, params, status, created, n_files) '
+                                  'VALUES (?, ?, ?, ?, ?, ?)',
+                                  (user, kind, json.dumps(params) if params else None, QUEUED, time.time(),
+                                   len(paths)))
+            conn.executemany('INSERT INTO job_files (job_id, path, status) VALUES (?, ?, ?)',
+                             [(cursor.lastrowid, path, QUEUED) for path in paths])
+            return cursor.lastrowid
+
+        job_id = self._transaction(insert)
+        self._wakeup.set()
+        return job_id
+
+    def submit_crawl(self, user, url, max_depth=Crawl.MAX_DEPTH, max_pages=Crawl.MAX_PAGES, group=''):
+        """
+        Queues a crawl from `url`, ingesting the pages found into the store of `user`.
+        """
+        return self.submit(user, [], CRAWL, {'url': url, 'max_depth': max_depth, 'max_pages': max_pages,
+                                             'group': group})
+
+    def add_files(self, job_id, paths):
+        """
+        Adds files found while a job runs, e.g. crawled pages.
+        """
+        def insert(conn):
+            conn.executemany('INSERT OR IGNORE INTO job_files (job_id, path, status) VALUES (?, ?, ?)',
+                             [(job_id, path, QUEUED) for path in paths])
+            conn.execute('UPDATE jobs SET heartbeat = ?, '
+                         'n_files = (SELECT COUNT(*) FROM job_files WHERE job_id = jobs.id) WHERE id = ?',
+                         (time.time(), job_id))
+
+        self._transaction(insert)
+
+    def claim(self):
+        """
+        Marks the oldest queued job of a user with no running job as running and returns it,
+        or returns None. Running jobs without a recent heartbeat are queued again first.
+        """
+        def claim_next(conn):
+            now = time.time()
+            conn.execute('UPDATE jobs SET status = ? WHERE status = ? AND heartbeat < ?',
+                         (QUEUED, RUNNING, now - self.stale_seconds))
+            row = conn.execute(f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs WHERE status = ? AND user NOT IN '
+                               '(SELECT user FROM jobs WHERE status = ?) ORDER BY id LIMIT 1',
+                               (QUEUED, RUNNING)).fetchone()
+            if row is None:
+                return None
+            conn.execute('UPDATE jobs SET status = ?, started = COALESCE(started, ?), heartbeat = ? WHERE id = ?',
+                         (RUNNING, now, now, row[0]))
+            return dict(self._as_job(row), status=RUNNING)
+
+        return self._transaction(claim_next)
+
+    def pending_files(self, job_id):
+        with self._lock:
+            rows = self._conn.execute('SELECT path FROM job_files WHERE job_id = ? AND status = ? ORDER BY rowid',
+                                      (job_id, QUEUED)).fetchall()
+        return [path for (path,) in rows]
+
+    def checkpoint(self, job_id, files):
+        """
+        Records the outcome of files, given as (path, status, number of chunks, error).
+        """
+        def update(conn):
+            conn.executemany('UPDATE job_files SET status = ?, n_chunks = ?, error = ? WHERE job_id = ? AND path = ?',
+                             [(status, n_chunks, error, job_id, path) for path, status, n_chunks, error in files])
+            conn.execute('UPDATE jobs SET heartbeat = ?, '
+                         'n_done = (SELECT COUNT(*) FROM job_files WHERE job_id = jobs.id AND status != ?), '
+                         'n_failed = (SELECT COUNT(*) FROM job_files WHERE job_id = jobs.id AND status = ?), '
+                         'n_chunks = (SELECT COALESCE(SUM(n_chunks), 0) FROM job_files WHERE job_id = jobs.id) '
+                         'WHERE id = ?', (time.time(), QUEUED, FAILED, job_id))
+
+        self._transaction(update)
+
+    def finish(self, job_id, status=DONE, error=None):
+        self._transaction(lambda conn: conn.execute(
+                'UPDATE jobs SET status = ?, finished = ?, error = ? WHERE id = ?',
+                (status, time.time(), error, job_id)))
+
+    def heartbeat(self, job_ids):
+        if job_ids:
+            marks = ','.join('?' * len(job_ids))
+            self._transaction(lambda conn: conn.execute(
+                    f'UPDATE jobs SET heartbeat = ? WHERE id IN ({marks})', (time.time(), *job_ids)))
+
+    def job(self, job_id):
+        with self._lock:
+            row = self._conn.execute(f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs WHERE id = ?',
+                                     (job_id,)).fetchone()
+        return None if row is None else self._as_job(row)
+
+    def jobs(self, user, limit=10):
+        """
+        The latest jobs of a user, newest first.
+        """
+        with self._lock:
+            rows = self._conn.execute(f'SELECT {", ".join(JOB_COLUMNS)} FROM jobs WHERE user = ? '
+                                      'ORDER BY id DESC LIMIT ?', (user, limit)).fetchall()
+        return [self._as_job(row) for row in rows]
+
+    def files(self, job_id):
+        with self._lock:
+            rows = self._conn.execute('SELECT path, status, n_chunks, error FROM job_files WHERE job_id = ? '
+                                      'ORDER BY rowid', (job_id,)).fetchall()
+        return [dict(zip(('path', 'status', 'n_chunks', 'error'), row)) for row in rows]
+
+    # --- workers ---
+
+    def start_workers(self, n_workers=Jobs.WORKERS):
+        """
+        Starts the worker threads of this process, once; later calls do nothing.
+        """
+        with self._lock:
+            if self._workers:
+                return
+            self._workers = [threading.Thread(target=self._work, daemon=True, name=f'job-worker-{i}')
+                             for i in range(n_workers)]
+            self._workers.append(threading.Thread(target=self._beat, daemon=True, name='job-heartbeat'))
+        for thread in self._workers:
+            thread.start()
+
+    def _work(self):
+        while True:
+            try:
+                job = self.claim()
+            except sqlite3.OperationalError as e:
+                print(f'Job queue unavailable: {e}')
+                job = None
+            if job is None:
+                self._wakeup.wait(self.poll_seconds)
+                self._wakeup.clear()
+                continue
+            self._running.add(job['id'])
+            try:
+                run_job(self, job)
+                self.finish(job['id'], DONE)
+            except Exception as e:
+                print(f"Ingestion job {job['id']} failed: {e!r}")
+                self.finish(job['id'], FAILED, f'{type(e).__name__}: {e}')
+            finally:
+                self._running.discard(job['id'])
+
+    def _beat(self):
+        while True:
+            time.sleep(self.stale_seconds / 4)
+            try:
+                self.heartbeat(list(self._running))
+            except sqlite3.OperationalError as e:
+                print(f'Job heartbeat failed: {e}')
+
+
+def _crawled_pages(queue, job, url_dir):
+    """
+    Crawls the site of a crawl job and yields the pages not stored by an earlier run of the
+    job, saved as text files and added to the job.
+    """
+    os.makedirs(url_dir, exist_ok=True)
+    params = job['params']
+    known = {os.path.basename(file['path']) for file in queue.files(job['id'])}
+    crawler = Crawler(max_depth=params['max_depth'], max_pages=params['max_pages'],
+                      concurrency=Crawl.CONCURRENCY, timeout=Crawl.TIMEOUT,
+                      same_host=Crawl.SAME_HOST, max_bytes=Crawl.MAX_PAGE_BYTES)
+    for page in crawler.crawl(params['url']):
+        if page_filename(page.url) in known:
+            continue
+        path = save_page(page, url_dir)
+        queue.add_files(job['id'], [path])
+        yield path
+    print(f"Crawled {params['url']}:", crawler.stats)
+
+
+def run_job(queue, job):
+    """
+    Ingests the files of a job not checkpointed yet, then updates the indexes of the user's
+    corpus.
+    Crawl jobs crawl their site first, and their pages are ingested while it goes on.
+    """
+    paths = UserPaths(job['user'])
+    for dir_path in (paths.DOC_DIR, paths.TXT_DIR):
+        os.makedirs(dir_path, exist_ok=True)
+
+    def doc_path(path):
+        return os.path.join(paths.DOC_DIR, os.path.basename(path))
+
+    def on_stored(files):
+        for path, _ in files:
+            os.replace(path, doc_path(path))
+        queue.checkpoint(job['id'], [(path, DONE, n_chunks, None) for path, n_chunks in files])
+
+    def on_error(path, error):
+        os.remove(path)
+        queue.checkpoint(job['id'], [(path, FAILED, 0, f'{type(error).__name__}: {error}')])
+
+    files, missing = [], []
+    for path in queue.pending_files(job['id']):
+        if os.path.exists(path):
+            files.append(path)
+        elif os.path.exists(doc_path(path)):
+            # Moved by an interrupted run of this job just before its checkpoint
+            missing.append((path, DONE, 0, None))
+        else:
+            missing.append((path, FAILED, 0, 'File not found'))
+    if missing:
+        queue.checkpoint(job['id'], missing)
+
+    if job['kind'] == CRAWL:
+        files = itertools.chain(files, _crawled_pages(queue, job, paths.URL_DIR))
+
+    store = open_store(paths.CORPUS_DIR)
+    if files:
+        ingest_files(files, store, make_embedder(),
+                     batch_chunks=Ingestion.BATCH_CHUNKS,
+                     max_workers=Jobs.SPLIT_WORKERS,
+                     txt_dir=paths.TXT_DIR,
+                     on_stored=on_stored,
+                     on_error=on_error,
+                     owner=job['user'] if Sharing.ENABLED else None,
+                     group=(job['params'] or {}).get('group', ''))
+    refresh_corpus(store, Retrieval.INDEX_KIND, Retrieval.INDEX_PARAMS)
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    """
+    Process-wide queue, created on first use.
+    """
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue()
+    return _job_queue
+
+
+if __name__ == '__main__':
+    import argparse
+
+    import openai
+
+    from utils.warmup import warm_up
+
+    parser = argparse.ArgumentParser(description='Process queued document ingestion jobs')
+    parser.add_argument('--workers', type=int, default=Jobs.WORKERS)
+    parser.add_argument('--api-key-path', default='api.txt')
+    args = parser.parse_args()
+
+    if os.path.exists(args.api_key_path):
+        openai.api_key_path = args.api_key_path
+    warm_up()
+    get_job_queue().start_workers(args.workers)
+    while True:
+        time.sleep(3600)
@@ -0,0 +1,213 @@
+import json
+import os
+import re
+from collections import Counter
+
+import numpy as np
+from numpy import ndarray
+
+from utils.ai import top_k_from_scores
+
+
+LEXICAL_META_FILE = 'bm25.json'
+# Words, numbers and identifiers such as "AB-1234", "v2.1" or "file_name"
+TOKEN_PATTERN = re.compile(r'\w+(?:[-./]\w+)*')
+PART_PATTERN = re.compile(r'[-./_]')
+
+
+def tokenize(text):
+    """
+    Lowercased terms of a text. Compound identifiers are kept whole and also split into
+    their parts, so "AB-1234" matches queries for "ab-1234" as well as for "1234".
+    """
+    terms = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        terms.append(token)
+        parts = PART_PATTERN.split(token)
+        if len(parts) > 1:
+            terms.extend(part for part in parts if part)
+    return terms
+
+
+class BM25Index:
+    """
+    Okapi BM25 over an inverted index of the passages.
+
+    The postings of all terms are stored back to back in flat arrays (passage row and term
+    frequency), sorted by term; `offsets[t]:offsets[t + 1]` is the slice of term t. Only
+    the vocabulary, mapping a term to its id, is a dict.
+    """
+    kind = 'bm25'
+
+    def __init__(self, texts=(), k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.terms = []
+        self.vocabulary = {}
+        self.offsets = np.zeros(1, dtype='int64')
+        self.postings = np.empty(0, dtype='int32')
+        self.frequencies = np.empty(0, dtype='uint16')
+        self.lengths = np.empty(0, dtype='int32')
+        self.live = None
+        self.add(texts)
+
+    def __len__(self):
+        return self.lengths.shape[0]
+
+    def set_live(self, live):
+        self.live = None if live is None or live.all() else live
+
+    def _term_id(self, term):
+        term_id = self.vocabulary.get(term)
+        if term_id is None:
+            term_id = self.vocabulary[term] = len(self.terms)
+            self.terms.append(term)
+        return term_id
+
+    def add(self, texts):
+        """
+        Indexes `texts` as the passages following the already indexed ones.
+        """
+        n_old = len(self)
+        term_ids, rows, frequencies, lengths = [], [], [], []
+        for row, text in enumerate(texts, start=n_old):
+            counts = Counter(tokenize(text))
+            term_ids.extend(self._term_id(term) for term in counts)
+            rows.extend([row] * len(counts))
+            frequencies.extend(counts.values())
+            lengths.append(sum(counts.values()))
+        if not lengths:
+            return
+
+        old_term_ids = np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+        term_ids = np.concatenate([old_term_ids, np.asarray(term_ids, dtype='int64')])
+        rows = np.concatenate([self.postings, np.asarray(rows, dtype='int32')])
+        frequencies = np.concatenate([self.frequencies,
+                                      np.minimum(frequencies, np.iinfo('uint16').max).astype('uint16')])
+        order = np.lexsort((rows, term_ids))
+        self.postings, self.frequencies = rows[order], frequencies[order]
+        self.offsets = np.zeros(len(self.terms) + 1, dtype='int64')
+        np.cumsum(np.bincount(term_ids, minlength=len(self.terms)), out=self.offsets[1:])
+        self.lengths = np.concatenate([self.lengths, np.asarray(lengths, dtype='int32')])
+
+    def scores(self, query):
+        """
+        BM25 score of every passage for a query text.
+        """
+        scores = np.zeros(len(self), dtype='float32')
+        term_ids = [self.vocabulary[term] for term in set(tokenize(query)) if term in self.vocabulary]
+        if not term_ids:
+            return scores
+        n_docs = len(self)
+        norms = self.k1 * (1 - self.b + self.b * self.lengths / max(self.lengths.mean(), 1))
+        for term_id in term_ids:
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            rows = self.postings[start:end]
+            frequencies = self.frequencies[start:end].astype('float32')
+            idf = np.log(1 + (n_docs - (end - start) + 0.5) / ((end - start) + 0.5))
+            scores[rows] += idf * frequencies * (self.k1 + 1) / (frequencies + norms[rows])
+        return scores
+
+    def search(self, queries, k: int = 3, allowed: ndarray = None) -> tuple[ndarray, ndarray]:
+        """
+        Same contract as the vector indexes, for one query text or a list of them.
+        Passages sharing no term with a query, or not `allowed`, are never returned.
+        """
+        queries = [queries] if isinstance(queries, str) else list(queries)
+        all_scores = np.full((len(queries), k), -np.inf, dtype='float32')
+        all_indexes = np.full((len(queries), k), -1, dtype='int64')
+        for qi, query in enumerate(queries):
+            scores = self.scores(query)
+            if self.live is not None:
+                scores[~self.live] = 0
+            if allowed is not None:
+                scores[~allowed] = 0
+            top_scores, top = top_k_from_scores(scores[None, :], k)
+            found = top_scores[0] > 0
+            all_scores[qi, :found.sum()] = top_scores[0][found]
+            all_indexes[qi, :found.sum()] = top[0][found]
+        return all_scores, all_indexes
+
+    def save(self, index_dir, generation=0):
+        from utils.index import _save_array
+
+        os.makedirs(index_dir, exist_ok=True)
+        for name in ('offsets', 'postings', 'frequencies', 'lengths'):
+            _save_array(index_dir, f'bm25_{name}', getattr(self, name))
+        meta = {'size': len(self), 'generation': generation, 'k1': self.k1, 'b': self.b, 'terms': self.terms}
+        with open(os.path.join(index_dir, LEXICAL_META_FILE) + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(os.path.join(index_dir, LEXICAL_META_FILE) + '.tmp', os.path.join(index_dir, LEXICAL_META_FILE))
+
+    @classmethod
+    def load(cls, index_dir, meta):
+        from utils.index import _load_array
+
+        index = cls(k1=meta['k1'], b=meta['b'])
+        index.terms = meta['terms']
+        index.vocabulary = {term: i for i, term in enumerate(index.terms)}
+        for name in ('offsets', 'postings', 'frequencies', 'lengths'):
+            setattr(index, name, np.asarray(_load_array(index_dir, f'bm25_{name}')))
+        return index
+
+
+def _read_lexical_meta(index_dir):
+    meta_path = os.path.join(index_dir, LEXICAL_META_FILE)
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def load_lexical(user_dir, texts, generation=0, live=None):
+    """
+    Loads the persisted BM25 index of a user, or builds one from `texts` (the ChunkTexts
+    of the store, only read then) when there is none or it was built for another version
+    of the corpus.
+    """
+    from utils.index import INDEX_DIRNAME
+
+    index_dir = os.path.join(user_dir, INDEX_DIRNAME)
+    meta = _read_lexical_meta(index_dir)
+    if meta is None or meta['size'] != len(texts) or meta['generation'] != generation:
+        index = BM25Index(texts)
+    else:
+        index = BM25Index.load(index_dir, meta)
+    index.set_live(live)
+    return index
+
+
+def update_lexical(user_dir, texts, generation=0):
+    """
+    Brings the persisted BM25 index up to date after passages were appended to the store,
+    tokenizing only the new ones. It is rebuilt after compaction renumbered the rows.
+    """
+    from utils.index import INDEX_DIRNAME
+
+    index_dir = os.path.join(user_dir, INDEX_DIRNAME)
+    meta = _read_lexical_meta(index_dir)
+    if meta is not None and meta['generation'] == generation and meta['size'] <= len(texts):
+        index = BM25Index.load(index_dir, meta)
+        index.add(texts[meta['size']:])
+    else:
+        index = BM25Index(texts)
+    index.save(index_dir, generation)
+    return index
+
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """
+    Merges several rankings of passage rows (arrays, best first, -1 for padding) into one
+    by summing 1 / (k + rank) over the rankings a row appears in.
+    Returns (fused scores, rows), best first.
+    """
+    rows = np.concatenate([np.asarray(ranking).ravel() for ranking in rankings])
+    ranks = np.concatenate([np.arange(np.asarray(ranking).size) for ranking in rankings])
+    valid = rows >= 0
+    rows, ranks = rows[valid], ranks[valid]
+    if rows.size == 0:
+        return np.empty(0, dtype='float32'), np.empty(0, dtype='int64')
+    unique_rows, positions = np.unique(rows, return_inverse=True)
+    scores = np.bincount(positions, weights=1.0 / (k + 1 + ranks)).astype('float32')
+    order = np.argsort(-scores, kind='stable')
+    return scores[order], unique_rows[order]
@@ -0,0 +1,177 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import pandas as pd
+
+from utils.access import shared_document
+from utils.tracing import record, span
+
+
+ALLOWED_SUFFIXES = ['.pdf', '.txt', '.docx']
+
+PREPROCESSOR_PARAMS = dict(
+        clean_empty_lines=True,
+        clean_whitespace=True,
+        clean_header_footer=False,
+        split_by="word",
+        split_length=200,
+        split_overlap=20,
+        split_respect_sentence_boundary=True,
+)
+
+# Set up once per worker process by _init_worker
+_converters = None
+_preprocessor = None
+
+
+def _init_worker():
+    global _converters, _preprocessor
+    if _preprocessor is not None:
+        # Inherited from the parent process, see prepare_preprocessor
+        return
+    from haystack.nodes import PreProcessor, PDFToTextConverter, TextConverter, DocxToTextConverter
+
+    _converters = {'.pdf': PDFToTextConverter, '.txt': TextConverter, '.docx': DocxToTextConverter}
+    _preprocessor = PreProcessor(**PREPROCESSOR_PARAMS)
+
+
+def prepare_preprocessor():
+    """
+    Sets up the converters and the PreProcessor in this process. Worker processes forked
+    afterwards inherit them instead of importing haystack again.
+    """
+    _init_worker()
+
+
+def split_file(path, txt_dir=None):
+    """
+    Converts one file to text and splits it into passages, the same way
+    haystack's convert_files_to_docs(split_paragraphs=True) + PreProcessor did for
+    a whole directory. Returns a DataFrame with Document, Filename, Content and Tokens.
+    """
+    from haystack import Document
+    from haystack.utils import clean_wiki_text
+    from utils.embedder import count_tokens
+
+    if _preprocessor is None:
+        _init_worker()
+    name = os.path.basename(path)
+    converter = _converters[os.path.splitext(name)[1].lower()]()
+    text = clean_wiki_text(converter.convert(file_path=path, meta=None)[0].content)
+
+    if txt_dir is not None:
+        with open(os.path.join(txt_dir, f"{name.split('.')[0]}.txt"), 'w', encoding="utf-8") as f:
+            f.write(text)
+
+    paragraphs = [Document(content=p, meta={'name': name}) for p in text.split("\n\n") if p.strip()]
+    chunks = _preprocessor.process(paragraphs) if paragraphs else []
+    return pd.DataFrame({'Document': name,
+                         'Filename': [f"{name}_{i}.txt" for i in range(len(chunks))],
+                         'Content': [chunk.content for chunk in chunks],
+                         'Tokens': [count_tokens(chunk.content) for chunk in chunks]},
+                        columns=['Document', 'Filename', 'Content', 'Tokens'])
+
+
+def _timed_split_file(path, txt_dir=None):
+    # Worker processes have their own tracer, so the duration is returned to the parent
+    start = time.perf_counter()
+    chunks = split_file(path, txt_dir)
+    return chunks, time.perf_counter() - start
+
+
+def list_files(dir_path):
+    return sorted(os.path.join(dir_path, f) for f in os.listdir(dir_path)
+                  if os.path.splitext(f)[1].lower() in ALLOWED_SUFFIXES)
+
+
+def iter_file_chunks(paths, max_workers=None, txt_dir=None, return_exceptions=False):
+    """
+    Yields (path, chunks DataFrame) for every file as soon as a worker process has split it.
+    At most two files per worker are in flight, so memory stays bounded for any number of files.
+    `paths` may be an iterator, e.g. of pages being crawled; it is consumed as workers free up.
+    With `return_exceptions`, a file that cannot be converted yields its exception in place
+    of the chunks and the other files go on.
+    """
+    paths = iter(paths)
+    max_workers = max_workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker) as executor:
+        pending = {}
+        exhausted = False
+        while not exhausted or pending:
+            while not exhausted and len(pending) < 2 * max_workers:
+                path = next(paths, None)
+                if path is None:
+                    exhausted = True
+                    break
+                pending[executor.submit(_timed_split_file, path, txt_dir)] = path
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = pending.pop(future)
+                try:
+                    chunks, seconds = future.result()
+                except Exception as e:
+                    if not return_exceptions:
+                        raise
+                    yield path, e
+                    continue
+                record('ingest.split_file', seconds)
+                yield path, chunks
+
+
+def ingest_files(paths, store, embedder, batch_chunks=1000, max_workers=None, txt_dir=None,
+                 progress=None, on_stored=None, on_error=None, owner=None, group=''):
+    """
+    Streams files through text -> chunks -> embeddings -> store.
+
+    Chunks are embedded and appended to `store` in batches of about `batch_chunks`. A
+    document is never split across batches, since appending replaces a document's
+    earlier chunks. `progress(done, total)` is called after every file; `paths` may be an
+    iterator, in which case `total` is None.
+
+    `on_stored([(path, number of chunks)])` is called once the chunks of these files are
+    in the store, so it can checkpoint them. With `on_error(path, exception)`, files that
+    cannot be converted are reported and skipped instead of failing the whole run.
+    With `owner`, `store` is the shared corpus (see utils/access.py): the chunks are
+    attributed to `owner`, shared with `group`, and their documents named accordingly.
+    Returns (number of documents, number of chunks).
+    """
+    total = len(paths) if isinstance(paths, (list, tuple)) else None
+    buffer, buffered_paths, n_buffered, n_docs, n_chunks = [], [], 0, 0, 0
+
+    def flush():
+        if buffer:
+            chunks = pd.concat(buffer, ignore_index=True)
+            if owner is not None:
+                chunks['Document'] = [shared_document(document, owner, group) for document in chunks['Document']]
+                chunks['Owner'], chunks['Group'] = owner, group
+            with span('ingest.embed'):
+                vectors = embedder.embed(chunks['Content'].to_list())
+            with span('ingest.store_append'):
+                store.append(chunks, vectors)
+            buffer.clear()
+        if on_stored is not None:
+            on_stored(list(buffered_paths))
+        buffered_paths.clear()
+
+    file_chunks = iter_file_chunks(paths, max_workers, txt_dir, return_exceptions=on_error is not None)
+    for i, (path, chunks) in enumerate(file_chunks):
+        if isinstance(chunks, Exception):
+            on_error(path, chunks)
+        else:
+            if len(chunks):
+                buffer.append(chunks)
+                n_buffered += len(chunks)
+                n_docs += 1
+                n_chunks += len(chunks)
+            buffered_paths.append((path, len(chunks)))
+        if n_buffered >= batch_chunks:
+            flush()
+            n_buffered = 0
+        if progress is not None:
+            progress(i + 1, total)
+    if buffered_paths:
+        flush()
+    return n_docs, n_chunks
@@ -0,0 +1,306 @@
+import time
+
+import numpy as np
+from tenacity import retry, wait_random_exponential, stop_after_attempt
+
+from utils.ai import normalize_rows
+from utils.embedder import count_tokens
+from utils.lexical import reciprocal_rank_fusion
+from utils.store import UNKNOWN_TOKENS
+from utils.tracing import record, span, traced
+
+
+# Passages are split with a 20 word overlap (see pipeline.PREPROCESSOR_PARAMS); allow some slack
+MAX_OVERLAP_WORDS = 40
+# A passage is dropped when this share of its word 5-grams is already in the context
+DUPLICATE_RATIO = 0.8
+SHINGLE_LEN = 5
+
+# The prompt asks for the answer followed by its source after this marker
+REF_MARKER = 'Ref:'
+PROMPT_HEADER = """Answer the question as truthfully as possible using the provided context, \
+and include the parts of the context that are used to generate the answer after the answer starting with "\nRef:". \
+If the answer is not contained within the text below, say "I don't know."\n\nContext:\n"""
+# Put in front of every passage of the context
+SEPARATOR = "\n* "
+
+
+def _shingles(words):
+    return {tuple(words[i:i + SHINGLE_LEN]) for i in range(max(1, len(words) - SHINGLE_LEN + 1))}
+
+
+def _overlap(head, tail):
+    """
+    Length of the longest run of words that ends `head` and starts `tail`.
+    """
+    for n in range(min(MAX_OVERLAP_WORDS, len(head), len(tail)), 0, -1):
+        if head[-n:] == tail[:n]:
+            return n
+    return 0
+
+
+def trim_overlap(words, chosen_words):
+    """
+    Removes the words a passage shares with the edges of already chosen neighbouring passages.
+    """
+    for other in chosen_words:
+        n = _overlap(other, words)
+        if n:
+            words = words[n:]
+        n = _overlap(words, other)
+        if n:
+            words = words[:-n]
+    return words
+
+
+@traced()
+def pack_context(candidates, max_tokens, separator_len=0):
+    """
+    Greedily fills a token budget with the best candidate passages.
+
+    `candidates` is a DataFrame sorted best first, with Content and Tokens columns and
+    optionally Document. Overlap with already chosen passages of the same document is
+    trimmed and near-duplicate passages are skipped. A passage that does not fit is
+    skipped, so a shorter one further down may still use the remaining budget.
+
+    Returns (chosen rows of `candidates`, their texts as they go into the prompt).
+    """
+    chosen_rows, chosen_texts = [], []
+    chosen_words = {}
+    seen_shingles = set()
+    used_tokens = 0
+
+    for row, candidate in enumerate(candidates.itertuples(index=False)):
+        document = getattr(candidate, 'Document', None)
+        words = candidate.Content.split()
+        shingles = _shingles(words)
+        if shingles and len(shingles & seen_shingles) >= DUPLICATE_RATIO * len(shingles):
+            continue
+
+        trimmed = trim_overlap(words, chosen_words.get(document, []))
+        if not trimmed:
+            continue
+        text = ' '.join(trimmed)
+        n_tokens = candidate.Tokens
+        if len(trimmed) != len(words) or n_tokens == UNKNOWN_TOKENS:
+            n_tokens = count_tokens(text)
+
+        if used_tokens + n_tokens + separator_len > max_tokens:
+            continue
+        used_tokens += n_tokens + separator_len
+        chosen_rows.append(row)
+        chosen_texts.append(text)
+        chosen_words.setdefault(document, []).append(words)
+        seen_shingles |= shingles
+
+    return candidates.iloc[chosen_rows], chosen_texts
+
+
+def _found_rows(dataset, scores, rows):
+    """
+    The metadata of the found rows with their Score, and their Content read from the store.
+    """
+    meta, texts = dataset[1], dataset[3]
+    # Fewer than k passages may be left after deletions
+    valid = (rows >= 0) & np.isfinite(scores)
+    with span('read_texts'):
+        contents = texts[rows[valid]]
+    return meta.iloc[rows[valid]].assign(Content=contents, Score=scores[valid])
+
+
+@traced()
+def find_top_k_similar_vectors(dataset, input_vector, k, allowed=None):
+    scores, top_k_indexes = dataset[0].search(input_vector, k, allowed)
+    return _found_rows(dataset, scores[0], top_k_indexes[0])
+
+
+def _fused_rows(dataset, vector_scores, vector_rows, lexical_rows, k, rrf_k):
+    vector_rows = np.where(np.isfinite(vector_scores), vector_rows, -1)
+    scores, rows = reciprocal_rank_fusion([vector_rows, lexical_rows], rrf_k)
+    return _found_rows(dataset, scores[:k], rows[:k])
+
+
+@traced()
+def find_top_k_candidates(dataset, question, question_vector, k, mode='hybrid', rrf_k=60, allowed=None):
+    """
+    The k best passages for a question, with their Score.
+
+    `mode` is 'vector', 'lexical' (BM25 only, needs no embedding) or 'hybrid', which fuses
+    the vector and BM25 rankings with reciprocal rank fusion. Without a question vector,
+    e.g. when the embedding API is down, retrieval is lexical. With the boolean row mask
+    `allowed` (see access.access_mask), only those passages are searched.
+    """
+    index, lexical = dataset[0], dataset[2]
+    if question_vector is None:
+        mode = 'lexical'
+    if mode == 'vector':
+        return find_top_k_similar_vectors(dataset, question_vector, k, allowed)
+    with span('lexical_search'):
+        lexical_scores, lexical_rows = lexical.search(question, k, allowed)
+    if mode == 'lexical':
+        return _found_rows(dataset, lexical_scores[0], lexical_rows[0])
+    with span('vector_search'):
+        vector_scores, vector_rows = index.search(question_vector, k, allowed)
+    return _fused_rows(dataset, vector_scores[0], vector_rows[0], lexical_rows[0], k, rrf_k)
+
+
+@traced()
+def find_top_k_candidates_batch(dataset, questions, question_vectors, k, mode='hybrid', rrf_k=60,
+                                allowed=None):
+    """
+    find_top_k_candidates for a list of questions. The vector index is searched for all of
+    them at once, which for the exact index is a single matrix product; `question_vectors`
+    is a (questions, dim) matrix, or None for keyword search only.
+    """
+    index, lexical = dataset[0], dataset[2]
+    if question_vectors is None:
+        mode = 'lexical'
+    if mode != 'lexical':
+        with span('vector_search'):
+            vector_scores, vector_rows = index.search(question_vectors, k, allowed)
+    candidates = []
+    for i, question in enumerate(questions):
+        if mode == 'vector':
+            candidates.append(_found_rows(dataset, vector_scores[i], vector_rows[i]))
+            continue
+        with span('lexical_search'):
+            lexical_scores, lexical_rows = lexical.search(question, k, allowed)
+        if mode == 'lexical':
+            candidates.append(_found_rows(dataset, lexical_scores[0], lexical_rows[0]))
+        else:
+            candidates.append(_fused_rows(dataset, vector_scores[i], vector_rows[i], lexical_rows[0], k, rrf_k))
+    return candidates
+
+
+def mmr_order(relevance, similarity, k, mmr_lambda):
+    """
+    Greedy maximal marginal relevance: positions of up to k items, each one maximizing
+    mmr_lambda * relevance - (1 - mmr_lambda) * its highest similarity to the items
+    chosen before it. `similarity` is the (n, n) Gram matrix of the items.
+    """
+    n = len(relevance)
+    chosen = []
+    redundancy = np.zeros(n)
+    available = np.ones(n, dtype=bool)
+    for _ in range(min(k, n)):
+        marginal = np.where(available, mmr_lambda * relevance - (1 - mmr_lambda) * redundancy, -np.inf)
+        best = int(np.argmax(marginal))
+        chosen.append(best)
+        available[best] = False
+        redundancy = np.maximum(redundancy, similarity[best])
+    return chosen
+
+
+@traced()
+def mmr_rerank(dataset, candidates, k, mmr_lambda=0.7):
+    """
+    The k candidates chosen by maximal marginal relevance, in the order they were chosen.
+
+    `candidates` are rows of the corpus metadata with their Score, as returned by
+    find_top_k_candidates. Their similarities to each other are the cosines of their
+    vectors, computed as one Gram matrix. Scores are scaled to [0, 1] over the candidates,
+    so that they weigh against the cosines in every retrieval mode. A `mmr_lambda` of 1
+    keeps the ranking by score; lower values favour passages unlike those already chosen.
+    """
+    if len(candidates) <= 1:
+        return candidates.head(k)
+    # Compressed indexes keep the vectors as stored, which may not be unit length
+    vectors = normalize_rows(dataset[0].vectors[candidates.index.to_numpy()])
+    similarity = vectors @ vectors.T
+    scores = candidates['Score'].to_numpy(dtype='float64')
+    spread = scores.max() - scores.min()
+    relevance = (scores - scores.min()) / spread if spread > 0 else np.ones(len(scores))
+    return candidates.iloc[mmr_order(relevance, similarity, k, mmr_lambda)]
+
+
+def _packed(dataset, candidates, max_tokens, separator_len, mmr_lambda, mmr_k):
+    if mmr_lambda is not None:
+        candidates = mmr_rerank(dataset, candidates, mmr_k or len(candidates), mmr_lambda)
+    found, texts = pack_context(candidates, max_tokens, separator_len)
+    return found.assign(Text=texts)
+
+
+def find_related_contents(dataset, question, question_vector, pool, max_tokens, separator_len=0,
+                          mode='hybrid', rrf_k=60, mmr_lambda=None, mmr_k=None, allowed=None):
+    """
+    Packs the best of the `pool` passages most related to the question into `max_tokens`.
+    With `mmr_lambda`, the pool is first reranked by maximal marginal relevance to its
+    `mmr_k` most diverse passages (see mmr_rerank). Returns the chosen rows of the corpus
+    metadata with their Score and, as Text, the passage as it goes into the prompt.
+    """
+    candidates = find_top_k_candidates(dataset, question, question_vector, pool, mode, rrf_k, allowed)
+    return _packed(dataset, candidates, max_tokens, separator_len, mmr_lambda, mmr_k)
+
+
+def find_related_contents_batch(dataset, questions, question_vectors, pool, max_tokens, separator_len=0,
+                                mode='hybrid', rrf_k=60, mmr_lambda=None, mmr_k=None, allowed=None):
+    """
+    find_related_contents for a list of questions, retrieving for all of them at once.
+    """
+    batch = find_top_k_candidates_batch(dataset, questions, question_vectors, pool, mode, rrf_k, allowed)
+    return [_packed(dataset, candidates, max_tokens, separator_len, mmr_lambda, mmr_k) for candidates in batch]
+
+
+@traced()
+def construct_prompt(question: str, most_relevant_document_sections) -> str:
+    chosen_sections = []
+    for document_section in most_relevant_document_sections:
+        chosen_sections.append(SEPARATOR + document_section.replace("\n", " "))
+    return PROMPT_HEADER + "".join(chosen_sections) + "\n\n Q: " + question + "\n A:"
+
+
+def split_answer(text, final=True):
+    """
+    Splits completion text into (answer, reference); reference is None until the marker
+    has been seen. While streaming (`final=False`), a trailing partial marker such as
+    "Re" is held back so it never flashes up in the answer.
+    """
+    if REF_MARKER in text:
+        answer, reference = text.split(REF_MARKER, 1)
+        return answer.strip(" \n"), reference.strip(" \n")
+    if not final:
+        for n in range(len(REF_MARKER) - 1, 0, -1):
+            if text.endswith(REF_MARKER[:n]):
+                text = text[:-n]
+                break
+    return text.strip(" \n"), None
+
+
+@traced('completion')
+@retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(6))
+def complete(prompt, params, **api_params):
+    """
+    The completion text for a prompt, as one blocking request retried on errors.
+    """
+    import openai
+
+    response = openai.Completion.create(prompt=prompt, **params, **api_params)
+    return response["choices"][0]["text"]
+
+
+def stream_completion(prompt, params, **api_params):
+    """
+    Yields the completion text received so far, every time a token arrives.
+
+    If streaming fails, the completion is requested again with `complete` and its full
+    text is yielded last, replacing whatever was yielded before. `api_params`
+    (api_base, api_key) are passed to openai, e.g. to point at a local test server.
+    """
+    import openai
+    import requests
+
+    text = ''
+    start = time.perf_counter()
+    try:
+        for chunk in openai.Completion.create(prompt=prompt, stream=True, **params, **api_params):
+            if not text:
+                record('completion_first_token', time.perf_counter() - start)
+            text += chunk["choices"][0]["text"]
+            yield text
+        record('completion_stream', time.perf_counter() - start)
+        return
+    except (openai.error.OpenAIError, requests.exceptions.RequestException):
+        # Counted as an error of the span, then answered by a blocking request
+        record('completion_stream', time.perf_counter() - start, error=True)
+
+    yield complete(prompt, params, **api_params)
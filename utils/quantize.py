@@ -0,0 +1,283 @@
+import numpy as np
+from numpy import ndarray
+
+from utils.ai import normalize_rows, top_k_from_scores
+
+
+def _kmeans(data, n_clusters, n_iter, rng):
+    """
+    Plain (Euclidean) k-means run independently on every slice data[i] of a
+    (n_slices, n_rows, dim) array. Returns the (n_slices, n_clusters, dim) centroids.
+    """
+    n_slices, n_rows, dim = data.shape
+    n_clusters = min(n_clusters, n_rows)
+    centroids = data[:, rng.choice(n_rows, n_clusters, replace=False)].copy()
+    # Cluster ids made unique across slices, so one bincount covers all of them
+    offsets = (np.arange(n_slices) * n_clusters)[:, None]
+    for _ in range(n_iter):
+        assignments = (_nearest(data, centroids) + offsets).ravel()
+        counts = np.bincount(assignments, minlength=n_slices * n_clusters)
+        sums = np.stack([np.bincount(assignments, weights=data[:, :, j].ravel(),
+                                     minlength=n_slices * n_clusters) for j in range(dim)], axis=1)
+        empty = counts == 0
+        if empty.any():
+            # Restart empty clusters from random rows of their slice
+            slices = np.flatnonzero(empty) // n_clusters
+            sums[empty] = data[slices, rng.integers(0, n_rows, len(slices))]
+            counts[empty] = 1
+        centroids = (sums / counts[:, None]).reshape(n_slices, n_clusters, dim).astype(data.dtype)
+    return centroids
+
+
+def _nearest(data, centroids, block=512):
+    """
+    Id of the nearest centroid for every row, batched over the leading axis.
+    """
+    # argmin |x - c|^2 == argmax x.c - |c|^2 / 2
+    half_norms = 0.5 * (centroids ** 2).sum(axis=-1)[..., None, :]
+    transposed = np.swapaxes(centroids, -1, -2)
+    nearest = np.empty(data.shape[:-1], dtype='int64')
+    for start in range(0, data.shape[-2], block):
+        scores = data[..., start:start + block, :] @ transposed
+        scores -= half_norms
+        nearest[..., start:start + block] = scores.argmax(axis=-1)
+    return nearest
+
+
+class QuantizedIndex:
+    """
+    Exhaustive scan over compressed vectors, followed by rescoring the best `rescore`
+    candidates against the full-precision vectors.
+
+    Only the compressed codes are read for every query; the float32 vectors (usually
+    memory-mapped from the store) are touched for the few rescored rows only. They are
+    normalized when encoded and row by row when rescored, so loading an index does not
+    read them. Subclasses define how vectors are encoded and scored.
+    """
+    # Arrays persisted next to the index metadata
+    arrays = ('codes',)
+    # The float32 vectors are only read row by row, so memory-mapped ones are not resident
+    full_scan = False
+    # Rows decoded at once while scanning
+    SCAN_BLOCK = 16384
+
+    def __init__(self, vectors: ndarray, rescore: int = 100, train: bool = True, **params):
+        self.vectors = np.asanyarray(vectors, dtype='float32')
+        self.rescore = rescore
+        self.params = {'rescore': rescore, **params}
+        self.live = None
+        if train:
+            self._fit()
+
+    def __len__(self):
+        return self.vectors.shape[0]
+
+    @property
+    def codes_nbytes(self):
+        return sum(getattr(self, name).nbytes for name in self.arrays)
+
+    def set_live(self, live):
+        self.live = None if live is None or live.all() else live
+
+    def _fit(self):
+        for name, value in self._encode(normalize_rows(self.vectors)).items():
+            setattr(self, name, value)
+
+    def _encode(self, vectors):
+        """
+        Returns {array name: one entry per row of `vectors`}.
+        """
+        raise NotImplementedError
+
+    def _prepare(self, queries):
+        """
+        Per-query data computed once before scanning, by default the queries themselves.
+        """
+        return queries
+
+    def _scan(self, queries, start, end):
+        """
+        Approximate scores of rows [start, end) for a batch of prepared queries.
+        """
+        raise NotImplementedError
+
+    def add(self, vectors):
+        """
+        Encodes the rows of `vectors` past the indexed ones; trained codebooks are kept.
+        """
+        n_old = len(self)
+        self.vectors = np.asanyarray(vectors, dtype='float32')
+        for name, value in self._encode(normalize_rows(self.vectors[n_old:])).items():
+            setattr(self, name, np.concatenate([getattr(self, name), value]))
+
+    def approximate_scores(self, queries, allowed=None):
+        queries = normalize_rows(np.atleast_2d(np.asarray(queries, dtype='float32')))
+        prepared = self._prepare(queries)
+        scores = np.empty((queries.shape[0], len(self)), dtype='float32')
+        for start in range(0, len(self), self.SCAN_BLOCK):
+            end = min(start + self.SCAN_BLOCK, len(self))
+            scores[:, start:end] = self._scan(prepared, start, end)
+        if self.live is not None:
+            scores[:, ~self.live] = -np.inf
+        if allowed is not None:
+            scores[:, ~allowed] = -np.inf
+        return scores
+
+    def search(self, queries, k: int = 3, allowed: ndarray = None) -> tuple[ndarray, ndarray]:
+        queries = normalize_rows(np.atleast_2d(np.asarray(queries, dtype='float32')))
+        approximate, candidates = top_k_from_scores(self.approximate_scores(queries, allowed),
+                                                    max(k, self.rescore))
+
+        all_scores = np.full((queries.shape[0], k), -np.inf, dtype='float32')
+        all_indexes = np.full((queries.shape[0], k), -1, dtype='int64')
+        for qi, (query, rows) in enumerate(zip(queries, candidates)):
+            rows = np.sort(rows[np.isfinite(approximate[qi])])
+            if rows.size == 0:
+                continue
+            scores = normalize_rows(self.vectors[rows]) @ query
+            top_scores, top = top_k_from_scores(scores[None, :], k)
+            all_scores[qi, :top.shape[1]] = top_scores[0]
+            all_indexes[qi, :top.shape[1]] = rows[top[0]]
+        return all_scores, all_indexes
+
+    def save_arrays(self, index_dir):
+        from utils.index import _save_array
+
+        for name in self.arrays:
+            _save_array(index_dir, name, getattr(self, name))
+
+    @classmethod
+    def load_arrays(cls, index_dir, vectors, params):
+        from utils.index import _load_array
+
+        index = cls(vectors, train=False, **params)
+        for name in cls.arrays:
+            setattr(index, name, np.asarray(_load_array(index_dir, name)))
+        return index
+
+
+class Float16Index(QuantizedIndex):
+    """
+    Half-precision copy of the vectors: 2 bytes per dimension, nearly lossless.
+    """
+    kind = 'fp16'
+
+    def _encode(self, vectors):
+        return {'codes': np.asarray(vectors).astype('float16')}
+
+    def _scan(self, queries, start, end):
+        return queries @ self.codes[start:end].astype('float32').T
+
+
+class Int8Index(QuantizedIndex):
+    """
+    Scalar quantization to int8 with one scale per vector: 1 byte per dimension.
+    """
+    kind = 'int8'
+    arrays = ('codes', 'scales')
+
+    def _encode(self, vectors):
+        vectors = np.asarray(vectors, dtype='float32')
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        return {'codes': np.rint(vectors / scales[:, None]).astype('int8'),
+                'scales': scales.astype('float32')}
+
+    def _scan(self, queries, start, end):
+        return (queries @ self.codes[start:end].astype('float32').T) * self.scales[start:end]
+
+
+class PQIndex(QuantizedIndex):
+    """
+    Product quantization: every vector is cut into `n_subvectors` pieces and each piece is
+    replaced by the id of the nearest of 256 centroids learned for its position, i.e. one
+    byte per piece. Queries are scored with one lookup table per piece.
+
+    More pieces give better recall and larger codes; `rescore` makes up for most of the loss.
+    """
+    kind = 'pq'
+    arrays = ('codes', 'codebooks')
+    N_CENTROIDS = 256
+
+    def __init__(self, vectors: ndarray, n_subvectors: int = 96, rescore: int = 200, n_iter: int = 10,
+                 seed: int = 0, train: bool = True):
+        dim = vectors.shape[1]
+        # Pieces must have equal width, so use the largest divisor of dim not above the request
+        self.n_subvectors = max(d for d in range(1, min(n_subvectors, dim) + 1) if dim % d == 0)
+        self.n_iter = n_iter
+        self.seed = seed
+        super().__init__(vectors, rescore, train, n_subvectors=self.n_subvectors)
+
+    def _pieces(self, vectors):
+        return np.asarray(vectors, dtype='float32').reshape(vectors.shape[0], self.n_subvectors, -1)
+
+    def _fit(self):
+        rng = np.random.default_rng(self.seed)
+        n = len(self)
+        sample = normalize_rows(self.vectors[np.sort(rng.choice(n, min(n, 32 * self.N_CENTROIDS), replace=False))])
+        # (n_subvectors, n_rows, piece width)
+        pieces = np.ascontiguousarray(self._pieces(sample).transpose(1, 0, 2))
+        self.codebooks = _kmeans(pieces, self.N_CENTROIDS, self.n_iter, rng).astype('float32')
+        super()._fit()
+
+    def _encode(self, vectors):
+        codes = np.empty((vectors.shape[0], self.n_subvectors), dtype='uint8')
+        for start in range(0, vectors.shape[0], self.SCAN_BLOCK):
+            pieces = self._pieces(np.asarray(vectors[start:start + self.SCAN_BLOCK])).transpose(1, 0, 2)
+            codes[start:start + pieces.shape[1]] = _nearest(pieces, self.codebooks).T
+        return {'codes': codes}
+
+    def _prepare(self, queries):
+        # (n_queries, n_subvectors, n_centroids): every query piece against every centroid
+        return np.einsum('qpd,pcd->qpc', self._pieces(queries), self.codebooks)
+
+    def _scan(self, tables, start, end):
+        codes = self.codes[start:end]
+        scores = np.zeros((tables.shape[0], end - start), dtype='float32')
+        for piece in range(self.n_subvectors):
+            scores += tables[:, piece, codes[:, piece]]
+        return scores
+
+
+QUANTIZED_TYPES = {cls.kind: cls for cls in (Float16Index, Int8Index, PQIndex)}
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    from utils.index import ExactIndex, recall_at_k
+
+    parser = argparse.ArgumentParser(description='Memory and recall of the compressed vector formats')
+    parser.add_argument('--size', type=int, default=50000)
+    parser.add_argument('--dim', type=int, default=1536)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--k', type=int, default=10)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    centers = rng.standard_normal((64, args.dim))
+    data = centers[rng.integers(0, 64, args.size)] + 0.5 * rng.standard_normal((args.size, args.dim))
+    data = normalize_rows(data.astype('float32'))
+    queries = data[rng.choice(args.size, args.queries)] + 0.1 * rng.standard_normal((args.queries, args.dim))
+
+    t_start = time.perf_counter()
+    ExactIndex(data).search(queries, args.k)
+    t_query = (time.perf_counter() - t_start) / args.queries
+    print(f'  fp32: {data.nbytes / 2 ** 20:8.1f} MB, {t_query * 1000:.2f} ms/query, recall@{args.k} 1.000')
+
+    for kind, index_type in QUANTIZED_TYPES.items():
+        t_start = time.perf_counter()
+        index = index_type(data)
+        t_build = time.perf_counter() - t_start
+        t_start = time.perf_counter()
+        index.search(queries, args.k)
+        t_query = (time.perf_counter() - t_start) / args.queries
+        rescore = index.rescore
+        index.rescore = 0
+        raw_recall = recall_at_k(index, queries, args.k)
+        index.rescore = rescore
+        print(f'{kind:>6}: {index.codes_nbytes / 2 ** 20:8.1f} MB '
+              f'({1 - index.codes_nbytes / data.nbytes:.1%} saved), build {t_build:.2f}s, '
+              f'{t_query * 1000:.2f} ms/query, recall@{args.k} {recall_at_k(index, queries, args.k):.3f} '
+              f'rescored / {raw_recall:.3f} compressed only')
@@ -0,0 +1,111 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.ai import vector_similarity
+from utils.config import Answering
+
+
+class _CorpusEntries:
+    def __init__(self, dim, capacity):
+        self.vectors = np.zeros((capacity, dim), dtype='float32')
+        self.answers = [None] * capacity
+        self.last_used = np.zeros(capacity)
+        self.size = 0
+
+
+class SemanticAnswerCache:
+    """
+    In-memory answer cache matching questions by embedding similarity instead of by text.
+
+    Every user corpus gets a small matrix of question embeddings; a lookup is one
+    matrix-vector product, and an answer is reused when the best similarity reaches
+    `threshold`. Each corpus holds at most `max_entries` questions (least recently used
+    are replaced) and at most `max_corpora` corpora are kept.
+    """
+
+    def __init__(self, threshold=0.95, max_entries=256, max_corpora=1000):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.max_corpora = max_corpora
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._corpora = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _entries(self, corpus, dim=None):
+        """
+        `corpus` is (user, version); a newer version of a user's corpus replaces the old one.
+        """
+        user, version = corpus
+        current = self._corpora.get(user)
+        if current is not None and current[0] == version:
+            self._corpora.move_to_end(user)
+            return current[1]
+        if dim is None:
+            return None
+        entries = _CorpusEntries(dim, self.max_entries)
+        self._corpora[user] = (version, entries)
+        self._corpora.move_to_end(user)
+        while len(self._corpora) > self.max_corpora:
+            self._corpora.popitem(last=False)
+        return entries
+
+    def get(self, corpus, question_vector):
+        """
+        Returns (answer, similarity) of the most similar cached question, or None below the threshold.
+        """
+        with self._lock:
+            entries = self._entries(corpus)
+            if entries is None or entries.size == 0:
+                self.misses += 1
+                return None
+            similarities = vector_similarity(entries.vectors[:entries.size], question_vector)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                self.misses += 1
+                return None
+            entries.last_used[best] = time.monotonic()
+            self.hits += 1
+            return entries.answers[best], float(similarities[best])
+
+    def put(self, corpus, question_vector, answer):
+        question_vector = np.asarray(question_vector, dtype='float32')
+        with self._lock:
+            entries = self._entries(corpus, question_vector.shape[0])
+            if entries.size < self.max_entries:
+                slot = entries.size
+                entries.size += 1
+            else:
+                slot = int(np.argmin(entries.last_used))
+                self.evictions += 1
+            entries.vectors[slot] = question_vector
+            entries.answers[slot] = answer
+            entries.last_used[slot] = time.monotonic()
+
+    def invalidate(self, user):
+        with self._lock:
+            self._corpora.pop(user, None)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits / total if total else 0.0}
+
+
+_semantic_cache = None
+_semantic_cache_lock = threading.Lock()
+
+
+def get_semantic_cache(threshold=Answering.SEMANTIC_CACHE_THRESHOLD):
+    """
+    Process-wide cache instance; `threshold` only applies when it is first created.
+    """
+    global _semantic_cache
+    with _semantic_cache_lock:
+        if _semantic_cache is None:
+            _semantic_cache = SemanticAnswerCache(threshold)
+    return _semantic_cache
@@ -0,0 +1,271 @@
+"""
+Retrieval service behind the Urls endpoints. Keeps each user's index resident in memory,
+so it is loaded once per store version instead of once per Streamlit session.
+
+    python -m utils.service [--host 127.0.0.1] [--port 8088]
+
+The service trusts the `user` of a request, so it only listens on a loopback address unless
+Service.SECRET is set; every request must then carry the secret in the X-Service-Secret header.
+
+All endpoints take and return JSON, and GET /metrics serves the span histograms (see utils/tracing.py):
+
+    POST /doc/send_chunks           {user, chunks: [{Filename, Content, Document?, Tokens?}],
+                                     embeddings?: [[float]], group?}
+    POST /doc/clear                 {user}
+    POST /doc/get_related_contents  {user, question, embedding?, pool?, max_tokens?,
+                                     separator_len?, mode?: hybrid | vector | lexical,
+                                     mmr_lambda?: float | null, mmr_k?, documents?: [str]}
+
+With Sharing.ENABLED, all users share one corpus (see utils/access.py): chunks sent by a
+user are theirs, or shared with one of their groups by `group`; a search only returns
+chunks the user may read, optionally only those of `documents`; and clearing only drops
+the user's private documents.
+"""
+import asyncio
+import hmac
+import ipaddress
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+import numpy as np
+import openai
+import pandas as pd
+from aiohttp import web
+
+from utils.ai import try_get_embedding
+from utils.cache import get_answer_cache
+from utils.access import access_mask, private_documents, shared_document, user_groups
+from utils.config import Answering, Retrieval, Service, Sharing, Jobs, corpus_dir
+from utils.corpus import CorpusManager, clear_corpus, refresh_corpus
+from utils.embedder import make_embedder
+from utils.jobs import get_job_queue
+from utils.qa import find_related_contents
+from utils.store import document_name, open_store
+from utils.tracing import get_tracer
+from utils.warmup import warm_up
+
+
+DEFAULT_POOL = Answering.CANDIDATE_POOL
+DEFAULT_MAX_TOKENS = Answering.MAX_SECTION_LEN
+RETRIEVAL_MODES = ('hybrid', 'vector', 'lexical')
+USERNAME_PATTERN = re.compile(r'[\w.@-]+')
+
+SECRET_HEADER = 'X-Service-Secret'
+
+CORPORA_KEY = web.AppKey('corpora', CorpusManager)
+EXECUTOR_KEY = web.AppKey('executor', ThreadPoolExecutor)
+
+
+def is_loopback(host):
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def require_secret(secret):
+    """
+    Middleware refusing requests that do not carry the shared secret.
+    """
+    @web.middleware
+    async def middleware(request, handler):
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, '').encode(), secret.encode()):
+            raise web.HTTPUnauthorized(text=f'Missing or wrong {SECRET_HEADER} header')
+        return await handler(request)
+
+    return middleware
+
+
+def _corpus_dir(body):
+    """
+    Directory of the corpus searched for the user of a request.
+    """
+    user = body.get('user')
+    if not isinstance(user, str) or not USERNAME_PATTERN.fullmatch(user) or user.strip('.') == '':
+        raise web.HTTPBadRequest(text='"user" must be a valid username')
+    return corpus_dir(user)
+
+
+async def _read_body(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        raise web.HTTPBadRequest(text='Expected a JSON body')
+    if not isinstance(body, dict):
+        raise web.HTTPBadRequest(text='Expected a JSON object')
+    return body
+
+
+def _int_param(body, name, default, minimum):
+    value = body.get(name, default)
+    # JSON true and false are ints to Python
+    if isinstance(value, bool) or not isinstance(value, int) or value < minimum:
+        raise web.HTTPBadRequest(text=f'"{name}" must be an integer of at least {minimum}')
+    return value
+
+
+async def _run(request, func, *args):
+    """
+    Runs blocking work (file I/O, numpy, OpenAI calls) off the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(request.app[EXECUTOR_KEY], partial(func, *args))
+
+
+def _add_chunks(path, chunks, embeddings):
+    store = open_store(path)
+    if embeddings is None:
+        embeddings = make_embedder().embed(chunks['Content'].to_list())
+    store.append(chunks, embeddings)
+    refresh_corpus(store, Retrieval.INDEX_KIND, Retrieval.INDEX_PARAMS)
+    return store.version
+
+
+async def send_chunks(request):
+    body = await _read_body(request)
+    path = _corpus_dir(body)
+    chunks = pd.DataFrame(body.get('chunks') or [])
+    if chunks.empty or not {'Filename', 'Content'} <= set(chunks.columns):
+        raise web.HTTPBadRequest(text='"chunks" must be a list of objects with Filename and Content')
+    embeddings = body.get('embeddings')
+    if embeddings is not None:
+        embeddings = np.asarray(embeddings, dtype='float32')
+        if embeddings.ndim != 2 or len(embeddings) != len(chunks):
+            raise web.HTTPBadRequest(text='"embeddings" must hold one vector per chunk')
+    if Sharing.ENABLED:
+        group = body.get('group') or ''
+        if group and group not in user_groups(body['user']):
+            raise web.HTTPForbidden(text=f'"{body["user"]}" is not a member of "{group}"')
+        documents = chunks['Document'] if 'Document' in chunks else chunks['Filename'].map(document_name)
+        chunks['Document'] = [shared_document(document, body['user'], group) for document in documents]
+        chunks['Owner'], chunks['Group'] = body['user'], group
+
+    version = await _run(request, _add_chunks, path, chunks, embeddings)
+    return web.json_response({'n_chunks': len(chunks), 'version': version})
+
+
+def _clear_private(path, user):
+    store = open_store(path)
+    store.delete_documents(private_documents(store.documents(), user))
+    refresh_corpus(store, Retrieval.INDEX_KIND, Retrieval.INDEX_PARAMS)
+
+
+async def clear(request):
+    body = await _read_body(request)
+    path = _corpus_dir(body)
+    if Sharing.ENABLED:
+        # Documents shared with a group stay for its other members
+        await _run(request, _clear_private, path, body['user'])
+    else:
+        request.app[CORPORA_KEY].drop(path)
+        await _run(request, clear_corpus, path)
+    # Answers cached for the old corpus are of no use any more
+    await _run(request, get_answer_cache().invalidate, body['user'])
+    return web.json_response({'cleared': True})
+
+
+def _related_contents(corpora, path, user, question, embedding, pool, max_tokens, separator_len, mode,
+                      mmr_lambda, mmr_k, documents):
+    if embedding is None and mode != 'lexical':
+        embedding = try_get_embedding(question, timeout=Retrieval.QUERY_EMBEDDING_TIMEOUT)
+    version, dataset = corpora.get(path)
+    if embedding is not None:
+        embedding = np.asarray(embedding, dtype='float32')
+        if embedding.shape != dataset[0].vectors.shape[1:]:
+            raise web.HTTPBadRequest(text=f'"embedding" must be a vector of {dataset[0].vectors.shape[1]} numbers')
+    allowed = access_mask(dataset[1], user, documents=documents)
+    found = find_related_contents(dataset, question, embedding, pool, max_tokens, separator_len,
+                                  mode, Retrieval.RRF_K, mmr_lambda, mmr_k, allowed)
+    return version, found
+
+
+async def get_related_contents(request):
+    body = await _read_body(request)
+    path = _corpus_dir(body)
+    question = body.get('question')
+    if not isinstance(question, str) or not question.strip():
+        raise web.HTTPBadRequest(text='"question" must be a non-empty string')
+    mode = body.get('mode', Retrieval.MODE)
+    if mode not in RETRIEVAL_MODES:
+        raise web.HTTPBadRequest(text=f'"mode" must be one of {RETRIEVAL_MODES}')
+    pool = _int_param(body, 'pool', DEFAULT_POOL, 1)
+    max_tokens = _int_param(body, 'max_tokens', DEFAULT_MAX_TOKENS, 0)
+    separator_len = _int_param(body, 'separator_len', 0, 0)
+    mmr_k = _int_param(body, 'mmr_k', Retrieval.MMR_K, 1)
+    mmr_lambda = body.get('mmr_lambda', Retrieval.MMR_LAMBDA)
+    if mmr_lambda is not None and (not isinstance(mmr_lambda, (int, float)) or not 0 <= mmr_lambda <= 1):
+        raise web.HTTPBadRequest(text='"mmr_lambda" must be a number between 0 and 1, or null')
+    documents = body.get('documents')
+    if documents is not None and (not isinstance(documents, list)
+                                  or not all(isinstance(document, str) for document in documents)):
+        raise web.HTTPBadRequest(text='"documents" must be a list of document names')
+    embedding = body.get('embedding')
+    if embedding is not None and (not isinstance(embedding, list) or not embedding or not all(
+            isinstance(x, (int, float)) and not isinstance(x, bool) for x in embedding)):
+        raise web.HTTPBadRequest(text='"embedding" must be a list of numbers, or null')
+
+    try:
+        version, found = await _run(request, _related_contents, request.app[CORPORA_KEY], path, body['user'],
+                                    question, embedding, pool, max_tokens, separator_len, mode,
+                                    mmr_lambda, mmr_k, documents)
+    except FileNotFoundError:
+        raise web.HTTPNotFound(text=f'No documents stored for "{body["user"]}"')
+    return web.json_response({
+        'version': version,
+        'scores': found['Score'].astype(float).to_list(),
+        'contents': found['Content'].to_list(),
+        'texts': found['Text'].to_list(),
+        'documents': found['Document'].to_list(),
+    })
+
+
+async def metrics(request):
+    """
+    Span histograms of the service, as Prometheus text or with ?format=json as a snapshot.
+    """
+    if request.query.get('format') == 'json':
+        return web.json_response(get_tracer().snapshot())
+    return web.Response(text=get_tracer().prometheus(), content_type='text/plain')
+
+
+def make_app(workers=Service.WORKERS, secret=Service.SECRET):
+    app = web.Application(client_max_size=256 * 1024 * 1024,
+                          middlewares=[require_secret(secret)] if secret else [])
+    app[CORPORA_KEY] = CorpusManager(Retrieval.INDEX_PARAMS, Retrieval.CORPUS_MEMORY_BYTES)
+    app[EXECUTOR_KEY] = ThreadPoolExecutor(max_workers=workers)
+
+    async def shutdown(app):
+        app[EXECUTOR_KEY].shutdown(wait=False)
+
+    app.on_cleanup.append(shutdown)
+    app.add_routes([web.post('/doc/send_chunks', send_chunks),
+                    web.post('/doc/clear', clear),
+                    web.post('/doc/get_related_contents', get_related_contents),
+                    web.get('/metrics', metrics)])
+    return app
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the Doc. Insight retrieval service')
+    parser.add_argument('--host', default=Service.HOST)
+    parser.add_argument('--port', type=int, default=Service.PORT)
+    parser.add_argument('--workers', type=int, default=Service.WORKERS)
+    parser.add_argument('--job-workers', type=int, default=Jobs.WORKERS,
+                        help='Threads processing queued ingestion jobs (see utils/jobs.py); 0 for none')
+    parser.add_argument('--api-key-path', default='api.txt')
+    args = parser.parse_args()
+    if not Service.SECRET and not is_loopback(args.host):
+        parser.error(f'Set Service.SECRET to listen on {args.host}: without it, any client could act as any user')
+
+    if os.path.exists(args.api_key_path):
+        openai.api_key_path = args.api_key_path
+    warm_up()
+    if args.job_workers:
+        get_job_queue().start_workers(args.job_workers)
+    web.run_app(make_app(args.workers), host=args.host, port=args.port)
@@ -0,0 +1,467 @@
+import ast
+import json
+import os
+import re
+import shutil
+import threading
+
+import numpy as np
+import pandas as pd
+
+from utils.blobs import BlobReader, ChunkTexts, offsets_path, write_blob
+from utils.tracing import traced
+
+
+STORE_DIRNAME = 'store'
+MANIFEST_FILE = 'manifest.json'
+LEGACY_FILE = 'processed_docs.csv'
+# Flat single-matrix layout written before the store was split into segments
+FLAT_VECTORS_FILE = 'embeddings.npy'
+FLAT_META_FILE = 'chunks.csv'
+# Legacy files are renamed with this suffix once imported, so they are not imported again
+MIGRATED_SUFFIX = '.migrated'
+# Last version of a cleared store, kept next to it so the versions of the next one continue from it
+CLEARED_VERSION_FILE = 'store_version'
+
+# The Content of a chunk is kept in the compressed text blob of its segment (see utils/blobs.py)
+META_COLUMNS = ['chunk_id', 'Document', 'Filename', 'Tokens', 'Owner', 'Group']
+# Access control columns of a shared corpus (see utils/access.py), empty in per-user stores;
+# loaded as categoricals, so filters compare small integer codes
+ACCESS_COLUMNS = ['Owner', 'Group']
+# Token count of chunks stored before counts were recorded at ingest
+UNKNOWN_TOKENS = -1
+
+# Compaction is started in the background once a store has more segments than this
+MAX_SEGMENTS = 8
+# Compression of the chunk texts of new segments: 'zlib', 'zstd' or 'none'
+TEXT_CODEC = 'zlib'
+# Times load() reads the manifest again when compactions keep replacing its segments
+LOAD_ATTEMPTS = 5
+
+# Lock file of the writes to a store, next to it so clearing the store keeps it
+LOCK_FILE = 'store.lock'
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+_file_locks = {}
+_file_locks_lock = threading.Lock()
+
+
+def _lock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        return
+    while True:
+        try:
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            return
+        except OSError:
+            # LK_LOCK gives up after 10 seconds
+            pass
+
+
+def _unlock_file(f):
+    if fcntl is None:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class FileLock:
+    """
+    Reentrant lock shared by the threads of a process and, through an exclusive lock on
+    `path`, by all processes: the service, the job workers and the Streamlit pages all
+    write to the same stores. Use file_lock() to get the one instance per path.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self._file = open(self.path, 'a+b')
+                _lock_file(self._file)
+            except BaseException:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self._depth -= 1
+        if self._depth == 0:
+            _unlock_file(self._file)
+            self._file.close()
+            self._file = None
+        self._thread_lock.release()
+
+
+def file_lock(path):
+    with _file_locks_lock:
+        return _file_locks.setdefault(os.path.abspath(path), FileLock(os.path.abspath(path)))
+
+
+def document_name(chunk_filename):
+    """
+    Chunk files are named "<document>_<split id>.txt".
+    """
+    return re.sub(r'_\d+\.txt$', '', os.path.basename(chunk_filename))
+
+
+def str_vectors_to_matrix(str_vectors):
+    matrix = [ast.literal_eval(v) for v in str_vectors]
+    return np.array(matrix, dtype='float32').reshape(len(matrix), -1)
+
+
+def _write_npy(path, array):
+    # np.save appends ".npy" to plain paths, so write through a file object
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, np.ascontiguousarray(array, dtype='float32'))
+    os.replace(path + '.tmp', path)
+
+
+def _write_csv(path, df):
+    df.to_csv(path + '.tmp', index=False)
+    os.replace(path + '.tmp', path)
+
+
+def _read_csv(path):
+    meta = pd.read_csv(path, dtype=str, keep_default_na=False)
+    if 'Tokens' not in meta:
+        meta['Tokens'] = UNKNOWN_TOKENS
+    for column in ACCESS_COLUMNS:
+        if column not in meta:
+            meta[column] = ''
+    return meta.astype({'chunk_id': 'int64', 'Tokens': 'int64'})
+
+
+def _without_blobs(segments):
+    """
+    Whether some segments keep their texts in the metadata table, as before blobs.
+    """
+    return any('codec' not in segment for segment in segments)
+
+
+class SegmentStore:
+    """
+    Append-only per-user store of chunk embeddings, texts and metadata.
+
+    Every upload becomes a new segment: a contiguous float32 matrix (.npy, memory-mapped
+    on load), a blob of compressed chunk texts (memory-mapped, read chunk by chunk) and
+    a metadata table. A manifest tracks the segments, which chunk ids belong to which
+    document, and tombstones for deleted chunks. Compaction rewrites all segments into
+    one without the deleted chunks.
+
+    `version` changes on every write and never repeats, not even after the store was
+    cleared; `generation` changes only when compaction renumbers rows.
+    """
+
+    def __init__(self, user_dir):
+        self.user_dir = user_dir
+        self.store_dir = os.path.join(user_dir, STORE_DIRNAME)
+        self._lock = file_lock(os.path.join(user_dir, LOCK_FILE))
+
+    # --- manifest ---
+
+    def _manifest_path(self):
+        return os.path.join(self.store_dir, MANIFEST_FILE)
+
+    def exists(self):
+        return os.path.exists(self._manifest_path())
+
+    def read_manifest(self):
+        if not self.exists():
+            return {'version': self._cleared_version(), 'generation': 0, 'next_id': 0, 'next_segment': 0,
+                    'segments': [], 'documents': {}, 'deleted': []}
+        with open(self._manifest_path()) as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest):
+        manifest['version'] += 1
+        os.makedirs(self.store_dir, exist_ok=True)
+        with open(self._manifest_path() + '.tmp', 'w') as f:
+            json.dump(manifest, f)
+        os.replace(self._manifest_path() + '.tmp', self._manifest_path())
+
+    def _cleared_version(self):
+        try:
+            with open(os.path.join(self.user_dir, CLEARED_VERSION_FILE)) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    @property
+    def version(self):
+        return self.read_manifest()['version']
+
+    def documents(self):
+        """
+        Returns {document: number of live chunks}.
+        """
+        manifest = self.read_manifest()
+        return {doc: sum(end - start for start, end in ranges)
+                for doc, ranges in manifest['documents'].items()}
+
+    def _segment_path(self, name, ext):
+        return os.path.join(self.store_dir, f'{name}.{ext}')
+
+    # --- writes ---
+
+    def _write_segment(self, manifest, meta, vectors, texts):
+        name = f"seg_{manifest['next_segment']:06d}"
+        manifest['next_segment'] += 1
+        os.makedirs(self.store_dir, exist_ok=True)
+        _write_npy(self._segment_path(name, 'npy'), vectors)
+        write_blob(self._segment_path(name, 'blob'), texts, TEXT_CODEC)
+        _write_csv(self._segment_path(name, 'csv'), meta[META_COLUMNS])
+        return {'name': name, 'n_rows': len(meta), 'codec': TEXT_CODEC}
+
+    def append(self, meta, vectors):
+        """
+        Adds chunks (a DataFrame with Filename and Content, optionally Document, Tokens,
+        Owner and Group) and their embeddings as a new segment. Documents that already exist are replaced.
+        Returns the new chunk ids.
+        """
+        vectors = np.asarray(vectors, dtype='float32')
+        if vectors.ndim != 2 or vectors.shape[0] != len(meta):
+            raise ValueError(f'Expected {len(meta)} embeddings, got array of shape {vectors.shape}')
+        if len(meta) == 0:
+            return np.empty(0, dtype='int64')
+
+        meta = meta.reset_index(drop=True).copy()
+        if 'Document' not in meta:
+            meta['Document'] = meta['Filename'].map(document_name)
+        if 'Tokens' not in meta:
+            meta['Tokens'] = UNKNOWN_TOKENS
+        for column in ACCESS_COLUMNS:
+            if column not in meta:
+                meta[column] = ''
+
+        with self._lock:
+            manifest = self.read_manifest()
+            self._delete_documents(manifest, meta['Document'].unique())
+            chunk_ids = np.arange(manifest['next_id'], manifest['next_id'] + len(meta), dtype='int64')
+            manifest['next_id'] += len(meta)
+            meta['chunk_id'] = chunk_ids
+
+            for doc, rows in meta.groupby('Document', sort=False).indices.items():
+                # Chunks of one document are contiguous when it was split in one go
+                ranges = []
+                for chunk_id in chunk_ids[rows]:
+                    if ranges and ranges[-1][1] == chunk_id:
+                        ranges[-1][1] += 1
+                    else:
+                        ranges.append([int(chunk_id), int(chunk_id) + 1])
+                manifest['documents'][doc] = ranges
+
+            manifest['segments'].append(self._write_segment(manifest, meta, vectors, meta['Content']))
+            self._write_manifest(manifest)
+        return chunk_ids
+
+    def _delete_documents(self, manifest, documents):
+        for doc in documents:
+            for start, end in manifest['documents'].pop(doc, []):
+                manifest['deleted'].extend(range(start, end))
+
+    def delete_documents(self, documents):
+        """
+        Tombstones every chunk of the given documents; the rows are dropped at compaction.
+        """
+        with self._lock:
+            manifest = self.read_manifest()
+            self._delete_documents(manifest, documents)
+            self._write_manifest(manifest)
+
+    def clear(self):
+        """
+        Deletes the whole store. Its version is kept, so caches keyed by the version of the
+        store never take a new store for the one that was cleared.
+        """
+        with self._lock:
+            version = self.version
+            os.makedirs(self.user_dir, exist_ok=True)
+            path = os.path.join(self.user_dir, CLEARED_VERSION_FILE)
+            with open(path + '.tmp', 'w') as f:
+                f.write(str(version))
+            os.replace(path + '.tmp', path)
+            if os.path.exists(self.store_dir):
+                shutil.rmtree(self.store_dir)
+            # Or open_store would import them again
+            for path in self._legacy_paths():
+                if os.path.exists(path):
+                    os.remove(path)
+
+    # --- reads ---
+
+    def load(self):
+        """
+        Returns (vectors, meta, live, texts) over all segments in chunk id order, where
+        `live` is a boolean mask of the rows that are not deleted and `texts` the ChunkTexts
+        of the rows; meta has no Content column.
+
+        A store with a single segment is memory-mapped without copying; several segments
+        are concatenated until the next compaction.
+        Reads take no lock: if a compaction removes the segments while they are being
+        opened, they are read again from the new manifest.
+        """
+        for attempt in range(LOAD_ATTEMPTS):
+            manifest = self.read_manifest()
+            if not manifest['segments']:
+                raise FileNotFoundError(f'No documents stored in "{self.store_dir}"')
+            try:
+                vectors, meta, texts = self._load_segments(manifest['segments'])
+                break
+            except FileNotFoundError:
+                # A compaction replaced the segments after the manifest was read
+                if attempt == LOAD_ATTEMPTS - 1 or self.read_manifest()['segments'] == manifest['segments']:
+                    raise
+        live = ~np.isin(meta['chunk_id'].to_numpy(), manifest['deleted'])
+        # Row numbers of what was just loaded are only valid for this generation
+        self.generation = manifest['generation']
+        return vectors, meta, live, texts
+
+    def _segment_texts(self, segment, meta):
+        """
+        The texts of a segment: its blob, or the Content column of segments written before blobs.
+        """
+        if 'codec' in segment:
+            return BlobReader(self._segment_path(segment['name'], 'blob'), segment['codec'])
+        return meta['Content'].to_list()
+
+    def _load_segments(self, segments):
+        vectors = [np.load(self._segment_path(s['name'], 'npy'), mmap_mode='r') for s in segments]
+        metas = [_read_csv(self._segment_path(s['name'], 'csv')) for s in segments]
+        texts = ChunkTexts(self._segment_texts(s, meta) for s, meta in zip(segments, metas))
+        vectors = vectors[0] if len(vectors) == 1 else np.concatenate(vectors)
+        meta = pd.concat([meta[META_COLUMNS] for meta in metas], ignore_index=True)
+        return vectors, meta.astype({column: 'category' for column in ACCESS_COLUMNS}), texts
+
+    # --- compaction ---
+
+    @traced('ingest.compact')
+    def compact(self):
+        """
+        Merges all current segments into one and drops tombstoned chunks. Texts of segments
+        written before blobs are moved into the blob of the new segment.
+        Appends and deletes made while compacting are kept. Reads and writes of the manifest
+        hold the store lock, which other processes respect too; merging does not.
+        """
+        with self._lock:
+            manifest = self.read_manifest()
+            segments = manifest['segments']
+            merged = [s['name'] for s in segments]
+            deleted = set(manifest['deleted'])
+            if len(merged) <= 1 and not deleted and not _without_blobs(segments):
+                return False
+        vectors, meta, texts = self._load_segments(segments)
+        keep = ~meta['chunk_id'].isin(deleted).to_numpy()
+        meta, vectors = meta[keep], np.asarray(vectors)[keep]
+        # Texts are streamed from the old blobs into the new one
+        kept_texts = (texts[row] for row in np.flatnonzero(keep))
+
+        with self._lock:
+            manifest = self.read_manifest()
+            if not set(merged) <= {s['name'] for s in manifest['segments']}:
+                # Compacted by another thread or process in the meantime
+                return False
+            segment = self._write_segment(manifest, meta, vectors, kept_texts)
+            others = [s for s in manifest['segments'] if s['name'] not in merged]
+            manifest['segments'] = [segment] + others
+            manifest['deleted'] = [i for i in manifest['deleted'] if i not in deleted]
+            manifest['generation'] += 1
+            self._write_manifest(manifest)
+
+        for name in merged:
+            for path in (self._segment_path(name, 'npy'), self._segment_path(name, 'csv'),
+                         self._segment_path(name, 'blob'), offsets_path(self._segment_path(name, 'blob'))):
+                try:
+                    os.remove(path)
+                except OSError:
+                    # Still memory-mapped by a reader on Windows; it is unreferenced either way
+                    pass
+        return True
+
+    def needs_compaction(self):
+        manifest = self.read_manifest()
+        return len(manifest['segments']) > MAX_SEGMENTS or _without_blobs(manifest['segments']) or \
+            len(manifest['deleted']) > sum(s['n_rows'] for s in manifest['segments']) // 4
+
+    def compact_in_background(self, on_done=None):
+        def run():
+            if self.compact() and on_done is not None:
+                on_done()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    # --- migration ---
+
+    def _legacy_paths(self):
+        return [os.path.join(self.user_dir, name) for name in (FLAT_VECTORS_FILE, FLAT_META_FILE, LEGACY_FILE)]
+
+    def migrate(self):
+        """
+        One-shot import of the older layouts of a user directory (processed_docs.csv with
+        stringified embeddings, or the flat embeddings.npy + chunks.csv) as a first segment.
+        The imported files are renamed to "<name>.migrated" afterwards.
+        """
+        flat_vectors = os.path.join(self.user_dir, FLAT_VECTORS_FILE)
+        flat_meta = os.path.join(self.user_dir, FLAT_META_FILE)
+        legacy_path = os.path.join(self.user_dir, LEGACY_FILE)
+        with self._lock:
+            if os.path.exists(flat_vectors) and os.path.exists(flat_meta):
+                meta = pd.read_csv(flat_meta, dtype=str, keep_default_na=False)
+                vectors = np.load(flat_vectors)
+            elif os.path.exists(legacy_path):
+                meta = pd.read_csv(legacy_path, dtype=str, keep_default_na=False)
+                vectors = str_vectors_to_matrix(meta['Embedding'])
+            else:
+                return 0
+            self.append(meta[['Filename', 'Content']], vectors)
+            for path in self._legacy_paths():
+                if os.path.exists(path):
+                    os.replace(path, path + MIGRATED_SUFFIX)
+        return len(meta)
+
+
+def open_store(user_dir):
+    """
+    Returns the store of a user, importing older layouts on first use.
+    """
+    store = SegmentStore(user_dir)
+    if not store.exists():
+        store.migrate()
+    return store
+
+
+def store_version(user_dir):
+    """
+    Cheap change marker for cache keys; changes whenever the store is written.
+    """
+    return SegmentStore(user_dir).version
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Convert user directories to the segment store')
+    parser.add_argument('user_dirs', nargs='+')
+    args = parser.parse_args()
+
+    for path in args.user_dirs:
+        n_rows = SegmentStore(path).migrate()
+        print(f'Migrated {n_rows} chunks from "{path}"')
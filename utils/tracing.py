@@ -0,0 +1,197 @@
+"""
+Lightweight tracing: named spans timed into per-name latency histograms.
+
+    from utils.tracing import span, traced
+
+    with span('completion'):
+        ...
+
+    @traced('construct_prompt')
+    def construct_prompt(...):
+        ...
+
+Histograms can be exported as Prometheus text or as a snapshot dict (shown on the
+Management page); with `Tracing.LOG_PATH` set, every span is also appended to a JSONL
+file. When tracing is disabled a span is a shared no-op object, so the cost is one
+attribute lookup and a function call.
+"""
+import functools
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+           float('inf'))
+METRIC_NAME = 'docinsight_span_seconds'
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+        self.errors = 0
+
+    def observe(self, seconds, error=False):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+        self.errors += error
+
+    def quantile(self, q):
+        """
+        Estimated like Prometheus' histogram_quantile: linear within the bucket holding the rank.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = BUCKETS[i - 1] if i else 0.0
+                upper = BUCKETS[i] if BUCKETS[i] != float('inf') else lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return BUCKETS[-2]
+
+
+class _Span:
+    __slots__ = ('tracer', 'name', 'start')
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.tracer.record(self.name, time.perf_counter() - self.start, error=exc_type is not None)
+        return False
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class Tracer:
+    def __init__(self, enabled=True, log_path=None):
+        self.enabled = enabled
+        self.log_path = log_path
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._log = None
+
+    def span(self, name):
+        return _Span(self, name) if self.enabled else _NOOP_SPAN
+
+    def record(self, name, seconds, error=False):
+        """
+        Adds a duration measured elsewhere, e.g. in a worker process.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(seconds, error)
+            if self.log_path:
+                self._write_log(name, seconds, error)
+
+    def _write_log(self, name, seconds, error):
+        if self._log is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.log_path)), exist_ok=True)
+            self._log = open(self.log_path, 'a', encoding='utf-8')
+        self._log.write(json.dumps({'ts': time.time(), 'pid': os.getpid(), 'span': name,
+                                    'ms': round(seconds * 1000, 3), 'error': error}) + '\n')
+        self._log.flush()
+
+    def snapshot(self):
+        """
+        Returns {span name: {count, errors, mean_ms, p50_ms, p95_ms, p99_ms, buckets}}.
+        """
+        with self._lock:
+            return {name: {'count': h.count, 'errors': h.errors,
+                           'mean_ms': 1000 * h.sum / h.count,
+                           'p50_ms': 1000 * h.quantile(0.5),
+                           'p95_ms': 1000 * h.quantile(0.95),
+                           'p99_ms': 1000 * h.quantile(0.99),
+                           'buckets': list(h.counts)}
+                    for name, h in sorted(self._histograms.items())}
+
+    def prometheus(self):
+        """
+        The histograms in the Prometheus text exposition format.
+        """
+        lines = [f'# HELP {METRIC_NAME} Duration of traced spans.', f'# TYPE {METRIC_NAME} histogram']
+        with self._lock:
+            for name, h in sorted(self._histograms.items()):
+                cumulative = 0
+                for bound, count in zip(BUCKETS, h.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{METRIC_NAME}_bucket{{span="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'{METRIC_NAME}_sum{{span="{name}"}} {h.sum}')
+                lines.append(f'{METRIC_NAME}_count{{span="{name}"}} {h.count}')
+                lines.append(f'docinsight_span_errors_total{{span="{name}"}} {h.errors}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+
+
+_tracer = None
+_tracer_lock = threading.Lock()
+
+
+def get_tracer():
+    """
+    Process-wide tracer, configured from utils.config.Tracing on first use.
+    """
+    global _tracer
+    if _tracer is None:
+        with _tracer_lock:
+            if _tracer is None:
+                from utils.config import Tracing
+
+                _tracer = Tracer(Tracing.ENABLED, Tracing.LOG_PATH)
+    return _tracer
+
+
+def span(name):
+    return get_tracer().span(name)
+
+
+def record(name, seconds, error=False):
+    get_tracer().record(name, seconds, error)
+
+
+def traced(name=None):
+    """
+    Decorator timing every call of a function as a span (named after the function by default).
+    """
+    def decorator(func):
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with get_tracer().span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,136 @@
+"""
+Start-up profile and background warm-up of the slow imports.
+
+The pages only import what a login needs; numpy, pandas, openai, scipy, haystack and the
+tiktoken encoding are loaded on first use. warm_up() loads them in a background thread as
+soon as a process starts, so they are ready by the time the first question or upload
+arrives, and worker processes forked for splitting files inherit them.
+
+    python -m utils.warmup [--top 15]
+
+prints how long each module takes to import in a fresh interpreter, its slowest
+dependencies, and the duration of every warm-up step.
+"""
+import importlib
+import re
+import subprocess
+import sys
+import threading
+import time
+
+from utils.config import Startup
+from utils.tracing import span
+
+
+# Imported by the query, document and management pages once a user is logged in
+APP_MODULES = ('numpy', 'pandas', 'requests', 'openai', 'scipy.spatial.distance', 'tiktoken',
+               'utils.qa', 'utils.corpus', 'utils.cache', 'utils.semantic_cache', 'utils.jobs')
+
+_started = False
+_started_lock = threading.Lock()
+
+
+def _load_encoding():
+    from utils.embedder import count_tokens
+
+    count_tokens('')
+
+
+def _load_preprocessor():
+    from utils.pipeline import prepare_preprocessor
+
+    prepare_preprocessor()
+
+
+def warm_up_steps(preprocessor=True):
+    """
+    (name, function) of the warm-up steps, in order.
+    """
+    steps = [(f'import {module}', lambda module=module: importlib.import_module(module))
+             for module in APP_MODULES]
+    steps.append(('tiktoken encoding', _load_encoding))
+    if preprocessor:
+        steps.append(('haystack PreProcessor', _load_preprocessor))
+    return steps
+
+
+def _run_steps(steps):
+    timings = {}
+    for name, step in steps:
+        start = time.perf_counter()
+        try:
+            with span('warmup'):
+                step()
+        except Exception as e:
+            # Warming up is an optimization only; the step runs again, and fails visibly, on first use
+            print(f'Warm-up step "{name}" failed: {e!r}')
+        timings[name] = time.perf_counter() - start
+    return timings
+
+
+def warm_up(preprocessor=Startup.WARM_PREPROCESSOR):
+    """
+    Starts the warm-up thread of this process, once; later calls do nothing, as do all
+    calls when Startup.WARM_UP is off. Without `preprocessor`, haystack is left to the
+    processes that split files.
+    """
+    global _started
+    with _started_lock:
+        if _started or not Startup.WARM_UP:
+            return
+        _started = True
+    threading.Thread(target=_run_steps, args=(warm_up_steps(preprocessor),), daemon=True,
+                     name='warm-up').start()
+
+
+IMPORTTIME_PATTERN = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)')
+
+
+def import_profile(module):
+    """
+    Imports `module` in a fresh interpreter with -X importtime. Returns (cumulative seconds,
+    [(self seconds, imported module)] of every module it pulled in).
+    """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise ImportError(result.stderr.strip().splitlines()[-1])
+    total, imported = 0.0, []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        if match is None:
+            continue
+        self_us, cumulative_us, indent, name = match.groups()
+        imported.append((int(self_us) / 1e6, name))
+        if name == module and not indent:
+            total = int(cumulative_us) / 1e6
+    return total, imported
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Profile the imports and the warm-up of the app')
+    parser.add_argument('modules', nargs='*', default=list(APP_MODULES))
+    parser.add_argument('--top', type=int, default=15, help='Slowest imported modules to list')
+    args = parser.parse_args()
+
+    slowest = {}
+    print('Import time in a fresh interpreter:')
+    for module in args.modules:
+        try:
+            total, imported = import_profile(module)
+        except ImportError as e:
+            print(f'  {module:<28} not importable: {e}')
+            continue
+        print(f'  {module:<28} {total * 1000:8.1f} ms')
+        for seconds, name in imported:
+            slowest[name] = max(seconds, slowest.get(name, 0.0))
+
+    print('\nSlowest modules (own import time):')
+    for name, seconds in sorted(slowest.items(), key=lambda item: -item[1])[:args.top]:
+        print(f'  {name:<40} {seconds * 1000:8.1f} ms')
+
+    print('\nWarm-up steps in this process:')
+    for name, seconds in _run_steps(warm_up_steps()).items():
+        print(f'  {name:<28} {seconds * 1000:8.1f} ms')